@@ -12,11 +12,17 @@ from os.path import join
 from pkg_resources import resource_filename
 import shutil
 import sys
+import time
 
 import numpy as np
 import obspy
+from rf.datacache import (NoDataCache, RetrievalStats, WaveformArchive,
+                          WaveformCache)
 from rf.rfstream import read_rf
-from rf.util import iter_event_data, iter_event_metadata
+from rf.traveltime import load_taupy_model
+from rf.util import (EventTable, iter_event_data, iter_event_metadata,
+                     iter_task_data, plan_event_data, TaskTable,
+                     _is_local, _RETRIEVAL_OPTIONS)
 
 try:
     from tqdm import tqdm
@@ -132,12 +138,25 @@ def load_func(modulename, funcname):
     return func
 
 
-def init_data(data, client_options=None, plugin=None):
+def init_data(data, client_options=None, plugin=None, cache=None,
+              cache_size=None, nodata_cache=None, max_failures=None,
+              index=None):
     """Return appropriate get_waveforms function.
 
-    See example configuration file for a description of the options."""
+    See example configuration file for a description of the options.
+    Local files are accessed with `~rf.datacache.WaveformArchive`, its
+    index is stored in the file index.
+    If cache is given, retrieved data is stored in this directory
+    (see `~rf.datacache.WaveformCache`), cache_size is in MB.
+    If nodata_cache or max_failures is given, requests without data are
+    skipped (see `~rf.datacache.NoDataCache`) and the returned function
+    has a summary attribute.
+    Latency, size and errors of all requests are recorded in the stats
+    attribute of the returned function
+    (see `~rf.datacache.RetrievalStats`)."""
     if client_options is None:
         client_options = {}
+    get_waveforms_bulk = None
     try:
         client_module = import_module('obspy.clients.%s' % data)
     except ImportError:
@@ -147,32 +166,84 @@ def init_data(data, client_options=None, plugin=None):
         client = Client(**client_options)
 
         def get_waveforms(event=None, **args):
+            if data != 'fdsn' and ',' in args['channel']:
+                # lists of channels are only supported by FDSN web services
+                channels = args.pop('channel').split(',')
+                return sum((client.get_waveforms(channel=cha, **args)
+                            for cha in channels), obspy.Stream())
             return client.get_waveforms(**args)
+        get_waveforms.local = data.startswith('filesystem')
+        get_waveforms_bulk = getattr(client, 'get_waveforms_bulk', None)
     elif data == 'plugin':
         modulename, funcname = plugin.split(':')
         get_waveforms = load_func(modulename.strip(), funcname.strip())
+        get_waveforms_bulk = getattr(get_waveforms, 'bulk', None)
     else:
-        from obspy import read
-        stream = read(data)
-
-        def get_waveforms(network, station, location, channel,
-                          starttime, endtime, event=None):
-            st = stream.select(network=network, station=station,
-                               location=location, channel=channel)
-            st = st.slice(starttime, endtime)
-            return st
+        get_waveforms = WaveformArchive(data, index=index)
+
+    if get_waveforms_bulk is not None:
+        get_waveforms.bulk = get_waveforms_bulk
+    nodata = None
+    if nodata_cache is not None or max_failures is not None:
+        nodata = NoDataCache(get_waveforms, nodata_cache,
+                             max_failures=max_failures)
+        get_waveforms = nodata
+    if cache is not None:
+        if cache_size is not None:
+            cache_size = int(cache_size * 1024 ** 2)
+        get_waveforms = WaveformCache(get_waveforms, cache,
+                                      max_size=cache_size)
+    get_waveforms_bulk = getattr(get_waveforms, 'bulk', None)
+    stats = RetrievalStats()
 
     def wrapper(**kwargs):
+        seedid = '%s.%s.%s.%s' % tuple(
+            kwargs.get(key, '') for key in
+            ('network', 'station', 'location', 'channel'))
+        t1 = time.time()
+        stream = error = None
         try:
-            return get_waveforms(**kwargs)
+            stream = get_waveforms(**kwargs)
+            return stream
         except (KeyboardInterrupt, SystemExit):
             raise
         except Exception as ex:
-            seedid = '.'.join((kwargs['network'], kwargs['station'],
-                               kwargs['location'], kwargs['channel']))
+            error = ex
             msg = 'channel %s: error while retrieving data: %s'
             print(msg % (seedid, ex))
+        finally:
+            stats.record(seedid, time.time() - t1, stream, error,
+                         starttime=t1)
 
+    def wrapper_bulk(bulk):
+        t1 = time.time()
+        stream = error = None
+        try:
+            stream = get_waveforms_bulk(bulk)
+            return stream
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception as ex:
+            error = ex
+            msg = 'bulk request (%d channels): error while retrieving data: %s'
+            print(msg % (len(bulk), ex))
+        finally:
+            # the latency of the bulk request is split between its channels
+            latency = (time.time() - t1) / len(bulk)
+            for net, sta, loc, cha, _, _ in bulk:
+                st = None
+                if stream is not None:
+                    st = stream.select(network=net, station=sta,
+                                       location=loc, channel=cha)
+                stats.record('.'.join((net, sta, loc, cha)), latency, st,
+                             error, starttime=t1)
+
+    if get_waveforms_bulk is not None:
+        wrapper.bulk = wrapper_bulk
+    if nodata is not None:
+        wrapper.summary = nodata.summary
+    wrapper.local = _is_local(get_waveforms)
+    wrapper.stats = stats
     return wrapper
 
 
@@ -235,9 +306,12 @@ DICT_OPTIONS = ['client_options', 'options', 'rf', 'moveout',
 
 def run_commands(command, commands=(), events=None, inventory=None,
                  objects=None, get_waveforms=None, data=None, plugin=None,
+                 data_cache=None, data_cache_size=None, nodata_cache=None,
+                 max_failures=None, data_index=None, data_stats=None,
                  phase=None, moveout_phase=None,
                  path_in=None, path_out=None, format='Q',
-                 newformat=None, **kw):
+                 newformat=None, plan=None, shard=None, dry_run=False,
+                 resume=False, **kw):
     """Load files, apply commands and write result files."""
     for opt in kw:
         if opt not in DICT_OPTIONS:
@@ -251,6 +325,10 @@ def run_commands(command, commands=(), events=None, inventory=None,
         kw['options']['phase'] = phase
     if moveout_phase is not None:
         kw['moveout']['phase'] = moveout_phase
+    if resume:
+        if 'journal' not in kw['options']:
+            raise ParseError('--resume needs the journal option')
+        kw['options']['resume'] = True
     if kw['boxbins'] is not None:
         kw['boxes']['bins'] = np.linspace(*kw['boxbins'])
 
@@ -263,11 +341,30 @@ def run_commands(command, commands=(), events=None, inventory=None,
             assert len(commands) < 2
     except Exception:
         raise ParseError('calc or moveout command given more than once')
-
+    if shard is not None:
+        try:
+            index, number = map(int, shard.split('/'))
+            assert 1 <= index <= number
+        except Exception:
+            msg = ('--shard has to be given as index/number with '
+                   '1 <= index <= number, e.g. 2/4, got %s')
+            raise ParseError(msg % shard)
+
+    # Load task table
+    if command == 'data' and plan is not None:
+        tasks = TaskTable.load(plan)
+        if shard is not None:
+            tasks = tasks.shard(index - 1, number)
+        print(tasks)
+        if dry_run:
+            return
     # Read events and inventory
     try:
-        if command in ('stack', 'plot'):
+        if command in ('stack', 'plot') or plan is not None:
             events = None
+        elif (isinstance(events, basestring) and
+                events.lower().endswith('.npz')):
+            events = EventTable.load(events)
         elif command != 'print' or objects[0] == 'events':
             if (not isinstance(events, obspy.Catalog) or
                     not isinstance(events, list) or
@@ -277,7 +374,9 @@ def run_commands(command, commands=(), events=None, inventory=None,
                 else:
                     events, format_ = events
                 events = obspy.read_events(events, format_)
-        if command != 'print' or objects[0] == 'stations':
+        if plan is not None:
+            pass
+        elif command != 'print' or objects[0] == 'stations':
             if not isinstance(inventory, obspy.Inventory):
                 if isinstance(inventory, basestring):
                     format_ = None
@@ -287,13 +386,28 @@ def run_commands(command, commands=(), events=None, inventory=None,
     except Exception:
         print('cannot read events or stations')
         return
+    # Plan command
+    if command == 'plan':
+        tasks = plan_event_data(events, inventory, pbar=tqdm(),
+                                **kw['options'])
+        tasks.save(path_out)
+        print(tasks)
+        return
+    if command == 'data' and plan is None and dry_run:
+        tasks = plan_event_data(events, inventory, pbar=tqdm(),
+                                **kw['options'])
+        print(tasks)
+        return
     # Initialize get_waveforms
     if command == 'data':
         try:
             # Initialize get_waveforms
             if get_waveforms is None:
                 get_waveforms = init_data(
-                    data, client_options=kw['client_options'], plugin=plugin)
+                    data, client_options=kw['client_options'], plugin=plugin,
+                    cache=data_cache, cache_size=data_cache_size,
+                    nodata_cache=nodata_cache, max_failures=max_failures,
+                    index=data_index)
         except Exception:
             print('cannot initalize data')
             return
@@ -309,7 +423,13 @@ def run_commands(command, commands=(), events=None, inventory=None,
             print(stream.__str__(True))
         return
     # Select appropriate iterator
-    if command == 'data':
+    if command == 'data' and plan is not None:
+        options = {k: v for k, v in kw['options'].items()
+                   if k in _RETRIEVAL_OPTIONS}
+        iter_ = iter_task_data(tasks, get_waveforms, pbar=tqdm(), **options)
+    elif command == 'data':
+        # load TauPy model once before processing, see load_taupy_model
+        load_taupy_model(kw['options'].get('tt_model', 'iasp91'))
         iter_ = iter_event_data(events, inventory, get_waveforms, pbar=tqdm(),
                                 **kw['options'])
     elif command == 'plot-profile':
@@ -362,6 +482,11 @@ def run_commands(command, commands=(), events=None, inventory=None,
                 else:
                     raise NotImplementedError
             write(stream, path_out, format)
+        if 'data' in commands and hasattr(get_waveforms, 'summary'):
+            print(get_waveforms.summary())
+        if ('data' in commands and data_stats is not None and
+                hasattr(get_waveforms, 'stats')):
+            get_waveforms.stats.write(data_stats)
 
 
 def run_cli(args=None):
@@ -381,6 +506,9 @@ def run_cli(args=None):
     sub = p.add_subparsers(title='commands', dest='command')
     msg = 'create config file in current directory'
     p_create = sub.add_parser('create', help=msg)
+    msg = ('plan data retrieval and write table of accepted '
+           'event-station pairs')
+    p_plan = sub.add_parser('plan', help=msg)
     msg = 'retrieve data for further processing'
     p_data = sub.add_parser('data', help=msg)
     msg = 'calculate receiver functions'
@@ -407,6 +535,18 @@ def run_cli(args=None):
     msg = 'calculate receiver functions, perform moveout correction, optional'
     p_data.add_argument('commands', nargs='*', help=msg,
                         choices=('calc', 'moveout'), default='moveout')
+    msg = 'use task table created by plan command'
+    p_data.add_argument('--plan', help=msg, default=SUPPRESS)
+    msg = ('process only one shard of the task table, '
+           'e.g. 2/4 for the second of four shards')
+    p_data.add_argument('--shard', help=msg, default=SUPPRESS)
+    msg = 'only print number of pairs and estimated data volume'
+    p_data.add_argument('--dry-run', help=msg, action='store_true',
+                        default=SUPPRESS)
+    msg = ('skip event-station pairs which are already written or rejected '
+           'according to the journal (see option journal)')
+    p_data.add_argument('--resume', help=msg, action='store_true',
+                        default=SUPPRESS)
     msg = 'perform also moveout correction'
     p_calc.add_argument('commands', nargs='*', help=msg,
                         choices=('moveout',), default='moveout')
@@ -421,6 +561,8 @@ def run_cli(args=None):
     for pp in io:
         msg = 'output directory or output file basename'
         pp.add_argument('path_out', help=msg)
+    msg = 'output file for task table (npz format)'
+    p_plan.add_argument('path_out', help=msg)
 
     msg = 'new format (supported: Q, SAC or H5)'
     p_conv.add_argument('newformat', help=msg)
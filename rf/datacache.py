@@ -0,0 +1,906 @@
+# Copyright 2013-2019 Tom Eulenfeld, MIT license
+"""
+Caches, indexed archives and statistics for the retrieval of raw waveform
+data.
+"""
+from collections import Counter, OrderedDict
+import glob
+import io
+import json
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from obspy import read, Stream, UTCDateTime
+from obspy.io.mseed.core import _is_mseed
+from obspy.io.mseed.util import get_record_information
+
+
+def _channel_dir(network, station, location, channel):
+    """Return relative directory for channel, wildcards are replaced"""
+    chan = '%s.%s' % (location or '--', channel)
+    chan = chan.replace('?', '_').replace('*', '+')
+    return os.path.join(network, station, chan)
+
+
+class WaveformCache(object):
+
+    """
+    Read-through cache of raw waveforms on disk.
+
+    The cache wraps a get_waveforms function (see
+    `~rf.util.iter_event_data()`). Retrieved data is stored in MiniSEED
+    files with the layout ``path/NET/STA/LOC.CHA/STARTNS_ENDNS.mseed``,
+    whereby the file name holds the requested time window in nanoseconds.
+    Later requests for the same or a contained time window of a channel
+    are served from disk. If the total size of the cache exceeds
+    ``max_size`` the least recently used files are removed.
+
+    :param get_waveforms: function returning the data
+    :param path: directory of the cache, it is created if it does not exist
+    :param max_size: maximal size of the cache in bytes (default: no limit)
+
+    The attributes ``hits`` and ``misses`` count the successful and
+    unsuccessful lookups, ``size`` is the total size of the cache in bytes.
+    Empty results are not cached. If get_waveforms supports bulk requests
+    via the ``bulk`` attribute, the cache supports them, too.
+
+    Example usage::
+
+        get_waveforms = WaveformCache(client.get_waveforms, 'raw_cache',
+                                      max_size=10 * 1024 ** 3)
+        for stream in iter_event_data(events, inventory, get_waveforms):
+            do_something(stream)
+    """
+
+    def __init__(self, get_waveforms, path, max_size=None):
+        self.get_waveforms = get_waveforms
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # relative filenames in order of last access and their sizes
+        self._files = OrderedDict()
+        # index channel directory -> set of (start, end, fname)
+        self._index = {}
+        self.size = 0
+        self._scan()
+        if hasattr(get_waveforms, 'bulk'):
+            self.bulk = self._bulk
+
+    def __repr__(self):
+        return '%s(%r) files:%d size:%d hits:%d misses:%d' % (
+            self.__class__.__name__, self.path, len(self), self.size,
+            self.hits, self.misses)
+
+    def __len__(self):
+        return len(self._files)
+
+    def _scan(self):
+        """Index files of an existing cache"""
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        files = []
+        for root, _, fnames in os.walk(self.path):
+            for fname in fnames:
+                if not fname.endswith('.mseed'):
+                    continue
+                fname = os.path.join(root, fname)
+                stat = os.stat(fname)
+                files.append((stat.st_mtime, stat.st_size,
+                              os.path.relpath(fname, self.path)))
+        for _, size, fname in sorted(files):
+            try:
+                self._add(fname, size)
+            except ValueError:  # not written by cache
+                pass
+
+    def _add(self, fname, size):
+        chan_dir, name = os.path.split(fname)
+        start, end = map(int, name[:-6].split('_'))
+        if fname in self._files:
+            self.size -= self._files.pop(fname)
+        self._files[fname] = size
+        self._index.setdefault(chan_dir, set()).add((start, end, fname))
+        self.size += size
+
+    def _remove(self, fname):
+        chan_dir, name = os.path.split(fname)
+        start, end = map(int, name[:-6].split('_'))
+        self.size -= self._files.pop(fname)
+        self._index[chan_dir].discard((start, end, fname))
+        try:
+            os.remove(os.path.join(self.path, fname))
+        except OSError:
+            pass
+
+    def _lookup(self, chan_dir, start, end):
+        """Return smallest cached file containing the time window"""
+        with self._lock:
+            candidates = [(e - s, fname) for s, e, fname in
+                          self._index.get(chan_dir, ())
+                          if s <= start and e >= end]
+            if len(candidates) == 0:
+                return
+            fname = min(candidates)[1]
+            self._files.move_to_end(fname)
+        return fname
+
+    def get(self, network, station, location, channel, starttime, endtime):
+        """Return cached data for request or None"""
+        chan_dir = _channel_dir(network, station, location, channel)
+        fname = self._lookup(chan_dir, starttime.ns, endtime.ns)
+        if fname is not None:
+            full_fname = os.path.join(self.path, fname)
+            try:
+                stream = read(full_fname, 'MSEED')
+                os.utime(full_fname, None)
+            except Exception:
+                # file was removed or is corrupt
+                with self._lock:
+                    if fname in self._files:
+                        self._remove(fname)
+            else:
+                with self._lock:
+                    self.hits += 1
+                return stream.slice(starttime, endtime)
+        with self._lock:
+            self.misses += 1
+
+    def put(self, network, station, location, channel, starttime, endtime,
+            stream):
+        """Store data for request in cache"""
+        if stream is None or len(stream) == 0:
+            return
+        chan_dir = _channel_dir(network, station, location, channel)
+        fname = os.path.join(chan_dir, '%d_%d.mseed' % (starttime.ns,
+                                                        endtime.ns))
+        full_fname = os.path.join(self.path, fname)
+        tmp_fname = '%s.%d.tmp' % (full_fname, threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(full_fname), exist_ok=True)
+            stream.write(tmp_fname, 'MSEED')
+            os.replace(tmp_fname, full_fname)
+        except Exception:
+            # e.g. data type not supported by MiniSEED
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+            return
+        size = os.path.getsize(full_fname)
+        with self._lock:
+            self._add(fname, size)
+            while (self.max_size is not None and self.size > self.max_size
+                   and len(self._files) > 1):
+                self._remove(next(iter(self._files)))
+
+    def __call__(self, network, station, location, channel, starttime,
+                 endtime, **kwargs):
+        args = (network, station, location, channel, starttime, endtime)
+        stream = self.get(*args)
+        if stream is None:
+            stream = self.get_waveforms(
+                network=network, station=station, location=location,
+                channel=channel, starttime=starttime, endtime=endtime,
+                **kwargs)
+            self.put(*args, stream=stream)
+        return stream
+
+    def _bulk(self, bulk):
+        stream = Stream()
+        missing = []
+        for args in bulk:
+            st = self.get(*args)
+            if st is None:
+                missing.append(args)
+            else:
+                stream += st
+        if len(missing) > 0:
+            st = self.get_waveforms.bulk(missing)
+            if st is not None:
+                for net, sta, loc, cha, t1, t2 in missing:
+                    st2 = st.select(network=net, station=sta, location=loc,
+                                    channel=cha).slice(t1, t2)
+                    self.put(net, sta, loc, cha, t1, t2, st2)
+                stream += st
+        return stream
+
+
+class BlockCache(object):
+
+    """
+    In-memory cache of data blocks aligned to multiples of block_length.
+
+    The cache wraps a get_waveforms function (see
+    `~rf.util.iter_event_data()`). Instead of the requested time window the
+    surrounding blocks (e.g. days) of a channel are retrieved and kept in a
+    small LRU cache. Later requests inside these blocks are sliced from
+    memory. The cache is used by `~rf.util.iter_event_data()` for
+    ``order='station'`` and local archives, for which consecutive requests
+    of the same station usually fall into the same block. If get_waveforms
+    supports bulk requests via the ``bulk`` attribute, the cache supports
+    them, too. Missing blocks are then retrieved with one bulk request.
+
+    :param get_waveforms: function returning the data
+    :param block_length: length of blocks in seconds (default: one day)
+    :param max_blocks: maximal number of blocks held in memory
+
+    The attributes ``hits`` and ``misses`` count the requests of blocks.
+    """
+
+    def __init__(self, get_waveforms, block_length=86400, max_blocks=4):
+        self.get_waveforms = get_waveforms
+        self.block_length = block_length
+        self.max_blocks = max_blocks
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        if hasattr(get_waveforms, 'bulk'):
+            self.bulk = self._bulk
+
+    def __repr__(self):
+        return '%s(block_length=%s) blocks:%d hits:%d misses:%d' % (
+            self.__class__.__name__, self.block_length, len(self._blocks),
+            self.hits, self.misses)
+
+    def _blocks_of(self, starttime, endtime):
+        """Return indices of blocks covering the time window"""
+        length = int(self.block_length * 1e9)
+        return range(starttime.ns // length, endtime.ns // length + 1)
+
+    def _block_window(self, k):
+        length = int(self.block_length * 1e9)
+        return (UTCDateTime(ns=k * length),
+                UTCDateTime(ns=(k + 1) * length - 1))
+
+    def _lookup(self, key):
+        with self._lock:
+            if key in self._blocks:
+                self.hits += 1
+                self._blocks.move_to_end(key)
+                return self._blocks[key]
+            self.misses += 1
+
+    def _store(self, key, stream):
+        if stream is None:
+            stream = Stream()
+        with self._lock:
+            self._blocks[key] = stream
+            while len(self._blocks) > self.max_blocks:
+                self._blocks.popitem(last=False)
+        return stream
+
+    def _get_block(self, seedid, k):
+        key = (seedid, k)
+        stream = self._lookup(key)
+        if stream is None:
+            net, sta, loc, cha = seedid
+            t1, t2 = self._block_window(k)
+            stream = self.get_waveforms(
+                network=net, station=sta, location=loc, channel=cha,
+                starttime=t1, endtime=t2)
+            stream = self._store(key, stream)
+        return stream
+
+    def __call__(self, network, station, location, channel, starttime,
+                 endtime, **kwargs):
+        seedid = (network, station, location, channel)
+        stream = Stream()
+        for k in self._blocks_of(starttime, endtime):
+            stream += self._get_block(seedid, k)
+        # data is copied, because it might be changed in place afterwards
+        return stream.slice(starttime, endtime).copy()
+
+    def _bulk(self, bulk):
+        # blocks of this request, they might be evicted from the LRU cache
+        # before the request is answered
+        blocks = OrderedDict()
+        for net, sta, loc, cha, t1, t2 in bulk:
+            for k in self._blocks_of(t1, t2):
+                key = ((net, sta, loc, cha), k)
+                if key not in blocks:
+                    blocks[key] = self._lookup(key)
+        missing = [key for key, st in blocks.items() if st is None]
+        if len(missing) > 0:
+            # retrieve all missing blocks with one bulk request
+            stream = self.get_waveforms.bulk(
+                [seedid + self._block_window(k) for seedid, k in missing])
+            for key in missing:
+                (net, sta, loc, cha), k = key
+                st = None
+                if stream is not None:
+                    st = stream.select(
+                        network=net, station=sta, location=loc,
+                        channel=cha).slice(*self._block_window(k))
+                blocks[key] = self._store(key, st)
+        stream = Stream()
+        for net, sta, loc, cha, t1, t2 in bulk:
+            st = Stream()
+            for k in self._blocks_of(t1, t2):
+                st += blocks[((net, sta, loc, cha), k)]
+            stream += st.slice(t1, t2).copy()
+        return stream
+
+
+def _is_nodata_exception(ex):
+    """Check if exception signals missing data, e.g. FDSNNoDataException"""
+    return 'nodata' in type(ex).__name__.lower()
+
+
+class NoDataCache(object):
+
+    """
+    Negative cache and circuit breaker for data requests.
+
+    The cache wraps a get_waveforms function (see
+    `~rf.util.iter_event_data()`). Requests which returned no data (an
+    empty stream, None or an exception like
+    `~obspy.clients.fdsn.header.FDSNNoDataException`) are remembered
+    with their seed id and time window. Later requests for the same or a
+    contained time window are skipped without calling get_waveforms.
+    Additionally, all requests for a station are skipped after
+    ``max_failures`` consecutive failed requests of this station (circuit
+    breaker). Failed requests are requests returning no data or raising
+    any exception. Skipped requests return None.
+
+    :param get_waveforms: function returning the data
+    :param fname: filename of SQLite database for remembering requests
+        without data between runs (default: None, requests are only
+        remembered in memory)
+    :param max_failures: number of consecutive failed requests after which
+        a station is skipped (default: None, no circuit breaker)
+
+    The attributes ``skipped_nodata`` and ``skipped_breaker`` count the
+    skipped requests per station. If get_waveforms supports bulk requests
+    via the ``bulk`` attribute, the cache supports them, too.
+    """
+
+    _CREATE = (
+        'CREATE TABLE IF NOT EXISTS nodata ('
+        'seedid TEXT, starttime INTEGER, endtime INTEGER, '
+        'PRIMARY KEY (seedid, starttime, endtime))')
+
+    def __init__(self, get_waveforms, fname=None, max_failures=None):
+        self.get_waveforms = get_waveforms
+        self.fname = fname
+        self.max_failures = max_failures
+        self.skipped_nodata = Counter()
+        self.skipped_breaker = Counter()
+        self._failures = Counter()
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(fname or ':memory:', isolation_level=None,
+                                    check_same_thread=False)
+        self._con.execute('PRAGMA synchronous=OFF')
+        self._con.execute(self._CREATE)
+        if hasattr(get_waveforms, 'bulk'):
+            self.bulk = self._bulk
+
+    def __repr__(self):
+        return '%s(%r) skipped:%d' % (
+            self.__class__.__name__, self.fname,
+            sum(self.skipped_nodata.values()) +
+            sum(self.skipped_breaker.values()))
+
+    def __len__(self):
+        with self._lock:
+            cursor = self._con.execute('SELECT COUNT(*) FROM nodata')
+            return cursor.fetchone()[0]
+
+    def broken(self):
+        """Return list of stations skipped by the circuit breaker"""
+        if self.max_failures is None:
+            return []
+        with self._lock:
+            return sorted(sta for sta, n in self._failures.items()
+                          if n >= self.max_failures)
+
+    def _skip(self, seedid, starttime, endtime):
+        """Check if request is skipped and count skipped request"""
+        station = seedid.rsplit('.', 2)[0]
+        with self._lock:
+            if (self.max_failures is not None and
+                    self._failures[station] >= self.max_failures):
+                self.skipped_breaker[station] += 1
+                return True
+            row = self._con.execute(
+                'SELECT 1 FROM nodata WHERE seedid=? AND starttime<=? AND '
+                'endtime>=? LIMIT 1',
+                (seedid, starttime.ns, endtime.ns)).fetchone()
+            if row is not None:
+                self.skipped_nodata[station] += 1
+                return True
+        return False
+
+    def _record(self, seedid, starttime, endtime, failed, nodata):
+        station = seedid.rsplit('.', 2)[0]
+        with self._lock:
+            if failed:
+                self._failures[station] += 1
+            else:
+                self._failures[station] = 0
+            if nodata:
+                self._con.execute(
+                    'INSERT OR IGNORE INTO nodata VALUES (?, ?, ?)',
+                    (seedid, starttime.ns, endtime.ns))
+
+    def __call__(self, network, station, location, channel, starttime,
+                 endtime, **kwargs):
+        seedid = '.'.join((network, station, location, channel))
+        if self._skip(seedid, starttime, endtime):
+            return
+        try:
+            stream = self.get_waveforms(
+                network=network, station=station, location=location,
+                channel=channel, starttime=starttime, endtime=endtime,
+                **kwargs)
+        except Exception as ex:
+            self._record(seedid, starttime, endtime, True,
+                         _is_nodata_exception(ex))
+            raise
+        nodata = stream is None or len(stream) == 0
+        self._record(seedid, starttime, endtime, nodata, nodata)
+        return stream
+
+    def _bulk(self, bulk):
+        bulk = [args for args in bulk
+                if not self._skip('.'.join(args[:4]), args[4], args[5])]
+        if len(bulk) == 0:
+            return
+        try:
+            stream = self.get_waveforms.bulk(bulk)
+        except Exception as ex:
+            nodata = _is_nodata_exception(ex)
+            for args in bulk:
+                self._record('.'.join(args[:4]), args[4], args[5], True,
+                             nodata)
+            raise
+        for net, sta, loc, cha, t1, t2 in bulk:
+            nodata = stream is None or len(stream.select(
+                network=net, station=sta, location=loc, channel=cha)) == 0
+            self._record('.'.join((net, sta, loc, cha)), t1, t2, nodata,
+                         nodata)
+        return stream
+
+    def summary(self):
+        """Return summary of skipped requests"""
+        nodata = sum(self.skipped_nodata.values())
+        breaker = sum(self.skipped_breaker.values())
+        msg = ('%d requests skipped: %d known without data, %d by circuit '
+               'breaker' % (nodata + breaker, nodata, breaker))
+        stations = self.broken()
+        if len(stations) > 0:
+            msg += '\ncircuit breaker open for %d stations: %s' % (
+                len(stations), ', '.join(
+                    '%s (%d skipped)' % (sta, self.skipped_breaker[sta])
+                    for sta in stations))
+        return msg
+
+    def close(self):
+        """Close database connection."""
+        self._con.close()
+
+
+class RetrievalStats(object):
+
+    """
+    Statistics of waveform requests aggregated per station and per run.
+
+    For each request the latency, the number of bytes and traces of the
+    returned data and the class of a raised exception are recorded with
+    `record()`. `~rf.batch.init_data()` records all requests of the
+    returned get_waveforms function in its ``stats`` attribute.
+    The number of bytes is the size of the data arrays in memory.
+    Recording is thread-safe.
+
+    The attribute ``run`` is a dictionary with the totals of the run,
+    the attribute ``stations`` holds the same values for each station
+    (``NET.STA``). `summary()` returns all values as a dictionary,
+    `write()` writes them to a JSON file.
+    """
+
+    def __init__(self):
+        self.run = self._new()
+        self.stations = {}
+        self.starttime = None
+        self.endtime = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _new():
+        return {'requests': 0, 'empty': 0, 'traces': 0, 'bytes': 0,
+                'latency': 0., 'max_latency': 0., 'errors': Counter()}
+
+    def __repr__(self):
+        return '%s() requests:%d bytes:%d errors:%d' % (
+            self.__class__.__name__, self.run['requests'], self.run['bytes'],
+            sum(self.run['errors'].values()))
+
+    def record(self, seedid, latency, stream=None, error=None,
+               starttime=None):
+        """
+        Record one request.
+
+        :param seedid: seed id of the request, only network and station
+            are used for the aggregation
+        :param latency: duration of the request in seconds
+        :param stream: returned stream or None
+        :param error: raised exception or None
+        :param starttime: start of the request as given by `time.time()`,
+            used for the duration of the run
+        """
+        station = '.'.join(seedid.split('.')[:2])
+        if not isinstance(stream, Stream):
+            stream = Stream()
+        ntraces = len(stream)
+        nbytes = sum(tr.data.nbytes for tr in stream)
+        with self._lock:
+            if starttime is not None:
+                if self.starttime is None or starttime < self.starttime:
+                    self.starttime = starttime
+                endtime = starttime + latency
+                if self.endtime is None or endtime > self.endtime:
+                    self.endtime = endtime
+            for values in (self.run, self.stations.setdefault(station,
+                                                              self._new())):
+                values['requests'] += 1
+                values['traces'] += ntraces
+                values['bytes'] += nbytes
+                values['latency'] += latency
+                values['max_latency'] = max(values['max_latency'], latency)
+                if error is not None:
+                    values['errors'][error.__class__.__name__] += 1
+                elif ntraces == 0:
+                    values['empty'] += 1
+
+    @staticmethod
+    def _summary(values):
+        values = dict(values, errors=dict(values['errors']))
+        n = values['requests']
+        values['mean_latency'] = values['latency'] / n if n else None
+        return values
+
+    def summary(self):
+        """
+        Return dictionary with statistics of the run and of all stations.
+
+        The run statistics also contain the duration between the start of
+        the first and the end of the last request and the resulting
+        throughput in bytes per second.
+        """
+        with self._lock:
+            run = self._summary(self.run)
+            duration = None
+            if self.starttime is not None:
+                duration = self.endtime - self.starttime
+            run['duration'] = duration
+            run['throughput'] = (run['bytes'] / duration
+                                 if duration else None)
+            stations = {sta: self._summary(values)
+                        for sta, values in sorted(self.stations.items())}
+        return {'run': run, 'stations': stations}
+
+    def write(self, fname):
+        """Write summary to JSON file."""
+        with open(fname, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+
+def _iter_mseed_spans(fname):
+    """
+    Return iterator yielding continuous runs of MiniSEED records
+
+    Yields tuples (network, station, location, channel, starttime, endtime,
+    offset, nbytes) with times in nanoseconds. Records are read one by
+    one, this is the fallback for files not handled by
+    `_read_mseed_spans()`.
+    """
+    span = None
+    offset = 0
+    with open(fname, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        while offset < size:
+            info = get_record_information(f, offset)
+            seedid = (info['network'], info['station'], info['location'],
+                      info['channel'])
+            start = info['starttime'].ns
+            end = info['endtime'].ns
+            nbytes = info['record_length']
+            delta = 1.5e9 / info['samp_rate'] if info['samp_rate'] else 0
+            if (span is not None and tuple(span[:4]) == seedid and
+                    span[6] + span[7] == offset and
+                    span[5] <= start <= span[5] + delta):
+                span[5] = max(span[5], end)
+                span[7] += nbytes
+            else:
+                if span is not None:
+                    yield tuple(span)
+                span = list(seedid) + [start, end, offset, nbytes]
+            offset += nbytes
+    if span is not None:
+        yield tuple(span)
+
+
+def _mseed_header_dtype(byteorder):
+    """Return dtype of the fixed header of MiniSEED records"""
+    bo = byteorder
+    return np.dtype([
+        ('sequence', 'S6'), ('quality', 'S1'), ('reserved', 'S1'),
+        ('station', 'S5'), ('location', 'S2'), ('channel', 'S3'),
+        ('network', 'S2'), ('year', bo + 'u2'), ('julday', bo + 'u2'),
+        ('hour', 'u1'), ('minute', 'u1'), ('second', 'u1'),
+        ('unused', 'u1'), ('fract', bo + 'u2'), ('npts', bo + 'u2'),
+        ('samp_rate_factor', bo + 'i2'), ('samp_rate_mult', bo + 'i2'),
+        ('activity_flags', 'u1'), ('io_flags', 'u1'),
+        ('quality_flags', 'u1'), ('nblockettes', 'u1'),
+        ('time_correction', bo + 'i4'), ('data_offset', bo + 'u2'),
+        ('blockette_offset', bo + 'u2')])
+
+
+def _read_mseed_spans(fname):
+    """
+    Return list of continuous runs of MiniSEED records
+
+    All headers of the file are parsed at once with NumPy. Same output as
+    `_iter_mseed_spans()`. None is returned for files which cannot be
+    handled this way, e.g. files with variable record length, without
+    blockette 1000 or with blockette 500.
+    """
+    with open(fname, 'rb') as f:
+        info = get_record_information(f)
+    reclen = info['record_length']
+    size = os.path.getsize(fname)
+    if size == 0 or size % reclen != 0:
+        return
+    bo = info['byteorder']
+    raw = np.memmap(fname, dtype=np.uint8, mode='r',
+                    shape=(size // reclen, reclen))
+    n = len(raw)
+    hdr = np.ascontiguousarray(raw[:, :48]).view(_mseed_header_dtype(bo))
+    hdr = hdr[:, 0]
+    if (not np.all(np.isin(hdr['quality'], [b'D', b'R', b'Q', b'M'])) or
+            not np.all((hdr['julday'] >= 1) & (hdr['julday'] <= 366))):
+        return
+    # traverse blockettes of all records in parallel
+    rows = np.arange(n)
+    offset = hdr['blockette_offset'].astype(np.int64)
+    exponent = np.zeros(n, dtype=np.int64)
+    musec = np.zeros(n, dtype=np.int64)
+    samp_rate = np.zeros(n)
+    for _ in range(16):
+        active = offset > 0
+        if not np.any(active):
+            break
+        if np.any(offset[active] + 8 > reclen):
+            return
+        index = rows[active, np.newaxis]
+        blkt = raw[index, offset[active, np.newaxis] + np.arange(8)]
+        btype = blkt[:, :2].copy().view(bo + 'u2')[:, 0]
+        bnext = blkt[:, 2:4].copy().view(bo + 'u2')[:, 0].astype(np.int64)
+        if np.any(btype == 500) or np.any((bnext != 0) &
+                                          (bnext <= offset[active])):
+            return
+        index = index[:, 0]
+        mask = btype == 1000
+        exponent[index[mask]] = blkt[mask, 6]
+        mask = btype == 1001
+        musec[index[mask]] = blkt[mask, 5].view(np.int8)
+        mask = btype == 100
+        samp_rate[index[mask]] = blkt[mask, 4:8].copy().view(bo + 'f4')[:, 0]
+        offset[active] = bnext
+    else:
+        return
+    if np.any(2 ** exponent != reclen):
+        return
+    # sample rate according to the SEED manual if not set by blockette 100
+    fact = hdr['samp_rate_factor'].astype(float)
+    mult = hdr['samp_rate_mult'].astype(float)
+    with np.errstate(divide='ignore'):
+        sr = np.select(
+            [(fact > 0) & (mult > 0), (fact > 0) & (mult < 0),
+             (fact < 0) & (mult > 0), (fact < 0) & (mult < 0)],
+            [fact * mult, -fact / mult, -mult / fact, 1 / (fact * mult)], 0)
+    samp_rate = np.where(samp_rate != 0, samp_rate, sr)
+    # start and end times in nanoseconds
+    years = (hdr['year'].astype(np.int64) - 1970).astype('datetime64[Y]')
+    days = (years.astype('datetime64[D]').astype(np.int64) +
+            hdr['julday'] - 1)
+    seconds = ((days * 24 + hdr['hour']) * 60 + hdr['minute']) * 60
+    start = ((seconds + hdr['second']) * 10 ** 9 +
+             hdr['fract'].astype(np.int64) * 10 ** 5 + musec * 1000)
+    corr = (hdr['activity_flags'] & 2) == 0
+    start[corr] += hdr['time_correction'][corr].astype(np.int64) * 10 ** 5
+    with np.errstate(divide='ignore', invalid='ignore'):
+        length = np.where(samp_rate > 0,
+                          (hdr['npts'] - 1) / samp_rate * 1e9, 0)
+        delta = np.where(samp_rate > 0, 1.5e9 / samp_rate, 0)
+    end = start + np.round(length).astype(np.int64)
+    # combine consecutive records of the same channel without gaps
+    ids = None
+    for key in ('network', 'station', 'location', 'channel'):
+        codes = np.char.strip(np.char.decode(hdr[key], 'latin-1'))
+        ids = codes if ids is None else np.char.add(np.char.add(ids, '.'),
+                                                    codes)
+    cont = ((ids[1:] == ids[:-1]) & (end[:-1] <= start[1:]) &
+            (start[1:] <= end[:-1] + delta[1:]))
+    first = np.flatnonzero(np.r_[True, ~cont])
+    last = np.r_[first[1:], n] - 1
+    spans = []
+    for i, j in zip(first, last):
+        spans.append(tuple(ids[i].split('.')) +
+                     (int(start[i]), int(end[j]), int(i * reclen),
+                      int((j - i + 1) * reclen)))
+    return spans
+
+
+def _iter_spans(fname):
+    """Return spans of MiniSEED records or of traces for other formats"""
+    if _is_mseed(fname):
+        spans = _read_mseed_spans(fname)
+        if spans is None:
+            spans = list(_iter_mseed_spans(fname))
+        return spans
+    else:
+        # other file format, the whole file is read for requests
+        stream = read(fname, headonly=True)
+        return [(tr.stats.network, tr.stats.station, tr.stats.location,
+                 tr.stats.channel, tr.stats.starttime.ns,
+                 tr.stats.endtime.ns, 0, -1) for tr in stream]
+
+
+class WaveformArchive(object):
+
+    """
+    Local archive of waveform files with an index of the data.
+
+    The index maps seed ids and time spans to files and byte offsets of
+    continuous runs of MiniSEED records. It is stored in a SQLite database
+    and only updated for new or changed files. Requests only read the
+    needed records from disk. Files in other formats are read as a
+    whole, if they contain requested data. Instances of this class can be
+    used as get_waveforms function (see `~rf.util.iter_event_data()`).
+
+    :param data: glob expression of waveform files or list of such
+        expressions
+    :param index: filename of SQLite database holding the index
+        (default: None, the index is held in memory)
+    :param update: index new and changed files, remove entries of removed
+        files (default: True)
+
+    Example usage::
+
+        get_waveforms = WaveformArchive('archive/*/*.mseed',
+                                        index='archive_index.sqlite')
+        stream = get_waveforms(network='CX', station='PB01', location='',
+                               channel='BH?', starttime=t1, endtime=t2)
+    """
+
+    #: data is read from local files, see `~rf.util.iter_event_data()`
+    local = True
+
+    _CREATE = (
+        'CREATE TABLE IF NOT EXISTS files ('
+        'id INTEGER PRIMARY KEY, fname TEXT UNIQUE, mtime REAL, '
+        'size INTEGER)',
+        'CREATE TABLE IF NOT EXISTS spans ('
+        'file_id INTEGER, network TEXT, station TEXT, location TEXT, '
+        'channel TEXT, starttime INTEGER, endtime INTEGER, '
+        'offset INTEGER, nbytes INTEGER)',
+        'CREATE INDEX IF NOT EXISTS spans_station ON spans '
+        '(station, starttime)')
+
+    def __init__(self, data, index=None, update=True):
+        self.data = data
+        self.index = index
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(index or ':memory:',
+                                    check_same_thread=False)
+        for sql in self._CREATE:
+            self._con.execute(sql)
+        self._con.commit()
+        if update:
+            self.update_index()
+
+    def __repr__(self):
+        return '%s(%r, index=%r) files:%d' % (
+            self.__class__.__name__, self.data, self.index, len(self))
+
+    def __len__(self):
+        with self._lock:
+            cursor = self._con.execute('SELECT COUNT(*) FROM files')
+            return cursor.fetchone()[0]
+
+    def update_index(self):
+        """
+        Index new and changed files, remove entries of removed files.
+
+        :return: number of indexed files
+        """
+        data = [self.data] if isinstance(self.data, str) else self.data
+        fnames = sorted(set(os.path.abspath(fname) for expr in data
+                            for fname in glob.glob(expr)))
+        with self._lock:
+            indexed = {fname: (id_, mtime, size) for id_, fname, mtime, size
+                       in self._con.execute('SELECT * FROM files')}
+        num = 0
+        for fname in fnames:
+            stat = os.stat(fname)
+            id_, mtime, size = indexed.pop(fname, (None, None, None))
+            if (mtime, size) == (stat.st_mtime, stat.st_size):
+                continue
+            try:
+                spans = _iter_spans(fname)
+            except Exception:  # not a waveform file
+                spans = []
+            with self._lock, self._con:
+                if id_ is not None:
+                    self._remove(id_)
+                cursor = self._con.execute(
+                    'INSERT INTO files (fname, mtime, size) VALUES (?, ?, ?)',
+                    (fname, stat.st_mtime, stat.st_size))
+                self._con.executemany(
+                    'INSERT INTO spans VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(cursor.lastrowid,) + span for span in spans])
+            num += 1
+        with self._lock, self._con:
+            for id_, _, _ in indexed.values():
+                self._remove(id_)
+        return num
+
+    def _remove(self, id_):
+        self._con.execute('DELETE FROM spans WHERE file_id=?', (id_,))
+        self._con.execute('DELETE FROM files WHERE id=?', (id_,))
+
+    def _query(self, network, station, location, channel, starttime,
+               endtime):
+        """Return list of (fname, offset, nbytes) with requested data"""
+        with self._lock:
+            rows = self._con.execute(
+                'SELECT fname, offset, nbytes FROM spans '
+                'JOIN files ON files.id = spans.file_id '
+                'WHERE station GLOB ? AND network GLOB ? AND '
+                'location GLOB ? AND channel GLOB ? AND '
+                'starttime <= ? AND endtime >= ? ORDER BY fname, offset',
+                (station, network, location, channel, endtime.ns,
+                 starttime.ns)).fetchall()
+        # join adjacent byte ranges
+        reads = []
+        for fname, offset, nbytes in rows:
+            if len(reads) > 0 and reads[-1][0] == fname:
+                last = reads[-1]
+                if nbytes < 0 and last[2] < 0:
+                    continue  # whole file is read anyway
+                if nbytes >= 0 and last[2] >= 0 and sum(last[1:]) == offset:
+                    last[2] += nbytes
+                    continue
+            reads.append([fname, offset, nbytes])
+        return reads
+
+    def __call__(self, network, station, location, channel, starttime,
+                 endtime, **kwargs):
+        if ',' in channel:
+            # comma separated list of channels like for FDSN web services
+            stream = Stream()
+            for cha in channel.split(','):
+                stream += self(network, station, location, cha, starttime,
+                               endtime)
+            return stream
+        stream = Stream()
+        for fname, offset, nbytes in self._query(
+                network, station, location, channel, starttime, endtime):
+            if nbytes < 0:
+                stream += read(fname)
+                continue
+            with open(fname, 'rb') as f:
+                f.seek(offset)
+                buffer = io.BytesIO(f.read(nbytes))
+            stream += read(buffer, 'MSEED', starttime=starttime,
+                           endtime=endtime)
+        stream = stream.select(network=network, station=station,
+                               location=location, channel=channel)
+        return stream.trim(starttime, endtime)
+
+    def close(self):
+        """Close database connection."""
+        self._con.close()
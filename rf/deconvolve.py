@@ -2,12 +2,50 @@
 """
 Frequency and time domain deconvolution.
 """
+from collections import OrderedDict
 from copy import copy
+import threading
+
 import numpy as np
 from numpy import max, pi
-from scipy.fftpack import fft, ifft, next_fast_len
+from numpy.fft import irfft, rfft
+from scipy.fftpack import next_fast_len
 from scipy.signal import correlate, detrend
-from rf.util import _add_processing_info
+from rf.util import _add_processing_info, _processing_info
+
+
+#: Maximal number of spectral filters kept in the cache
+FILTER_CACHE_SIZE = 32
+_FILTER_CACHE = OrderedDict()
+_FILTER_CACHE_LOCK = threading.Lock()
+
+
+def _cached_filter(func):
+    """
+    Decorator caching filters returned by func in a LRU cache.
+
+    The cache is keyed by the function name and the arguments, i.e. number of
+    points, sample spacing and filter parameter. The cache holds up to
+    `FILTER_CACHE_SIZE` filters. The returned arrays are read-only.
+    """
+    def wrapper(*args, **kwargs):
+        key = (func.__name__,) + args + tuple(sorted(kwargs.items()))
+        with _FILTER_CACHE_LOCK:
+            try:
+                _FILTER_CACHE.move_to_end(key)
+                return _FILTER_CACHE[key]
+            except KeyError:
+                pass
+        filt = func(*args, **kwargs)
+        filt.flags.writeable = False
+        with _FILTER_CACHE_LOCK:
+            _FILTER_CACHE[key] = filt
+            while len(_FILTER_CACHE) > FILTER_CACHE_SIZE:
+                _FILTER_CACHE.popitem(last=False)
+        return filt
+    wrapper.__doc__ = func.__doc__
+    wrapper.__name__ = func.__name__
+    return wrapper
 
 
 def __find_nearest(array, value):
@@ -76,6 +114,57 @@ def deconvolve(stream, method='time', func=None,
         method = 'waterlevel'
     if method not in ('time', 'waterlevel', 'iterative', 'multitaper', 'func'):
         raise NotImplementedError()
+    src, rsp, tshift = _prepare_deconvolve(
+        stream, method, source_components, response_components, winsrc,
+        kwargs)
+    sr = src.stats.sampling_rate
+    if method == 'time':
+        shift = int(round(tshift * sr - len(src) // 2))
+        rsp_data = [tr.data for tr in rsp]
+        rf_data = deconv_time(rsp_data, src.data, shift,  **kwargs)
+        for i, tr in enumerate(rsp):
+            tr.data = rf_data[i].real
+    elif method == 'waterlevel':
+        rsp_data = [tr.data for tr in rsp]
+        rf_data = deconv_waterlevel(rsp_data, src.data, sr, tshift=tshift,
+                                    **kwargs)
+        for i, tr in enumerate(rsp):
+            tr.data = rf_data[i].real
+    elif method == 'iterative':
+        rsp_data = [tr.data for tr in rsp]
+        rf_data, nit = deconv_iterative(rsp_data, src.data, sr, tshift=tshift,
+                                        **kwargs)
+        for i, tr in enumerate(rsp):
+            tr.data = rf_data[i].real
+            tr.stats['iterations'] = nit[i]
+    elif method == 'multitaper':
+        noise = kwargs.pop('noise',None)
+        if noise is None:  # no kwarg, grab from pre-event time series
+            onset_rsp = rsp[0].stats.onset - rsp[0].stats.starttime
+            noise = stream.copy().trim2(-onset_rsp,-5,'onset') # NOTE window length will vary
+        # noise is not None (kwarg provided), noise should be Stream() or RFStream()
+        # so now we grab that data and make a list of arrays
+        nse_data = [tr.data for tr in noise if response_components is None or
+                    tr.stats.channel[-1] in response_components]
+        rsp_data = [tr.data for tr in rsp]
+        rf_data = deconv_multitaper(rsp_data, src.data, nse_data, sr, -tshift,
+                                    **kwargs)
+        for i, tr in enumerate(rsp):
+            tr.data = rf_data[i].real
+    else:
+        rsp = func(stream.__class__(rsp), src, tshift=tshift, **kwargs)
+    return stream.__class__(rsp)
+
+
+def _prepare_deconvolve(stream, method, source_components,
+                        response_components, winsrc, kwargs):
+    """
+    Identify, trim and taper source and identify responses.
+
+    Sets the normalize parameter in kwargs if not present.
+
+    :return: source trace, list of response traces, tshift
+    """
     # identify source and response components
     src = [tr for tr in stream if tr.stats.channel[-1] in source_components]
     if len(src) != 1:
@@ -90,7 +179,6 @@ def deconvolve(stream, method='time', func=None,
         msg = 'Invalid number of response components. %d not between 0 and 4.'
         raise ValueError(msg % len(rsp))
 
-    sr = src.stats.sampling_rate
     # shift onset to time of nearest data sample to circumvent complications
     # for data with low sampling rate and method='time'
     idx = __find_nearest(src.times(), src.stats.onset - src.stats.starttime)
@@ -123,42 +211,97 @@ def deconvolve(stream, method='time', func=None,
     src.trim(onset + winsrc[0], onset + winsrc[1], pad=True, fill_value=0.)
     src.taper(max_percentage=None, max_length=winsrc[2])
     tshift = -winsrc[0]
-    if method == 'time':
-        shift = int(round(tshift * sr - len(src) // 2))
-        rsp_data = [tr.data for tr in rsp]
-        rf_data = deconv_time(rsp_data, src.data, shift,  **kwargs)
-        for i, tr in enumerate(rsp):
-            tr.data = rf_data[i].real
-    elif method == 'waterlevel':
-        rsp_data = [tr.data for tr in rsp]
-        rf_data = deconv_waterlevel(rsp_data, src.data, sr, tshift=tshift,
-                                    **kwargs)
-        for i, tr in enumerate(rsp):
-            tr.data = rf_data[i].real
-    elif method == 'iterative':
-        rsp_data = [tr.data for tr in rsp]
-        rf_data, nit = deconv_iterative(rsp_data, src.data, sr, tshift=tshift,
-                                        **kwargs)
-        for i, tr in enumerate(rsp):
-            tr.data = rf_data[i].real
-            tr.stats['iterations'] = nit[i]
-    elif method == 'multitaper':
-        noise = kwargs.pop('noise',None)
-        if noise is None:  # no kwarg, grab from pre-event time series
-            onset_rsp = rsp[0].stats.onset - rsp[0].stats.starttime
-            noise = stream.copy().trim2(-onset_rsp,-5,'onset') # NOTE window length will vary
-        # noise is not None (kwarg provided), noise should be Stream() or RFStream()
-        # so now we grab that data and make a list of arrays
-        nse_data = [tr.data for tr in noise if response_components is None or
-                    tr.stats.channel[-1] in response_components]
-        rsp_data = [tr.data for tr in rsp]
-        rf_data = deconv_multitaper(rsp_data, src.data, nse_data, sr, -tshift,
-                                    **kwargs)
-        for i, tr in enumerate(rsp):
-            tr.data = rf_data[i].real
-    else:
-        rsp = func(stream.__class__(rsp), src, tshift=tshift, **kwargs)
-    return stream.__class__(rsp)
+    return src, rsp, tshift
+
+
+def deconvolve_batch(streams, method='time', source_components='LZ',
+                     response_components=None, winsrc='P', batch_size=1000,
+                     **kwargs):
+    """
+    Deconvolve one component of several streams from other components.
+
+    The result is the same as calling `deconvolve()` for each stream.
+    For water level and iterative deconvolution the data of all streams
+    with the same number and lengths of traces, sampling rate and source
+    window is stacked into arrays and deconvolved with one call of
+    `deconv_waterlevel()` or `deconv_iterative_batch()`. Other methods
+    deconvolve one stream after the other.
+
+    :param streams: list of streams, each including responses and source
+    :param batch_size: maximal number of streams deconvolved at once,
+        limits the size of the stacked arrays,
+        None stacks all streams of a group
+    :return: list of streams with deconvolutions
+
+    See `deconvolve()` for the other parameters.
+    """
+    if method == 'freq':
+        method = 'waterlevel'
+    batch = (method == 'waterlevel' or
+             method == 'iterative' and kwargs.get('incremental', True))
+    if not batch or len(streams) == 0:
+        return [deconvolve(stream, method=method,
+                           source_components=source_components,
+                           response_components=response_components,
+                           winsrc=winsrc, **kwargs)
+                for stream in streams]
+    info = _processing_info(
+        deconvolve, streams[0], method=method,
+        source_components=source_components,
+        response_components=response_components, winsrc=winsrc, **kwargs)
+    rsps = []
+    groups = {}
+    for stream in streams:
+        kw = kwargs.copy()
+        src, rsp, tshift = _prepare_deconvolve(
+            stream, method, source_components, response_components, winsrc,
+            kw)
+        rsps.append(rsp)
+        key = (len(src), tuple(len(tr) for tr in rsp),
+               src.stats.sampling_rate, tshift, kw.get('normalize', 0))
+        groups.setdefault(key, []).append((src, rsp))
+    # split groups into chunks to limit memory usage
+    chunks = [(key, group[i:i + (batch_size or len(group))])
+              for key, group in groups.items()
+              for i in range(0, len(group), batch_size or len(group))]
+    for (_, _, sr, tshift, normalize), group in chunks:
+        if method == 'waterlevel':
+            kw = dict(kwargs, normalize=normalize)
+            src_data = np.array([src.data for src, _ in group])
+            # responses of a stream might have different lengths, the
+            # length of the results is given by the first response
+            # like in deconv_waterlevel
+            lens = [len(tr) for tr in group[0][1]]
+            kw.setdefault('length', lens[0])
+            rsp_data = np.zeros((len(group), len(lens), max(lens)))
+            for i, (_, rsp) in enumerate(group):
+                for j, tr in enumerate(rsp):
+                    rsp_data[i, j, :len(tr)] = tr.data
+            rf_data = deconv_waterlevel(rsp_data, src_data, sr,
+                                        tshift=tshift, **kw)
+        else:
+            kw = {k: v for k, v in kwargs.items()
+                  if k not in ('normalize', 'incremental')}
+            ncomp = len(group[0][1])
+            src_data = PreparedSource([src.data for src, _ in group], sr,
+                                      kw.pop('gauss', 0.5))
+            rsp_data = [tr.data for _, rsp in group for tr in rsp]
+            rf_data, nit = deconv_iterative_batch(
+                rsp_data, src_data, sr, tshift=tshift, gauss=src_data.gauss,
+                src_index=np.repeat(np.arange(len(group)), ncomp), **kw)
+            rf_data = rf_data.reshape((len(group), ncomp, -1))
+            nit = nit.reshape((len(group), ncomp))
+            if normalize is not None:
+                rf_data *= 1 / np.max(np.abs(rf_data[:, normalize, :]),
+                                      axis=1)[:, np.newaxis, np.newaxis]
+            for (_, rsp), trnit in zip(group, nit):
+                for tr, n in zip(rsp, trnit):
+                    tr.stats['iterations'] = n
+        for (_, rsp), data in zip(group, rf_data):
+            for tr, trdata in zip(rsp, data):
+                tr.data = trdata
+                tr._internal_add_processing_info(info)
+    return [stream.__class__(rsp) for stream, rsp in zip(streams, rsps)]
 
 
 def __get_length(rsp_list):
@@ -176,8 +319,10 @@ def deconv_waterlevel(rsp_list, src, sampling_rate, waterlevel=0.05, gauss=0.5,
     Deconvolve src from arrays in rsp_list.
 
     :param rsp_list: either a list of arrays containing the response functions
-        or a single array
-    :param src: array with source function
+        or a single array, for a batch an array with shape
+        (number of sources, number of responses, length of responses)
+    :param src: array with source function, for a batch an array with
+        one source function per row
     :param sampling_rate: sampling rate of the data
     :param waterlevel: waterlevel to stabilize the deconvolution
     :param gauss: Gauss parameter (standard deviation) of the
@@ -192,12 +337,19 @@ def deconv_waterlevel(rsp_list, src, sampling_rate, waterlevel=0.05, gauss=0.5,
         for the maximum of the prepared source. Set normalize to None for no
         normalization.
     :param return_info: return additionally a lot of different parameters in a
-        dict for debugging purposes
+        dict for debugging purposes (not available for batches)
 
-    :return: (list of) array(s) with deconvolution(s)
+    :return: (list of) array(s) with deconvolution(s),
+        for a batch an array with the shape of rsp_list
+
+    A batch of sources and responses is deconvolved with one multi-row FFT.
+    The normalization is applied to the responses of each source separately.
     """
+    batch = np.ndim(src) == 2
+    if batch and return_info:
+        raise ValueError('return_info is not available for batches')
     if length is None:
-        length = __get_length(rsp_list)
+        length = np.shape(rsp_list)[-1] if batch else __get_length(rsp_list)
     N = length
     if nfft is None:
         nfft = next_fast_len(N)
@@ -205,15 +357,30 @@ def deconv_waterlevel(rsp_list, src, sampling_rate, waterlevel=0.05, gauss=0.5,
     ffilt = _phase_shift_filter(nfft, dt, tshift)
     if gauss is not None:
         ffilt = _gauss_filter(dt, nfft, gauss, waterlevel=-700) * ffilt
-    spec_src = fft(src, nfft)
+    spec_src = rfft(src, nfft)
     spec_src_conj = np.conjugate(spec_src)
     spec_src_water = np.abs(spec_src * spec_src_conj)
     spec_src_water = np.maximum(
-        spec_src_water, max(spec_src_water) * waterlevel)
+        spec_src_water, max(spec_src_water, axis=-1, keepdims=True) *
+        waterlevel)
+
+    if batch:
+        spec_src_conj = spec_src_conj[:, np.newaxis, :]
+        spec_src_water = spec_src_water[:, np.newaxis, :]
+        rf = irfft(ffilt * rfft(rsp_list, nfft) * spec_src_conj /
+                   spec_src_water, nfft)[..., :N]
+        if normalize == 'src':
+            spec_src = ffilt * spec_src[:, np.newaxis, :] * spec_src_conj
+            rf_src = irfft(spec_src / spec_src_water, nfft)[..., :N]
+            rf *= 1 / max(rf_src, axis=-1, keepdims=True)
+        elif normalize is not None:
+            rf *= 1. / max(rf[:, normalize, :][:, np.newaxis, :], axis=-1,
+                           keepdims=True)
+        return rf
 
     if normalize == 'src':
         spec_src = ffilt * spec_src * spec_src_conj / spec_src_water
-        rf_src = ifft(spec_src, nfft)[:N]
+        rf_src = irfft(spec_src, nfft)[:N]
         norm = 1 / max(rf_src)
         rf_src = norm * rf_src
 
@@ -221,8 +388,8 @@ def deconv_waterlevel(rsp_list, src, sampling_rate, waterlevel=0.05, gauss=0.5,
     if not isinstance(rsp_list, (list, tuple)):
         flag = True
         rsp_list = [rsp_list]
-    rf_list = [ifft(ffilt * fft(rsp, nfft) * spec_src_conj / spec_src_water,
-                    nfft)[:N] for rsp in rsp_list]
+    rf_list = [irfft(ffilt * rfft(rsp, nfft) * spec_src_conj / spec_src_water,
+                     nfft)[:N] for rsp in rsp_list]
     if normalize not in (None, 'src'):
         norm = 1. / max(rf_list[normalize])
     if normalize is not None:
@@ -231,12 +398,12 @@ def deconv_waterlevel(rsp_list, src, sampling_rate, waterlevel=0.05, gauss=0.5,
     if return_info:
         if normalize not in (None, 'src'):
             spec_src = ffilt * spec_src * spec_src_conj / spec_src_water
-            rf_src = ifft(spec_src, nfft)[:N]
+            rf_src = irfft(spec_src, nfft)[:N]
             norm = 1 / max(rf_src)
             rf_src = norm * rf_src
         info = {'rf_src': rf_src, 'rf_src_conj': spec_src_conj,
                 'spec_src_water': spec_src_water,
-                'freq': np.fft.fftfreq(nfft, d=dt),
+                'freq': np.fft.rfftfreq(nfft, d=dt),
                 'gauss': ffilt, 'norm': norm, 'N': N, 'nfft': nfft}
         return rf_list, info
     elif flag:
@@ -382,12 +549,16 @@ def deconv_time(rsp_list, src, shift, spiking=1., length=None, normalize=0,
         return RF_list
 
 
+@_cached_filter
 def _gauss_filter(dt, nft, f0, waterlevel=None):
     """
     Gaussian filter with width f0
 
+    The filter is defined for the non-negative frequencies of a real-input
+    FFT (see `numpy.fft.rfft`).
+
     :param dt: sample spacing in seconds
-    :param nft: length of filter in points
+    :param nft: number of points for fft
     :param f0: Standard deviation of the Gaussian Low-pass filter,
         corresponds to cut-off frequency in Hz for a response value of
         exp(0.5)=0.607.
@@ -395,27 +566,24 @@ def _gauss_filter(dt, nft, f0, waterlevel=None):
         (default: no waterlevel)
     :return: array with Gaussian filter frequency response
     """
-    f = np.fft.fftfreq(nft, dt)
+    f = np.fft.rfftfreq(nft, dt)
     gauss_arg = -0.5 * (f/f0) ** 2
     if waterlevel is not None:
         gauss_arg = np.maximum(gauss_arg, waterlevel)
     return np.exp(gauss_arg)
 
 
-def _apply_filter(x, filt, dt):
+def _apply_filter(x, filt, nft):
     """
     Apply a filter defined in frequency domain to a data array
 
     :param x: array of data to filter
-    :param filter: filter to apply in frequency domain,
-        e.g. from _gauss_filter()
-    :param dt: sample spacing in seconds
-    :return: real part of filtered array
+    :param filter: filter to apply in frequency domain for the non-negative
+        frequencies, e.g. from _gauss_filter()
+    :param nft: number of points for fft
+    :return: filtered array
     """
-    nft = len(filt)
-    xf = fft(x, n=nft)
-    xnew = ifft(xf*filt, n=nft)
-    return xnew.real
+    return irfft(rfft(x, n=nft) * filt, n=nft)
 
 
 def _fft_correlate(a, b, nft):
@@ -425,27 +593,99 @@ def _fft_correlate(a, b, nft):
 
     :param a, b: data arrays
     :param nft: number of points for fft
-    :return: array of real part of correlation
+    :return: array with correlation
     """
-    x = ifft(fft(a, n=nft) * np.conj(fft(b, n=nft)), n=nft)
-    return x.real
+    return irfft(rfft(a, n=nft) * np.conj(rfft(b, n=nft)), n=nft)
 
 
+@_cached_filter
 def _phase_shift_filter(nft, dt, tshift):
     """
     Construct filter to shift an array to account for time before onset
 
+    The filter is defined for the non-negative frequencies of a real-input
+    FFT (see `numpy.fft.rfft`).
+
     :param nft: number of points for fft
     :param dt: sample spacing in seconds
     :param tshift: time to shift by in seconds
     :return: shifted array
     """
-    freq = np.fft.fftfreq(nft, d=dt)
+    freq = np.fft.rfftfreq(nft, d=dt)
     return np.exp(-2j * pi * freq * tshift)
 
 
+class PreparedSource(object):
+
+    """
+    Source function(s) prepared for iterative deconvolution.
+
+    All values needed by the iterative deconvolution which only depend on
+    the source are calculated once: the Gaussian filtered source, the
+    Fourier transform of the source, the power of the filtered source and
+    its autocorrelation. The object can be passed instead of the source
+    array to `deconv_iterative()` and `deconv_iterative_batch()`. This
+    avoids repeated calculations if several responses are deconvolved with
+    the same source, e.g. in parameter sweeps.
+
+    :param src: array with source function or array with one source
+        function per row
+    :param sampling_rate: sampling rate of the data
+    :param gauss: Gauss parameter of the Gaussian Low-pass filter,
+        see `deconv_iterative()`
+
+    The attribute ``nt`` holds the number of samples of the source,
+    the attributes ``s_flt``, ``sft``, ``power`` and ``spike_rs`` hold arrays
+    with one row for each source.
+    """
+
+    def __init__(self, src, sampling_rate, gauss=0.5):
+        src = np.atleast_2d(src)
+        self.nt = nt = src.shape[1]
+        self.sampling_rate = sampling_rate
+        self.gauss = gauss
+        dt = 1 / sampling_rate
+        self.gaussF = _gauss_filter(dt, nt, gauss)
+        self.s_flt = _apply_filter(src, self.gaussF, nt)
+        self.sft = rfft(src, nt)
+        self.power = np.sum(self.s_flt**2, axis=1)
+        # a spike at sample 0 contributes the filtered source to the predicted
+        # signal and the autocorrelation of the filtered source to the
+        # correlation of residual and filtered source
+        self.spike_rs = (_fft_correlate(self.s_flt, self.s_flt, nt) /
+                         self.power[:, np.newaxis])
+        self._shifts = None
+
+    def __len__(self):
+        return len(self.s_flt)
+
+    def __repr__(self):
+        return '%s(%d sources, nt=%d, sampling_rate=%s, gauss=%s)' % (
+            self.__class__.__name__, len(self), self.nt, self.sampling_rate,
+            self.gauss)
+
+    @property
+    def shifts(self):
+        """
+        Circular shifts of filtered sources and their autocorrelations
+        (see `_circular_shifts()`)
+        """
+        if self._shifts is None:
+            self._shifts = (_circular_shifts(self.s_flt),
+                            _circular_shifts(self.spike_rs))
+        return self._shifts
+
+    def check(self, sampling_rate, gauss):
+        """Raise ValueError if the source was prepared with other values"""
+        if sampling_rate != self.sampling_rate or gauss != self.gauss:
+            msg = ('source was prepared for sampling_rate=%s and gauss=%s, '
+                   'but sampling_rate=%s and gauss=%s are used')
+            raise ValueError(msg % (self.sampling_rate, self.gauss,
+                                    sampling_rate, gauss))
+
+
 def deconv_iterative(rsp, src, sampling_rate, tshift=10, gauss=0.5, itmax=400,
-                     minderr=0.001, normalize=0):
+                     minderr=0.001, normalize=0, incremental=True):
     """
     Iterative deconvolution.
 
@@ -461,7 +701,7 @@ def deconv_iterative(rsp, src, sampling_rate, tshift=10, gauss=0.5, itmax=400,
 
     :param rsp: either a list of arrays containing the response functions
         or a single array
-    :param src: array with source function
+    :param src: array with source function or `PreparedSource` instance
     :param sampling_rate: sampling rate of the data
     :param tshift: delay time 0s will be at time tshift afterwards
     :param gauss: Gauss parameter (standard deviation) of the
@@ -473,11 +713,31 @@ def deconv_iterative(rsp, src, sampling_rate, tshift=10, gauss=0.5, itmax=400,
         spike drops below this threshold
     :param normalize: normalize all results so that the maximum of the trace
         with the supplied index is 1. Set normalize to None for no normalization.
+    :param incremental: update the residual and its correlation with the
+        source after adding a spike by subtracting a shifted copy of the
+        filtered source and of its autocorrelation, which costs O(N)
+        operations per iteration instead of several FFTs (default).
+        Set incremental to False to recalculate both with FFTs in
+        each iteration. Both variants give the same result apart from
+        rounding errors.
 
     :return: (list of) array(s) with deconvolution(s)
     """
-
-    nt = len(src)       # number of points actually in trace
+    if isinstance(src, PreparedSource):
+        src.check(sampling_rate, gauss)
+    else:
+        src = PreparedSource(src, sampling_rate, gauss)
+    if len(src) != 1:
+        raise ValueError('deconv_iterative needs exactly one source')
+    if incremental:
+        RF_out, nit = deconv_iterative_batch(
+            rsp, src, sampling_rate, tshift=tshift, gauss=gauss, itmax=itmax,
+            minderr=minderr)
+        if normalize is not None:
+            RF_out *= 1 / np.max(np.abs(RF_out[normalize]))
+        return RF_out, nit
+
+    nt = src.nt         # number of points actually in trace
     ncomp = len(rsp)    # number of components we're looping over here
     dt = 1 / sampling_rate
 
@@ -485,17 +745,17 @@ def deconv_iterative(rsp, src, sampling_rate, tshift=10, gauss=0.5, itmax=400,
     RF_out = np.zeros((ncomp,nt))       # spike trains that we're going to make
     nit = np.zeros(ncomp)               # number of iterations each component uses
 
+    gaussF = src.gaussF  # gaussian filter
+    s_flt = src.s_flt[0]  # filtered source
+    sft = src.sft[0]  # fourier transform of the source
+    powerS = src.power[0]  # power in the filtered source
+
     for c in range(ncomp):  # loop over the responses
         rms = np.zeros(itmax)    # to store rms
         p0 = np.zeros(nfft)      # and rf for this component iteration
         r0 = rsp[c]
-        s0 = src
 
-        gaussF = _gauss_filter(dt, nfft, gauss)  # construct and apply gaussian filter
-        r_flt = _apply_filter(r0, gaussF, dt)
-        s_flt = _apply_filter(s0, gaussF, dt)
-
-        sft = fft(s0, nfft)  # fourier transform of the source
+        r_flt = _apply_filter(r0, gaussF, nfft)  # apply gaussian filter
         rem_flt = copy(r_flt)  # thing to subtract from as spikes are added to p
 
         powerR = np.sum(r_flt**2)  # power in the response for scaling
@@ -507,15 +767,15 @@ def deconv_iterative(rsp, src, sampling_rate, tshift=10, gauss=0.5, itmax=400,
 
         while np.abs(d_error) > minderr and it < itmax:  # loop iterations, add spikes
             rs = _fft_correlate(rem_flt, s_flt, nfft)  # correlate (what's left of) the num & demon
-            rs = rs/np.sum(s_flt**2)  # scale the correlation
+            rs = rs/powerS  # scale the correlation
 
             i1 = np.argmax(np.abs(rs[0:int(maxlag) - 1]))  # index for getting spike amplitude
             # note that ^abs there means negative spikes are allowed
             amp = rs[i1]/dt
 
             p0[i1] = p0[i1] + amp  # add the amplitude of the spike to our spike-train RF
-            p_flt = _apply_filter(p0, gaussF, dt)  # gaussian filter the spike
-            p_flt = _apply_filter(p_flt, sft, dt) * dt  # convolve with fft of source
+            p_flt = _apply_filter(p0, gaussF, nfft)  # gaussian filter the spike
+            p_flt = _apply_filter(p_flt, sft, nfft) * dt  # convolve with fft of source
 
             rem_flt = r_flt - p_flt  # subtract spike estimate from source to see what's left to model
             sumsq = np.sum(rem_flt**2)/powerR
@@ -526,9 +786,9 @@ def deconv_iterative(rsp, src, sampling_rate, tshift=10, gauss=0.5, itmax=400,
             it = it + 1         # and add one to the iteration count
 
         # once we get out of the loop:
-        p_flt = _apply_filter(p0, gaussF, dt)
+        p_flt = _apply_filter(p0, gaussF, nfft)
         shift_filt = _phase_shift_filter(nfft, dt, tshift)
-        p_flt = _apply_filter(p_flt, shift_filt, dt)
+        p_flt = _apply_filter(p_flt, shift_filt, nfft)
         RF_out[c,:] = p_flt[:nt]  # save the RF for output
         nit[c] = it
 
@@ -539,6 +799,130 @@ def deconv_iterative(rsp, src, sampling_rate, tshift=10, gauss=0.5, itmax=400,
 
     return RF_out, nit
 
+
+def _circular_shifts(a):
+    """
+    Return read-only view of all circular shifts of the rows of a
+
+    The returned array has shape (len(a), n + 1, n) with n = a.shape[1].
+    Index (k, n - i) holds row k shifted by i samples to the right.
+    """
+    from numpy.lib.stride_tricks import as_strided
+    a2 = np.hstack((a, a))
+    n = a.shape[1]
+    strides = a2.strides + (a2.strides[1],)
+    return as_strided(a2, shape=(len(a), n + 1, n), strides=strides,
+                      writeable=False)
+
+
+def deconv_iterative_batch(rsp, src, sampling_rate, tshift=10, gauss=0.5,
+                           itmax=400, minderr=0.001, src_index=None,
+                           batch_size=None):
+    """
+    Iterative deconvolution of many traces at once.
+
+    Same algorithm as `deconv_iterative()` with incremental updates, but
+    the spikes are added to all traces in lockstep. Each iteration picks
+    the maximum of the correlation for each trace which has not yet
+    converged. The iteration stops for each trace separately, if the number
+    of iterations reaches itmax or the change in error drops below minderr.
+    The results are not normalized.
+
+    :param rsp: array with shape (number of traces, number of samples)
+        or list of arrays containing the response functions,
+        responses are cut or padded with zeros to the length of the source
+    :param src: array with source function or array with one source
+        function for each response or `PreparedSource` instance
+    :param sampling_rate: sampling rate of the data
+    :param tshift: delay time 0s will be at time tshift afterwards
+    :param gauss: Gauss parameter (standard deviation) of the
+        Gaussian Low-pass filter,
+        corresponds to cut-off frequency in Hz for a response value of
+        exp(0.5)=0.607.
+    :param itmax: limit on number of iterations/spikes to add,
+        single value or array with one value for each trace
+    :param minderr: stop iteration when the change in error from adding another
+        spike drops below this threshold,
+        single value or array with one value for each trace
+    :param src_index: array with index of source for each trace
+        (default: the same source for all traces if only one source is
+        given, otherwise one source for each trace)
+    :param batch_size: maximal number of traces deconvolved at once,
+        more traces are deconvolved in chunks to limit memory usage
+        (default: None, all traces at once)
+
+    :return: array with deconvolutions, array with number of iterations
+    """
+    if isinstance(src, PreparedSource):
+        src.check(sampling_rate, gauss)
+    else:
+        src = PreparedSource(src, sampling_rate, gauss)
+    ntr = len(rsp)
+    itmax = np.broadcast_to(itmax, ntr)
+    minderr = np.broadcast_to(minderr, ntr)
+    if src_index is None:
+        src_index = np.arange(ntr) if len(src) > 1 else np.zeros(ntr, int)
+    src_index = np.asarray(src_index)
+    if batch_size and ntr > batch_size:
+        results = [deconv_iterative_batch(
+            rsp[i:i + batch_size], src, sampling_rate, tshift=tshift,
+            gauss=gauss, itmax=itmax[i:i + batch_size],
+            minderr=minderr[i:i + batch_size],
+            src_index=src_index[i:i + batch_size])
+            for i in range(0, ntr, batch_size)]
+        return tuple(np.concatenate(r) for r in zip(*results))
+    nt = src.nt
+    nfft = nt
+    dt = 1 / sampling_rate
+    r0 = np.zeros((ntr, nt))
+    for c, r in enumerate(rsp):
+        n = min(len(r), nt)
+        r0[c, :n] = r[:n]
+    gaussF = src.gaussF
+    r_flt = _apply_filter(r0, gaussF, nfft)
+    rs = (_fft_correlate(r_flt, src.s_flt[src_index], nfft) /
+          src.power[src_index, np.newaxis])
+    # all circular shifts of filtered source and its autocorrelation,
+    # the array shifted by i samples is at index nfft - i of the second axis
+    s_shifted, spike_shifted = src.shifts
+    rem_flt = r_flt
+    powerR = np.sum(r_flt**2, axis=1)
+
+    p0 = np.zeros((ntr, nfft))
+    nit = np.zeros(ntr)
+    sumsq_i = np.ones(ntr)
+    d_error = 100*powerR + minderr
+    maxlag = int(0.5*nfft) - 1
+    # residual and correlation are only kept for active traces
+    active = np.flatnonzero((np.abs(d_error) > minderr) & (nit < itmax))
+    rem_flt = rem_flt[active]
+    rs = rs[active]
+    while len(active) > 0:
+        i1 = np.argmax(np.abs(rs[:, :maxlag]), axis=1)
+        amp = rs[np.arange(len(active)), i1] / dt
+        p0[active, i1] += amp
+        # subtract shifted copies of filtered source and its autocorrelation
+        factor = (amp * dt)[:, np.newaxis]
+        index = (src_index[active], nfft - i1)
+        rem_flt -= factor * s_shifted[index]
+        rs -= factor * spike_shifted[index]
+        sumsq = np.sum(rem_flt**2, axis=1) / powerR[active]
+        d_error[active] = 100*(sumsq_i[active] - sumsq)
+        sumsq_i[active] = sumsq
+        nit[active] += 1
+        running = ((np.abs(d_error[active]) > minderr[active]) &
+                   (nit[active] < itmax[active]))
+        if not np.all(running):
+            active = active[running]
+            rem_flt = rem_flt[running]
+            rs = rs[running]
+
+    p_flt = _apply_filter(p0, gaussF, nfft)
+    shift_filt = _phase_shift_filter(nfft, dt, tshift)
+    p_flt = _apply_filter(p_flt, shift_filt, nfft)
+    return p_flt[:, :nt], nit
+
+
 def deconv_multitaper(rsp, src, nse, sampling_rate, tshift, gauss=0.5,
                       K=3, tband=4, T=10, olap=0.75, normalize=0):
     """
@@ -601,7 +985,8 @@ def deconv_multitaper(rsp, src, nse, sampling_rate, tshift, gauss=0.5,
 
     ofac = 1 / (1 - olap)  # calculate overlap factor
 
-    sfft = np.zeros((K,nft), dtype=np.complex)  # array for holding freq-domain source estimate
+    nfreq = nft // 2 + 1  # number of non-negative frequencies
+    sfft = np.zeros((K,nfreq), dtype=complex)  # array for holding freq-domain source estimate
     src = detrend(src, type='constant')  # demean and detrend source
     src = detrend(src, type='linear')
 
@@ -618,7 +1003,7 @@ def deconv_multitaper(rsp, src, nse, sampling_rate, tshift, gauss=0.5,
             bit = np.zeros(nft)
             bit[js:je] = tap[k] # insert window taper into full-length zeros
             bit = bit*src_pad   # window/taper the padded source trace
-            bit = fft(bit)      # transform tapered bit to frequency domain
+            bit = rfft(bit)     # transform tapered bit to frequency domain
             sfft[k] = sfft[k] + bit  # sum to total freq-domain source estimate
 
     # multiply by factor to account for short wavelet relative to fft
@@ -630,8 +1015,8 @@ def deconv_multitaper(rsp, src, nse, sampling_rate, tshift, gauss=0.5,
     RF_out = np.zeros((ncomp, nft))
     for c in range(ncomp):
         dat = rsp[c]; nos = nse[c]  # pick out component
-        dfft = np.zeros((K,nft), dtype=np.complex)  # arrays for storing freq-domain estimates
-        nfft = np.zeros((K,nft), dtype=np.complex)
+        dfft = np.zeros((K,nfreq), dtype=complex)  # arrays for storing freq-domain estimates
+        nfft = np.zeros((K,nfreq), dtype=complex)
 
         # window, taper, and transform the noise
         nos = detrend(nos, type='constant')
@@ -647,14 +1032,14 @@ def deconv_multitaper(rsp, src, nse, sampling_rate, tshift, gauss=0.5,
                     bit = np.zeros(nft)
                     bit[js:je] = tap[k]
                     bit = bit*nos_pad
-                    bit = fft(bit)
+                    bit = rfft(bit)
                     nfft[k] = nfft[k] + bit
 
         fac = nwav/float(nwin*nft)  # scale for noise trace length
         nfft = nfft*fac
 
         # calculate power in the noise window
-        s0 = np.zeros(nft)
+        s0 = np.zeros(nfreq)
         for k in range(K):
             s0 = s0 + (np.real(nfft[k])**2 + np.imag(nfft[k])**2)/el[k]
 
@@ -670,15 +1055,15 @@ def deconv_multitaper(rsp, src, nse, sampling_rate, tshift, gauss=0.5,
                     bit = np.zeros(nft)
                     bit[js:je] = tap[k]
                     bit = bit*dat
-                    bit = fft(bit)
+                    bit = rfft(bit)
                     dfft[k] = dfft[k] + bit
 
         fac = float(nft)/float(nwin*nft)
         dfft = dfft*fac
 
         # deconvolve
-        num = np.zeros(nft)
-        denom = np.zeros(nft)
+        num = np.zeros(nfreq)
+        denom = np.zeros(nfreq)
         for k in range(K):
             num = num + sfft[k]*np.conj(dfft[k])
             denom = denom + sfft[k]*np.conj(sfft[k])
@@ -690,8 +1075,8 @@ def deconv_multitaper(rsp, src, nse, sampling_rate, tshift, gauss=0.5,
         recF = recF * _phase_shift_filter(nft, dt, tshift-dt)  # one sample gets lost in the shuffle
 
         # inverse fft, put in output array
-        recT = ifft(recF)
-        RF_out[c] = copy(recT.real[::-1])
+        recT = irfft(recF, nft)
+        RF_out[c] = copy(recT[::-1])
 
     if normalize is not None:
         norm = 1 / np.max(np.abs(RF_out[normalize]))
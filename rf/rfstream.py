@@ -12,9 +12,9 @@ import numpy as np
 from obspy import read, Stream, Trace
 from obspy.core import AttribDict
 from obspy.geodetics import gps2dist_azimuth
-from obspy.taup import TauPyModel
-from rf.deconvolve import deconvolve
+from rf.deconvolve import deconvolve, deconvolve_batch
 from rf.simple_model import load_model
+from rf.traveltime import load_taupy_model
 from rf.util import DEG2KM, IterMultipleComponents, _add_processing_info
 
 
@@ -76,6 +76,14 @@ _HEADERS = (tuple(zip(*_STATION_GETTER))[0] +
             'pp_latitude', 'pp_longitude', 'pp_depth',
             'box_pos', 'box_length'))
 
+# header values defining an event-station pair and header values
+# set by rfstats
+_RFSTATS_GROUP = (tuple(zip(*_STATION_GETTER))[0] +
+                  tuple(zip(*_EVENT_GETTER))[0])
+_RFSTATS_HEADERS = _RFSTATS_GROUP + (
+    'distance', 'back_azimuth', 'inclination', 'onset', 'slowness', 'phase',
+    'pp_latitude', 'pp_longitude', 'pp_depth')
+
 # The corresponding header fields in the format
 # The following headers can at the moment only be stored for H5:
 # slowness_before_moveout, box_lonlat, event_id
@@ -284,7 +292,11 @@ class RFStream(Stream):
             method. See `~.deconvolve.deconvolve()`,
             `.deconv_time()`, `.deconv_waterlevel()`,
             `.deconv_iterative()`, and `.deconv_multitaper()`
-            for further documentation.
+            for further documentation. Water level and iterative
+            deconvolutions of traces with equal lengths are calculated
+            together (see `~.deconvolve.deconvolve_batch()`, the number
+            of streams deconvolved at once can be limited with the
+            batch_size kwarg).
         :param source_components: parameter is passed to deconvolve.
             If None, source components will be chosen depending on method.
         :param \*\*kwargs: all other kwargs not mentioned here are
@@ -330,11 +342,10 @@ class RFStream(Stream):
             if tr.stats.channel.endswith('Q'):
                 tr.data = -tr.data
         if deconvolve:
-            for stream3c in iter3c(self):
-                kwargs.setdefault('winsrc', method)
-                stream3c.deconvolve(method=deconvolve,
-                                    source_components=source_components,
-                                    **kwargs)
+            # water level and iterative deconvolutions are performed at once
+            kwargs.setdefault('winsrc', method)
+            deconvolve_batch(list(iter3c(self)), method=deconvolve,
+                             source_components=source_components, **kwargs)
         # Mirrow Q/R and T component at 0s for S-receiver method for a better
         # comparison with P-receiver method (converted Sp wave arrives before
         # S wave, but converted Ps wave arrives after P wave)
@@ -615,13 +626,16 @@ def obj2stats(event=None, station=None):
     """
     Map event and station object to stats with attributes.
 
-    :param event: ObsPy `~obspy.core.event.event.Event` object
+    :param event: ObsPy `~obspy.core.event.event.Event` object or
+        row of `.EventTable`
     :param station: station object with attributes latitude, longitude and
         elevation
     :return: ``stats`` object with station and event attributes
     """
     stats = AttribDict({})
-    if event is not None:
+    if event is not None and 'event_time' in event:  # row of EventTable
+        stats.update(event)
+    elif event is not None:
         for key, getter in _EVENT_GETTER:
             stats[key] = getter(event)
     if station is not None:
@@ -630,9 +644,48 @@ def obj2stats(event=None, station=None):
     return stats
 
 
+def _get_dist_range(phase, dist_range='default'):
+    """Return default distance range for phases P and S"""
+    if dist_range == 'default':
+        dist_range = {'P': (30, 90), 'S': (50, 85)}.get(phase.upper())
+    return dist_range
+
+
+def _get_arrivals(depth, dist, phases, tt_model, tt_table=None):
+    """
+    Return travel time, slowness and inclination of first arrivals.
+
+    All phases not found in tt_table are calculated with one TauPy call.
+    The returned dictionary maps phases to tuples or to None if the phase
+    does not arrive.
+    """
+    arrivals = {}
+    if tt_table is not None:
+        for phase in phases:
+            if phase in tt_table:
+                values = tt_table(phase, depth, dist)
+                if not np.isnan(values[0]):
+                    arrivals[phase] = values
+    missing = [phase for phase in phases if phase not in arrivals]
+    if len(missing) > 0:
+        tt_model = load_taupy_model(tt_model)
+        all_arrivals = tt_model.get_travel_times(depth, dist, missing)
+        for phase in missing:
+            arrs = [arr for arr in all_arrivals if arr.phase.name == phase]
+            if len(arrs) > 1:
+                msg = ('TauPy returns more than one arrival for phase %s at '
+                       'distance %s -> take first arrival')
+                warnings.warn(msg % (phase, dist))
+            arrivals[phase] = (None if len(arrs) == 0 else
+                               (arrs[0].time, arrs[0].ray_param_sec_degree,
+                                arrs[0].incident_angle))
+    return arrivals
+
+
 def rfstats(obj=None, event=None, station=None,
             phase='P', dist_range='default', tt_model='iasp91',
-            pp_depth=None, pp_phase=None, model='iasp91'):
+            pp_depth=None, pp_phase=None, model='iasp91', tt_table=None,
+            cache=None):
     """
     Calculate ray specific values like slowness for given event and station.
 
@@ -640,72 +693,130 @@ def rfstats(obj=None, event=None, station=None,
         attributes. Can be None if both event and station are given.
         It is possible to specify a stream object, too. Then, rfstats will be
         called for each Trace.stats object and traces outside dist_range will
-        be discarded.
-    :param event: ObsPy `~obspy.core.event.event.Event` object
+        be discarded. Values are calculated only once for traces with the
+        same event and station attributes.
+    :param event: ObsPy `~obspy.core.event.event.Event` object or
+        row of `.EventTable`
     :param station: dictionary like object with items latitude, longitude and
         elevation
     :param phase: string with phase. Usually this will be 'P' or
         'S' for P and S receiver functions, respectively.
+        It is possible to specify a list of phases, e.g. ['P', 'PP', 'S'],
+        if the obj argument is not a stream. Then, the arrivals of all
+        phases are calculated with one TauPy call and a list
+        of stats objects is returned.
     :type dist_range: tuple of length 2
     :param dist_range: if epicentral of event is not in this intervall, None
         is returned by this function,\n
         if phase == 'P' defaults to (30, 90),\n
-        if phase == 'S' defaults to (50, 85)
+        if phase == 'S' defaults to (50, 85),\n
+        for other phases no distance range is used by default
     :param tt_model: model for travel time calculation.
-        (see the `obspy.taup` module, default: iasp91)
+        (see the `obspy.taup` module, default: iasp91),
+        models are loaded only once (see `.load_taupy_model()`)
     :param pp_depth: Depth for piercing point calculation
         (in km, default: None -> No calculation)
     :param pp_phase: Phase for pp calculation (default: 'S' for P-receiver
         function and 'P' for S-receiver function)
     :param model: Path to model file for pp calculation
         (see `.SimpleModel`, default: iasp91)
+    :param tt_table: `.TravelTimeTable` instance. If given, onset,
+        slowness and inclination are interpolated from the table instead
+        of calculated by TauPy. TauPy is still used if the phase is not
+        included in the table or the event is outside of the grid.
+    :param cache: `.RFStatsCache` instance for storing and looking up
+        distance, back azimuth, onset, slowness and inclination of
+        event-station pairs
     :return: `~obspy.core.trace.Stats` object with event and station
         attributes, distance, back_azimuth, inclination, onset and
         slowness or None if epicentral distance is not in the given interval.
         Stream instance if stream was specified instead of stats.
+        List of stats objects or None values if a list of phases was
+        specified. In this case phases without arrival are also None.
     """
     if isinstance(obj, (Stream, RFStream)):
+        if not isinstance(phase, str):
+            raise ValueError('phase has to be a string for stream objects')
         stream = obj
         kwargs = {'event': event, 'station': station,
                   'phase': phase, 'dist_range': dist_range,
                   'tt_model': tt_model, 'pp_depth': pp_depth,
-                  'pp_phase': pp_phase, 'model': model}
+                  'pp_phase': pp_phase, 'model': model,
+                  'tt_table': tt_table, 'cache': cache}
+        # traces of the same event and station share the results
+        results = {}
         traces = []
         for tr in stream:
-            if rfstats(tr.stats, **kwargs) is not None:
+            key = tuple(str(tr.stats.get(head)) for head in _RFSTATS_GROUP)
+            if key not in results:
+                results[key] = rfstats(tr.stats, **kwargs)
+            elif results[key] is not None:
+                tr.stats.update({head: results[key][head]
+                                 for head in _RFSTATS_HEADERS
+                                 if head in results[key]})
+            if results[key] is not None:
                 traces.append(tr)
         stream.traces = traces
         return stream
-    if dist_range == 'default' and phase.upper() in 'PS':
-        dist_range = (30, 90) if phase.upper() == 'P' else (50, 85)
+    phases = [phase] if isinstance(phase, str) else list(phase)
     stats = AttribDict({}) if obj is None else obj
     if event is not None and station is not None:
         stats.update(obj2stats(event=event, station=station))
-    dist, baz, _ = gps2dist_azimuth(stats.station_latitude,
-                                    stats.station_longitude,
-                                    stats.event_latitude,
-                                    stats.event_longitude)
-    dist = dist / 1000 / DEG2KM
-    if dist_range and not dist_range[0] <= dist <= dist_range[1]:
-        return
-    tt_model = TauPyModel(model=tt_model)
-    arrivals = tt_model.get_travel_times(stats.event_depth, dist, (phase,))
-    if len(arrivals) == 0:
-        raise Exception('TauPy does not return phase %s at distance %s' %
-                        (phase, dist))
-    if len(arrivals) > 1:
-        msg = ('TauPy returns more than one arrival for phase %s at '
-               'distance -> take first arrival')
-        warnings.warn(msg % (phase, dist))
-    arrival = arrivals[0]
-    onset = stats.event_time + arrival.time
-    inc = arrival.incident_angle
-    slowness = arrival.ray_param_sec_degree
-    stats.update({'distance': dist, 'back_azimuth': baz, 'inclination': inc,
-                  'onset': onset, 'slowness': slowness, 'phase': phase})
-    if pp_depth is not None:
-        model = load_model(model)
-        if pp_phase is None:
-            pp_phase = 'S' if phase.upper().endswith('P') else 'P'
-        model.ppoint(stats, pp_depth, phase=pp_phase)
-    return stats
+    cached = {}
+    if cache is not None:
+        for ph in phases:
+            values = cache.get(stats, ph, tt_model, tt_table=tt_table)
+            if values is not None:
+                cached[ph] = values
+    if len(cached) > 0:
+        dist, baz = next(iter(cached.values()))[:2]
+    else:
+        dist, baz, _ = gps2dist_azimuth(stats.station_latitude,
+                                        stats.station_longitude,
+                                        stats.event_latitude,
+                                        stats.event_longitude)
+        dist = dist / 1000 / DEG2KM
+    arrivals = {ph: values[2:] for ph, values in cached.items()
+                if values[2] is not None}
+    in_range = []
+    for ph in phases:
+        dr = _get_dist_range(ph, dist_range)
+        if not dr or dr[0] <= dist <= dr[1]:
+            in_range.append(ph)
+        elif cache is not None and ph not in cached:
+            cache.put(stats, ph, tt_model, dist, baz, tt_table=tt_table)
+    missing = [ph for ph in in_range if ph not in arrivals]
+    if len(missing) > 0:
+        new_arrivals = _get_arrivals(stats.event_depth, dist, missing,
+                                     tt_model, tt_table)
+        arrivals.update(new_arrivals)
+        if cache is not None:
+            for ph, values in new_arrivals.items():
+                cache.put(stats, ph, tt_model, dist, baz, *(values or ()),
+                          tt_table=tt_table)
+    results = []
+    for ph in phases:
+        if ph not in in_range:
+            results.append(None)
+            continue
+        if arrivals[ph] is None:
+            if len(phases) == 1:
+                raise Exception('TauPy does not return phase %s at '
+                                'distance %s' % (ph, dist))
+            results.append(None)
+            continue
+        time, slowness, inc = arrivals[ph]
+        st = stats if len(phases) == 1 else stats.copy()
+        st.update({'distance': dist, 'back_azimuth': baz,
+                   'inclination': inc, 'onset': stats.event_time + time,
+                   'slowness': slowness, 'phase': ph})
+        if pp_depth is not None:
+            pp_model = load_model(model)
+            pp_ph = pp_phase
+            if pp_ph is None:
+                pp_ph = 'S' if ph.upper().endswith('P') else 'P'
+            pp_model.ppoint(st, pp_depth, phase=pp_ph)
+        results.append(st)
+    if isinstance(phase, str):
+        return results[0]
+    return results
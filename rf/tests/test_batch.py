@@ -3,6 +3,7 @@
 Tests for batch module.
 """
 from glob import glob
+import json
 import unittest
 import os
 from pkg_resources import load_entry_point
@@ -102,15 +103,62 @@ class BatchTestCase(unittest.TestCase):
     def test_batch_command_interface_H5(self):
         test_format(self, 'H5')
 
+    @unittest.skipIf(sys.platform.startswith("win"), "fails on Windows")
+    def test_batch_plan(self):
+        with tempdir():
+            script(['create', '-t'])
+            with quiet():
+                script(['plan', 'tasks.npz'])
+                script(['data', '--dry-run', 'data'])
+                script(['data', '--plan', 'tasks.npz', '--shard', '1/2',
+                        'data'])
+            n1 = len(glob(os.path.join('data', '*', '*')))
+            with quiet():
+                script(['data', '--plan', 'tasks.npz', '--shard', '2/2',
+                        'data'])
+            n2 = len(glob(os.path.join('data', '*', '*')))
+            self.assertGreater(n1, 0)
+            self.assertEqual(n2, 14)
+            for shard in ('0/2', '3/2', '1/0', '1', 'foo', '1/b'):
+                with quiet(), self.assertRaises(SystemExit):
+                    script(['data', '--plan', 'tasks.npz', '--shard', shard,
+                            'data'])
+
+    @unittest.skipIf(sys.platform.startswith("win"), "fails on Windows")
+    def test_batch_data_stats(self):
+        with tempdir():
+            script(['create', '-t'])
+            substitute('#"data_stats"', '"data_stats"')
+            with quiet():
+                script(['data', 'data'])
+            with open('data_stats.json') as f:
+                stats = json.load(f)
+        self.assertEqual(stats['run']['requests'], 7)
+        self.assertEqual(stats['run']['traces'], 21)
+        self.assertGreater(stats['run']['bytes'], 0)
+        self.assertEqual(list(stats['stations']), ['CX.PB01'])
+        self.assertEqual(stats['stations']['CX.PB01']['bytes'],
+                         stats['run']['bytes'])
+
     def test_plugin_option(self):
         f = init_data('plugin', plugin='rf.tests.test_batch : gw_test')
         self.assertEqual(f(nework=4, station=2), 42)
+        f = init_data('plugin', plugin='rf.tests.test_batch : gw_error')
+        with quiet():
+            self.assertIsNone(f(network='NE', station='STA', location='',
+                                channel='BH?'))
+        self.assertEqual(f.stats.run['errors'], {'ValueError': 1})
+        self.assertEqual(f.stats.stations['NE.STA']['requests'], 1)
 
 
 def gw_test(**kwargs):
     return 42
 
 
+def gw_error(**kwargs):
+    raise ValueError('no data')
+
+
 def suite():
     return unittest.makeSuite(BatchTestCase, 'test')
 
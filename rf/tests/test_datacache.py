@@ -0,0 +1,307 @@
+# Copyright 2013-2019 Tom Eulenfeld, MIT license
+"""
+Tests for datacache module.
+"""
+import json
+import os
+from pkg_resources import resource_filename
+import unittest
+
+import numpy as np
+from obspy import read, Stream, Trace, UTCDateTime
+from rf.datacache import (BlockCache, _iter_mseed_spans, NoDataCache,
+                          _read_mseed_spans, RetrievalStats, WaveformArchive,
+                          WaveformCache)
+from rf.tests.util import tempdir
+
+
+def _data(stream):
+    return [(tr.id, tr.stats.starttime, tr.data.tolist()) for tr in stream]
+
+
+class DataCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = read()
+        for tr in self.stream:
+            tr.data = np.require(tr.data, np.float32)
+        self.requests = []
+
+        def get_waveforms(network, station, location, channel, starttime,
+                          endtime, event=None):
+            self.requests.append((starttime, endtime))
+            st = self.stream.select(network=network, station=station,
+                                    location=location, channel=channel)
+            return st.slice(starttime, endtime)
+        self.get_waveforms = get_waveforms
+        t = self.stream[0].stats.starttime
+        self.kw = {'network': 'BW', 'station': 'RJOB', 'location': '',
+                   'channel': 'EH?', 'starttime': t + 5, 'endtime': t + 25}
+
+    def test_waveform_cache(self):
+        kw = self.kw
+        with tempdir():
+            cache = WaveformCache(self.get_waveforms, 'cache')
+            st1 = cache(event=None, **kw)
+            self.assertEqual(len(st1), 3)
+            st2 = cache(**kw)
+            self.assertEqual(_data(st1), _data(st2))
+            self.assertEqual(len(self.requests), 1)
+            # contained window is served from cache
+            kw2 = dict(kw, starttime=kw['starttime'] + 5,
+                       endtime=kw['endtime'] - 5)
+            st3 = cache(**kw2)
+            self.assertEqual(_data(st3), _data(st1.slice(kw2['starttime'],
+                                                         kw2['endtime'])))
+            self.assertEqual(len(self.requests), 1)
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+            # no data is not cached
+            self.assertEqual(len(cache(**dict(kw, station='XXX'))), 0)
+            self.assertEqual(len(cache(**dict(kw, station='XXX'))), 0)
+            self.assertEqual(len(self.requests), 3)
+            self.assertEqual(len(cache), 1)
+            self.assertTrue(os.path.exists('cache/BW/RJOB/--.EH_'))
+            # cache is persistent
+            cache2 = WaveformCache(self.get_waveforms, 'cache')
+            self.assertEqual(len(cache2), 1)
+            self.assertEqual(cache2.size, cache.size)
+            self.assertEqual(_data(cache2(**kw)), _data(st1))
+            self.assertEqual(len(self.requests), 3)
+
+    def test_waveform_cache_eviction(self):
+        kw = self.kw
+        with tempdir():
+            cache = WaveformCache(self.get_waveforms, 'cache')
+            cache(**kw)
+            size = cache.size
+            cache.max_size = 2.5 * size
+            kw2 = dict(kw, starttime=kw['starttime'] - 5,
+                       endtime=kw['endtime'] - 5)
+            kw3 = dict(kw, starttime=kw['starttime'] + 5,
+                       endtime=kw['endtime'] + 5)
+            cache(**kw2)
+            cache(**kw)  # access first entry again
+            cache(**kw3)
+            self.assertEqual(len(cache), 2)
+            self.assertLessEqual(cache.size, cache.max_size)
+            self.assertEqual(len(self.requests), 3)
+            # second entry was evicted, first and third are cached
+            cache(**kw)
+            cache(**kw3)
+            self.assertEqual(len(self.requests), 3)
+            cache(**kw2)
+            self.assertEqual(len(self.requests), 4)
+
+    def test_waveform_cache_bulk(self):
+        bulk_requests = []
+
+        def get_waveforms_bulk(bulk):
+            bulk_requests.append(bulk)
+            stream = self.stream.__class__()
+            for net, sta, loc, cha, t1, t2 in bulk:
+                stream += self.get_waveforms(net, sta, loc, cha, t1, t2)
+            return stream
+        self.get_waveforms.bulk = get_waveforms_bulk
+        kw = self.kw
+        args = tuple(kw[k] for k in ('network', 'station', 'location',
+                                     'channel', 'starttime', 'endtime'))
+        args2 = args[:4] + (args[4] + 10, args[5] + 10)
+        with tempdir():
+            cache = WaveformCache(self.get_waveforms, 'cache')
+            cache(**kw)
+            stream = cache.bulk([args, args2])
+            self.assertEqual(len(stream), 6)
+            self.assertEqual(bulk_requests, [[args2]])
+            stream = cache.bulk([args, args2])
+            self.assertEqual(len(stream), 6)
+            self.assertEqual(len(bulk_requests), 1)
+
+    def test_block_cache_bulk(self):
+        bulk_requests = []
+
+        def get_waveforms_bulk(bulk):
+            bulk_requests.append(bulk)
+            stream = self.stream.__class__()
+            for net, sta, loc, cha, t1, t2 in bulk:
+                stream += self.get_waveforms(net, sta, loc, cha, t1, t2)
+            return stream
+        self.assertFalse(hasattr(BlockCache(self.get_waveforms), 'bulk'))
+        self.get_waveforms.bulk = get_waveforms_bulk
+        t = self.stream[0].stats.starttime
+        args1 = ('BW', 'RJOB', '', 'EH?', t + 5, t + 15)
+        args2 = ('BW', 'RJOB', '', 'EH?', t + 10, t + 25)
+        cache = BlockCache(self.get_waveforms, block_length=10,
+                           max_blocks=1)
+        stream = cache.bulk([args1, args2])
+        # all blocks are retrieved with one bulk request
+        self.assertEqual(len(bulk_requests), 1)
+        self.assertEqual(len(bulk_requests[0]), 3)
+        self.assertEqual(len(self.requests), 3)
+        for args in (args1, args2):
+            st1 = self.stream.slice(*args[4:])
+            st2 = stream.select(channel='EH?').slice(*args[4:])
+            st2.merge()
+            self.assertEqual(_data(st1.sort()), _data(st2.sort()))
+        # only the last block is held in memory
+        cache.bulk([args2[:4] + (t + 20, t + 25)])
+        self.assertEqual(len(bulk_requests), 1)
+        self.assertEqual(cache.hits, 1)
+
+    def test_nodata_cache(self):
+        kw = self.kw
+        with tempdir():
+            cache = NoDataCache(self.get_waveforms, 'nodata.sqlite')
+            self.assertEqual(len(cache(**kw)), 3)
+            self.assertEqual(len(cache(**dict(kw, channel='BH?'))), 0)
+            self.assertEqual(len(self.requests), 2)
+            self.assertEqual(len(cache), 1)
+            # contained window is skipped
+            kw2 = dict(kw, channel='BH?', starttime=kw['starttime'] + 5)
+            self.assertIsNone(cache(**kw2))
+            self.assertEqual(len(self.requests), 2)
+            self.assertEqual(cache.skipped_nodata['BW.RJOB'], 1)
+            cache.close()
+            # requests without data are remembered between runs
+            cache = NoDataCache(self.get_waveforms, 'nodata.sqlite')
+            self.assertIsNone(cache(**kw2))
+            self.assertEqual(len(self.requests), 2)
+            self.assertIn('1 known without data', cache.summary())
+            cache.close()
+
+    def test_circuit_breaker(self):
+        kw = self.kw
+
+        failed = []
+
+        def get_waveforms(**kwargs):
+            if kwargs['station'] == 'FAIL':
+                failed.append(kwargs)
+                raise IOError('timeout')
+            return self.get_waveforms(**kwargs)
+        cache = NoDataCache(get_waveforms, max_failures=2)
+        kw2 = dict(kw, station='FAIL')
+        for i in range(2):
+            with self.assertRaises(IOError):
+                cache(**kw2)
+        # exceptions are not remembered
+        self.assertEqual(len(cache), 0)
+        for i in range(3):
+            self.assertIsNone(cache(**kw2))
+            self.assertEqual(len(cache(**kw)), 3)
+        self.assertEqual(len(failed), 2)
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(cache.broken(), ['BW.FAIL'])
+        self.assertEqual(cache.skipped_breaker['BW.FAIL'], 3)
+        self.assertIn('BW.FAIL (3 skipped)', cache.summary())
+
+    def test_retrieval_stats(self):
+        stats = RetrievalStats()
+        stats.record('BW.RJOB..EH?', 2., self.stream, starttime=10.)
+        stats.record('BW.RJOB..EH?', 1., None, starttime=11.)
+        stats.record('BW.XXX..EH?', 3., None, error=IOError('timeout'),
+                     starttime=11.)
+        summary = stats.summary()
+        run = summary['run']
+        self.assertEqual(run['requests'], 3)
+        self.assertEqual(run['traces'], 3)
+        self.assertEqual(run['bytes'], 3 * 4 * 3000)
+        self.assertEqual(run['empty'], 1)
+        self.assertEqual(run['errors'], {'OSError': 1})
+        self.assertEqual(run['mean_latency'], 2.)
+        self.assertEqual(run['max_latency'], 3.)
+        self.assertEqual(run['duration'], 4.)
+        self.assertEqual(run['throughput'], 3 * 3000)
+        self.assertEqual(list(summary['stations']), ['BW.RJOB', 'BW.XXX'])
+        self.assertEqual(summary['stations']['BW.RJOB']['requests'], 2)
+        self.assertEqual(summary['stations']['BW.XXX']['errors'],
+                         {'OSError': 1})
+        with tempdir():
+            stats.write('stats.json')
+            with open('stats.json') as f:
+                self.assertEqual(json.load(f), summary)
+
+    def test_waveform_archive(self):
+        fname = resource_filename('rf', 'example/example_data.mseed')
+        stream = read(fname)
+        with tempdir():
+            for tr in self.stream:
+                tr.write('%s.sac' % tr.id, 'SAC')
+            archive = WaveformArchive([fname, '*.sac'], index='index.sqlite')
+            self.assertEqual(len(archive), 4)
+            tr = stream[0]
+            kws = [('CX', 'PB01', '', 'BH?', tr.stats.starttime + 100, 300),
+                   ('CX', 'PB01', '', 'BHZ', tr.stats.starttime - 10, 50),
+                   ('CX', 'PB01', '', 'BH?', tr.stats.endtime - 5, 100),
+                   ('CX', 'PB01', '', 'BHZ', tr.stats.endtime + 5, 10)]
+            for net, sta, loc, cha, t1, length in kws:
+                st1 = stream.select(network=net, station=sta, location=loc,
+                                    channel=cha).slice(t1, t1 + length)
+                st2 = archive(network=net, station=sta, location=loc,
+                              channel=cha, starttime=t1,
+                              endtime=t1 + length, event=None)
+                st1.merge()
+                st2.merge()
+                self.assertEqual(_data(st1), _data(st2))
+            # lists of channels
+            t1 = tr.stats.starttime + 100
+            st1 = archive(network='CX', station='PB01', location='',
+                          channel='BH[ZN]', starttime=t1, endtime=t1 + 50)
+            st2 = archive(network='CX', station='PB01', location='',
+                          channel='BHZ,BHN', starttime=t1, endtime=t1 + 50)
+            self.assertEqual(len(st1), 2)
+            self.assertEqual(_data(st1.sort()), _data(st2.sort()))
+            # files in other formats
+            t = self.stream[0].stats.starttime
+            st = archive(network='BW', station='RJOB', location='',
+                         channel='EH?', starttime=t + 5, endtime=t + 10)
+            st1 = self.stream.slice(t + 5, t + 10)
+            self.assertEqual(_data(st.sort()), _data(st1.sort()))
+            # index is stored and only updated for new or changed files
+            archive.close()
+            archive = WaveformArchive(['*.sac', fname], index='index.sqlite')
+            self.assertEqual(archive.update_index(), 0)
+            os.remove('BW.RJOB..EHZ.sac')
+            self.assertEqual(archive.update_index(), 0)
+            self.assertEqual(len(archive), 3)
+            self.stream[1].data[:] = 0
+            self.stream[1].write('BW.RJOB..EHN.sac', 'SAC')
+            os.utime('BW.RJOB..EHN.sac', (0, 1))
+            self.assertEqual(archive.update_index(), 1)
+            st = archive(network='BW', station='RJOB', location='',
+                         channel='EH?', starttime=t + 5, endtime=t + 10)
+            self.assertEqual(len(st), 2)
+            self.assertEqual(st.select(channel='EHN')[0].data.max(), 0)
+
+    def test_mseed_spans(self):
+        stream = Stream()
+        t = UTCDateTime(2020, 1, 1, 0, 0, 0, 123456)
+        for cha in ('BHZ', 'BHN'):
+            for k in range(3):
+                tr = Trace(np.arange(20000, dtype=np.int32))
+                tr.stats.update({'network': 'XX', 'station': 'AB',
+                                 'channel': cha, 'sampling_rate': 20,
+                                 'starttime': t + k * 1100})
+                stream.append(tr)
+        with tempdir():
+            stream.write('data.mseed', 'MSEED', reclen=512)
+            spans1 = _read_mseed_spans('data.mseed')
+            spans2 = list(_iter_mseed_spans('data.mseed'))
+            size = os.path.getsize('data.mseed')
+            stream2 = read('data.mseed')
+        self.assertEqual(spans1, spans2)
+        # one span per trace
+        self.assertEqual(len(spans1), 6)
+        self.assertEqual(len(stream2), 6)
+        for span, tr in zip(spans1, stream2):
+            self.assertEqual(span[:4], tuple(tr.id.split('.')))
+            self.assertEqual(span[4:6], (tr.stats.starttime.ns,
+                                         tr.stats.endtime.ns))
+        self.assertEqual(sum(span[7] for span in spans1), size)
+
+
+def suite():
+    return unittest.makeSuite(DataCacheTestCase, 'test')
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
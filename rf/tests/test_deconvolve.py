@@ -149,6 +149,159 @@ class DeconvolveTestCase(unittest.TestCase):
         self.assertEqual(peakpos, np.argmax(stream2[1].data))
         self.assertEqual(peakpos, np.argmax(stream3[1].data))
 
+    def test_deconvolve_batch(self):
+        from rf.deconvolve import deconvolve, deconvolve_batch
+        stream = read_rf()[:3]
+        rfstats(stream)
+        stream.filter('bandpass', freqmin=0.4, freqmax=1)
+        stream.trim2(5, 95, reftime='starttime')
+        stream.rotate('ZNE->LQT')
+        streams = [stream.copy() for i in range(4)]
+        for i, st in enumerate(streams):
+            for tr in st:
+                tr.data = tr.data + 0.1 * i * np.roll(tr.data, 10 * i)
+        streams[3].trim2(0, 70, reftime='starttime')
+        # traces of a stream with different lengths
+        streams.append(streams[2].copy())
+        streams[4][1].data = streams[4][1].data[:-5]
+        streams.append(streams[4].copy())
+        kws = [{'method': 'waterlevel'},
+               {'method': 'waterlevel', 'normalize': 'src'},
+               {'method': 'waterlevel', 'normalize': None},
+               {'method': 'waterlevel', 'normalize': -1},
+               {'method': 'iterative', 'normalize': -1},
+               {'method': 'waterlevel', 'response_components': 'QT'},
+               {'method': 'iterative'},
+               {'method': 'iterative', 'normalize': None, 'itmax': 50},
+               {'method': 'iterative', 'response_components': 'QT'}]
+        for kw in kws:
+            streams1 = [st.copy() for st in streams]
+            streams2 = [st.copy() for st in streams]
+            rfs1 = [deconvolve(st, **kw) for st in streams1]
+            rfs2 = deconvolve_batch(streams2, **kw)
+            # results do not depend on the size of the batches
+            rfs3 = deconvolve_batch([st.copy() for st in streams],
+                                    batch_size=1, **kw)
+            for st2, st3 in zip(rfs2, rfs3):
+                for tr2, tr3 in zip(st2, st3):
+                    np.testing.assert_allclose(tr2.data, tr3.data,
+                                               rtol=1e-10, atol=1e-10)
+            for st1, st2 in zip(rfs1, rfs2):
+                self.assertEqual(len(st1), len(st2))
+                for tr1, tr2 in zip(st1, st2):
+                    np.testing.assert_allclose(tr1.data, tr2.data,
+                                               rtol=1e-10, atol=1e-10)
+                    self.assertEqual(tr1.stats, tr2.stats)
+        # rf uses deconvolve_batch
+        stream1 = streams[0].copy()
+        for i, st in enumerate(streams[1:]):
+            for tr in st:
+                tr.stats.station = 'ST%d' % i
+            stream1.extend(st)
+        stream2 = stream1.copy()
+        stream1.rf(deconvolve='waterlevel', rotate=None)
+        for tr in stream2.select(component='Q'):
+            tr.data = -tr.data
+        for i in range(0, len(stream2), 3):
+            stream2[i:i + 3].deconvolve(method='waterlevel')
+        self.assertEqual(len(stream1), len(stream2))
+        for tr1, tr2 in zip(stream1, stream2):
+            self.assertEqual(tr1.id, tr2.id)
+            np.testing.assert_allclose(tr1.data, tr2.data, rtol=1e-10,
+                                       atol=1e-10)
+
+    def test_deconv_iterative_incremental(self):
+        from rf.deconvolve import deconv_iterative
+        rng = np.random.RandomState(42)
+        for nt in (400, 901):
+            src = rng.randn(nt) * np.hanning(nt)
+            rsp = [convolve(src, rng.randn(30), 'same') +
+                   0.1 * rng.randn(nt) for i in range(3)]
+            for kw in ({}, {'gauss': 2., 'itmax': 50},
+                       {'minderr': 1e-5, 'normalize': None}):
+                rf1, nit1 = deconv_iterative(rsp, src, 10., **kw)
+                rf2, nit2 = deconv_iterative(rsp, src, 10., incremental=False,
+                                             **kw)
+                np.testing.assert_equal(nit1, nit2)
+                np.testing.assert_allclose(rf1, rf2, rtol=1e-10, atol=1e-10)
+
+    def test_deconv_iterative_batch(self):
+        from rf.deconvolve import deconv_iterative, deconv_iterative_batch
+        rng = np.random.RandomState(42)
+        nt = 400
+        srcs = [rng.randn(nt) * np.hanning(nt) for i in range(2)]
+        rsps = [[convolve(src, rng.randn(30), 'same') + 0.1 * rng.randn(nt)
+                 for i in range(3)] for src in srcs]
+        src = np.repeat(srcs, 3, axis=0)
+        rsp = np.vstack(rsps)
+        itmax = [400, 400, 400, 20, 30, 40]
+        rf, nit = deconv_iterative_batch(rsp, src, 10., itmax=itmax)
+        self.assertEqual(rf.shape, (6, nt))
+        np.testing.assert_equal(nit[3:], itmax[3:])
+        for i in range(2):
+            for j in range(3):
+                k = 3 * i + j
+                rf1, nit1 = deconv_iterative([rsp[k]], srcs[i], 10.,
+                                             itmax=itmax[k], normalize=None,
+                                             incremental=False)
+                self.assertEqual(nit[k], nit1[0])
+                np.testing.assert_allclose(rf[k], rf1[0], rtol=1e-10,
+                                           atol=1e-10)
+        # common source for all traces
+        rf2, nit2 = deconv_iterative_batch(rsp[:3], srcs[0], 10.)
+        np.testing.assert_equal(nit2, nit[:3])
+        np.testing.assert_allclose(rf2, rf[:3], rtol=1e-10, atol=1e-10)
+        # traces deconvolved in chunks
+        rf3, nit3 = deconv_iterative_batch(rsp, src, 10., itmax=itmax,
+                                           batch_size=4)
+        np.testing.assert_equal(nit3, nit)
+        np.testing.assert_allclose(rf3, rf, rtol=1e-10, atol=1e-10)
+
+    def test_prepared_source(self):
+        from rf.deconvolve import (deconv_iterative, deconv_iterative_batch,
+                                   PreparedSource)
+        rng = np.random.RandomState(42)
+        nt = 400
+        src = rng.randn(nt) * np.hanning(nt)
+        rsp = [convolve(src, rng.randn(30), 'same') + 0.1 * rng.randn(nt)
+               for i in range(3)]
+        prepared = PreparedSource(src, 10., gauss=1.)
+        self.assertEqual((len(prepared), prepared.nt), (1, nt))
+        rf1, nit1 = deconv_iterative(rsp, src, 10., gauss=1.,
+                                     normalize=None)
+        for incremental in (True, False):
+            # source is reused for each response
+            for i in range(3):
+                rf2, nit2 = deconv_iterative(
+                    [rsp[i]], prepared, 10., gauss=1., normalize=None,
+                    incremental=incremental)
+                self.assertEqual(nit2[0], nit1[i])
+                np.testing.assert_allclose(rf2[0], rf1[i], rtol=1e-10,
+                                           atol=1e-10)
+        rf2, nit2 = deconv_iterative_batch(rsp, prepared, 10., gauss=1.)
+        np.testing.assert_equal(nit2, nit1)
+        np.testing.assert_allclose(rf2, rf1, rtol=1e-10, atol=1e-10)
+        # source has to be prepared with the same parameters
+        with self.assertRaises(ValueError):
+            deconv_iterative(rsp, prepared, 10., gauss=0.5)
+        with self.assertRaises(ValueError):
+            deconv_iterative(rsp, PreparedSource([src, src], 10.), 10.)
+
+    def test_filter_cache(self):
+        from rf.deconvolve import (_apply_filter, _gauss_filter,
+                                   _phase_shift_filter)
+        filt = _gauss_filter(0.1, 400, 0.5)
+        self.assertEqual(len(filt), 201)
+        self.assertIs(_gauss_filter(0.1, 400, 0.5), filt)
+        self.assertIsNot(_gauss_filter(0.1, 400, 1.), filt)
+        self.assertFalse(filt.flags.writeable)
+        # shift by 2s corresponds to 20 samples
+        data = np.zeros(400)
+        data[100] = 1
+        shifted = _apply_filter(data, _phase_shift_filter(400, 0.1, 2.), 400)
+        self.assertEqual(np.argmax(shifted), 120)
+        np.testing.assert_allclose(shifted, np.roll(data, 20), atol=1e-10)
+
     def test_deconvolve_custom_function(self):
         def test_func_stream(rsp, src, **kw):
             for r_ in rsp:
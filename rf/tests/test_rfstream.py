@@ -3,10 +3,12 @@
 Tests for rfstream module.
 """
 import unittest
+from unittest import mock
 
 from obspy import read, read_events
 from obspy.core import AttribDict
 from obspy.core.util import NamedTemporaryFile
+import rf.rfstream
 from rf import read_rf, RFStream, rfstats
 from rf.rfstream import (obj2stats, _HEADERS, _STATION_GETTER, _EVENT_GETTER,
                          _FORMATHEADERS)
@@ -136,6 +138,37 @@ class RFStreamTestCase(unittest.TestCase):
         with self.assertRaisesRegex(ValueError, 'No origin'):
             stats = rfstats(station=self.station, event=event, pp_depth=100.)
 
+    def test_rfstats_multiple_phases(self):
+        stats = rfstats(station=self.station, event=self.event,
+                        phase=['P', 'PP', 'S'], dist_range=None)
+        self.assertEqual([st.phase for st in stats], ['P', 'PP', 'S'])
+        for st in stats:
+            st2 = rfstats(station=self.station, event=self.event,
+                          phase=st.phase, dist_range=None)
+            self.assertEqual(st.onset, st2.onset)
+            self.assertEqual(st.slowness, st2.slowness)
+        stats = rfstats(station=self.station, event=self.event,
+                        phase=['P', 'S'], dist_range='default')
+        self.assertIsNotNone(stats[0])
+        self.assertIsNotNone(stats[1])
+        stats = rfstats(station=self.station, event=self.event,
+                        phase=['P', 'S'], dist_range=(10, 20))
+        self.assertEqual(stats, [None, None])
+        with self.assertRaises(ValueError):
+            rfstats(read_rf(), phase=['P', 'S'])
+
+    def test_rfstats_stream(self):
+        stream = read_rf()
+        stats = [rfstats(tr.stats.copy()) for tr in stream]
+        with mock.patch('rf.rfstream._get_arrivals',
+                        wraps=rf.rfstream._get_arrivals) as get_arrivals:
+            rfstats(stream)
+        self.assertEqual(get_arrivals.call_count, len(stream) // 3)
+        for st, tr in zip(stats, stream):
+            for head in ('onset', 'distance', 'back_azimuth', 'slowness',
+                         'inclination', 'phase'):
+                self.assertEqual(st[head], tr.stats[head])
+
     def test_trim2(self):
         stream = read_rf()
         starttimes = [tr.stats.starttime for tr in stream]
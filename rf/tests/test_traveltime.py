@@ -0,0 +1,127 @@
+# Copyright 2013-2019 Tom Eulenfeld, MIT license
+"""
+Tests for traveltime module.
+"""
+import os.path
+import sqlite3
+import threading
+import unittest
+
+import numpy as np
+from obspy import read_events
+from obspy.core import AttribDict
+from rf import rfstats
+from rf.tests.util import tempdir
+import rf.traveltime
+from rf.traveltime import load_taupy_model, RFStatsCache, TravelTimeTable
+
+
+class TravelTimeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.event = read_events()[0]
+        self.station = AttribDict({'latitude': 41.818 - 66.7,
+                                   'longitude': 79.689,
+                                   'elevation': 365.4})
+        self.table = TravelTimeTable(('P', 'S'), depths=[0, 10, 20, 50],
+                                     distances=np.arange(50, 81, 2.))
+
+    def test_table_vs_taupy(self):
+        stats1 = rfstats(station=self.station, event=self.event)
+        stats2 = rfstats(station=self.station, event=self.event,
+                         tt_table=self.table)
+        self.assertLess(abs(stats2.onset - stats1.onset), 0.1)
+        self.assertAlmostEqual(stats2.slowness, stats1.slowness, 2)
+        self.assertAlmostEqual(stats2.inclination, stats1.inclination, 1)
+        errors = self.table.max_error(num=10, seed=42)
+        self.assertEqual(set(errors), {'P', 'S'})
+        for phase in errors:
+            self.assertLess(errors[phase][0], 0.5)
+        # outside of grid -> fallback to TauPy
+        self.assertTrue(np.isnan(self.table('P', 100, 60)[0]))
+        stats3 = rfstats(station=self.station, event=self.event,
+                         tt_table=self.table, phase='PP', dist_range=None)
+        self.assertGreater(stats3.onset, stats1.onset)
+
+    def test_io(self):
+        with tempdir():
+            self.table.save('table.npz')
+            self.assertTrue(os.path.exists('table.npz'))
+            table = TravelTimeTable.load('table.npz')
+        self.assertEqual(table.phases, self.table.phases)
+        self.assertEqual(table.model, self.table.model)
+        np.testing.assert_array_equal(table.data, self.table.data)
+
+    def test_rfstats_cache(self):
+        with tempdir():
+            cache = RFStatsCache('cache.sqlite')
+            stats1 = rfstats(station=self.station, event=self.event,
+                             cache=cache)
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+            self.assertEqual(len(cache), 1)
+            stats2 = rfstats(station=self.station, event=self.event,
+                             cache=cache)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            cache.close()
+            # event outside of distance range
+            cache = RFStatsCache('cache.sqlite')
+            stats3 = rfstats(station=self.station, event=self.event,
+                             cache=cache, dist_range=(10, 20))
+            self.assertIsNone(stats3)
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+            cache.close()
+        for key in ('distance', 'back_azimuth', 'onset', 'slowness',
+                    'inclination'):
+            self.assertEqual(stats1[key], stats2[key])
+
+    def test_rfstats_cache_table(self):
+        with tempdir():
+            with RFStatsCache('cache.sqlite') as cache:
+                stats1 = rfstats(station=self.station, event=self.event,
+                                 cache=cache)
+                # interpolated values are not mixed with exact values
+                stats2 = rfstats(station=self.station, event=self.event,
+                                 cache=cache, tt_table=self.table)
+                self.assertEqual((cache.hits, cache.misses), (0, 2))
+                self.assertEqual(len(cache), 2)
+                stats3 = rfstats(station=self.station, event=self.event,
+                                 cache=cache, tt_table=self.table)
+                self.assertEqual((cache.hits, cache.misses), (1, 2))
+            self.assertRaises(sqlite3.ProgrammingError, len, cache)
+        self.assertNotEqual(stats1.onset, stats2.onset)
+        self.assertEqual(stats2.onset, stats3.onset)
+
+    def test_load_taupy_model(self):
+        model = load_taupy_model('iasp91')
+        self.assertIs(load_taupy_model('iasp91'), model)
+        models = []
+
+        def load():
+            models.append(load_taupy_model('iasp91'))
+            models.append(load_taupy_model('iasp91'))
+        threads = [threading.Thread(target=load)
+                   for _ in range(rf.traveltime.TAUPY_POOL_SIZE + 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # each thread reuses its own instance, even with many threads
+        self.assertEqual(len(set(map(id, models))), len(threads))
+        self.assertNotIn(model, models)
+        self.assertIs(load_taupy_model('iasp91'), model)
+        size = rf.traveltime.TAUPY_POOL_SIZE
+        rf.traveltime.TAUPY_POOL_SIZE = 2
+        try:
+            for name in ('ak135', 'prem', 'iasp91'):
+                load_taupy_model(name)
+            self.assertEqual(len(rf.traveltime._taupy_pool()), 2)
+        finally:
+            rf.traveltime.TAUPY_POOL_SIZE = size
+
+
+def suite():
+    return unittest.makeSuite(TravelTimeTestCase, 'test')
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,624 @@
+# Copyright 2013-2019 Tom Eulenfeld, MIT license
+"""
+Tests for util module.
+"""
+import asyncio
+from pkg_resources import resource_filename
+import unittest
+from unittest import mock
+
+import numpy as np
+from obspy import read, read_events, read_inventory, UTCDateTime
+from obspy.geodetics import gps2dist_azimuth
+from rf.rfstream import obj2stats
+from rf.tests.util import tempdir
+import rf.util
+from rf.util import (aiter_event_data, DEG2KM, distance_azimuth_matrix,
+                     EventTable, Journal, iter_event_data,
+                     iter_event_metadata, iter_task_data, plan_event_data,
+                     StationTable, TaskTable, _coalesce_requests, _Request)
+
+
+def _example_files():
+    def fname(name):
+        return resource_filename('rf', 'example/%s' % name)
+    events = read_events(fname('example_events.xml'))
+    inventory = read_inventory(fname('example_inventory.xml'))
+    stream = read(fname('example_data.mseed'))
+    return events, inventory, stream
+
+
+def _run(coroutine):
+    """Run coroutine in a new event loop, asyncio.run needs Python 3.7"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class _Pbar(object):
+
+    total = None
+    n = 0
+
+    def update(self, n):
+        self.n += n
+
+
+class UtilTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.events, self.inventory, self.stream = _example_files()
+        self.requests = []
+
+        def get_waveforms(**kwargs):
+            self.requests.append(kwargs)
+            st = self.stream.select(network=kwargs['network'],
+                                    station=kwargs['station'],
+                                    location=kwargs['location'],
+                                    channel=kwargs['channel'])
+            return st.slice(kwargs['starttime'], kwargs['endtime'])
+        self.get_waveforms = get_waveforms
+
+    def test_distance_azimuth_matrix(self):
+        evcoords = [(-20.1, -70.3), (35.2, 139.4), (0, 0)]
+        stacoords = [(-21.04, -69.49), (50.2, 10.3)]
+        dist, baz = distance_azimuth_matrix(evcoords, stacoords)
+        self.assertEqual(dist.shape, (3, 2))
+        self.assertEqual(baz.shape, (3, 2))
+        for i, j in np.ndindex(dist.shape):
+            d, b, _ = gps2dist_azimuth(*(stacoords[j] + evcoords[i]))
+            d = d / 1000 / DEG2KM
+            self.assertLess(abs(dist[i, j] - d), 0.005 * d + 0.01)
+            self.assertLess(abs((baz[i, j] - b + 180) % 360 - 180), 0.5)
+
+    def test_iter_event_data(self):
+        pbar = _Pbar()
+        streams = list(iter_event_data(self.events, self.inventory,
+                                       self.get_waveforms, pbar=pbar))
+        self.assertEqual(len(streams), 7)
+        self.assertEqual(len(self.requests), 7)
+        # 6 of 13 events are discarded before calling rfstats
+        self.assertEqual(pbar.total, 7)
+        for stream in streams:
+            self.assertEqual(len(stream), 3)
+            self.assertIn('onset', stream[0].stats)
+        # no pair inside this distance range
+        self.requests = []
+        streams = list(iter_event_data(self.events, self.inventory,
+                                       self.get_waveforms,
+                                       dist_range=(150, 160)))
+        self.assertEqual(len(streams), 0)
+        self.assertEqual(len(self.requests), 0)
+
+    def test_iter_event_data_multiple_phases(self):
+        streams = list(iter_event_data(self.events, self.inventory,
+                                       self.get_waveforms,
+                                       phase=['P', 'PP'],
+                                       request_window=(-20, 60)))
+        phases = [stream[0].stats.phase for stream in streams]
+        self.assertEqual(phases.count('P'), 7)
+        # separate requests for P and PP
+        self.assertGreater(len(self.requests), 7)
+        # overlapping request windows -> one request per event
+        self.requests = []
+        streams = list(iter_event_data(self.events, self.inventory,
+                                       self.get_waveforms,
+                                       phase=['P', 'PcP'],
+                                       dist_range=(30, 40),
+                                       request_window=(-50, 150)))
+        self.assertEqual(len(streams), 2 * len(self.requests))
+        for stream in streams:
+            self.assertEqual(len(stream), 3)
+            onset = stream[0].stats.onset
+            self.assertLess(abs(stream[0].stats.starttime - onset + 50), 0.2)
+
+    def test_iter_event_data_concurrent(self):
+        get_waveforms = self.get_waveforms
+        calls = []
+
+        def get_waveforms2(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 2:
+                raise ValueError('no data')
+            return get_waveforms(**kwargs)
+        serial = list(iter_event_data(self.events, self.inventory,
+                                      get_waveforms2))
+        self.assertEqual(len(serial), 6)
+        for ordered in (True, False):
+            calls = []
+            streams = list(iter_event_data(
+                self.events, self.inventory, get_waveforms2, max_workers=3,
+                prefetch=2, ordered=ordered))
+            self.assertEqual(len(calls), 7)
+            self.assertEqual(len(streams), 6)
+            ids = [st[0].stats.event_id for st in streams]
+            expected = [st[0].stats.event_id for st in serial]
+            if ordered:
+                self.assertEqual(ids, expected)
+            self.assertEqual(sorted(ids), sorted(expected))
+        # closing the iterator early does not block
+        self.requests = []
+        iter_ = iter_event_data(self.events, self.inventory,
+                                self.get_waveforms, max_workers=2)
+        next(iter_)
+        iter_.close()
+        self.assertLessEqual(len(self.requests), 5)
+
+    def test_iter_event_data_bulk(self):
+        def assert_streams_equal(streams1, streams2):
+            self.assertEqual(len(streams1), len(streams2))
+            for st1, st2 in zip(streams1, streams2):
+                self.assertEqual(st1[0].stats.event_id,
+                                 st2[0].stats.event_id)
+                for tr1, tr2 in zip(st1, st2):
+                    self.assertEqual(tr1.id, tr2.id)
+                    self.assertEqual(tr1.stats.starttime,
+                                     tr2.stats.starttime)
+                    np.testing.assert_array_equal(tr1.data, tr2.data)
+        bulk_requests = []
+
+        def get_waveforms_bulk(bulk):
+            bulk_requests.append(bulk)
+            stream = self.stream.__class__()
+            for net, sta, loc, cha, t1, t2 in bulk:
+                stream += self.get_waveforms(
+                    network=net, station=sta, location=loc, channel=cha,
+                    starttime=t1, endtime=t2)
+            return stream
+        self.get_waveforms.bulk = get_waveforms_bulk
+        streams = list(iter_event_data(self.events, self.inventory,
+                                       self.get_waveforms))
+        self.assertEqual(len(bulk_requests), 7)
+        self.assertEqual(len(streams), 7)
+        bulk_requests = []
+        streams2 = list(iter_event_data(self.events, self.inventory,
+                                        self.get_waveforms, bulk=3))
+        self.assertEqual([len(b) for b in bulk_requests], [3, 3, 1])
+        assert_streams_equal(streams2, streams)
+        # bulk requests disabled
+        bulk_requests = []
+        self.requests = []
+        streams3 = list(iter_event_data(self.events, self.inventory,
+                                        self.get_waveforms, bulk=None,
+                                        max_workers=2))
+        self.assertEqual(len(bulk_requests), 0)
+        self.assertEqual(len(self.requests), 7)
+        assert_streams_equal(streams3, streams)
+
+    def test_iter_event_data_station_order(self):
+        streams = list(iter_event_data(self.events, self.inventory,
+                                       self.get_waveforms))
+        self.requests = []
+        streams2 = list(iter_event_data(self.events, self.inventory,
+                                        self.get_waveforms, order='station',
+                                        block_length=1e7))
+        # 7 events inside 2 blocks
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(len(streams2), 7)
+        times = [st[0].stats.event_time for st in streams2]
+        self.assertEqual(times, sorted(times))
+        streams2 = {st[0].stats.event_id: st for st in streams2}
+        for st1 in streams:
+            st2 = streams2[st1[0].stats.event_id]
+            for tr1, tr2 in zip(st1, st2):
+                self.assertEqual(tr1.stats.starttime, tr2.stats.starttime)
+                np.testing.assert_array_equal(tr1.data, tr2.data)
+        # returned data is a copy
+        for st in streams2.values():
+            for tr in st:
+                tr.data[:] = 0
+        self.assertEqual(self.stream, _example_files()[2])
+        self.requests = []
+        streams2 = list(iter_event_data(self.events, self.inventory,
+                                        self.get_waveforms, order='station',
+                                        block_length=0))
+        self.assertEqual(len(self.requests), 7)
+        self.assertEqual(len(streams2), 7)
+
+    def test_iter_event_data_station_order_blocks(self):
+        bulk_requests = []
+
+        def get_waveforms_bulk(bulk):
+            bulk_requests.append(bulk)
+            stream = self.stream.__class__()
+            for net, sta, loc, cha, t1, t2 in bulk:
+                stream += self.get_waveforms(
+                    network=net, station=sta, location=loc, channel=cha,
+                    starttime=t1, endtime=t2)
+            return stream
+        # FDSN like client, data is not retrieved in blocks by default
+        self.get_waveforms.bulk = get_waveforms_bulk
+        streams = list(iter_event_data(self.events, self.inventory,
+                                       self.get_waveforms, order='station'))
+        self.assertEqual(len(streams), 7)
+        self.assertEqual(len(bulk_requests), 7)
+        for (_, _, _, _, t1, t2), in bulk_requests:
+            self.assertLess(t2 - t1, 300)
+        # blocks with explicit block_length use the bulk requests, too
+        bulk_requests = []
+        streams = list(iter_event_data(self.events, self.inventory,
+                                       self.get_waveforms, order='station',
+                                       block_length=1e7))
+        self.assertEqual(len(streams), 7)
+        self.assertEqual(len(bulk_requests), 2)
+        self.assertEqual(len(self.requests), 2 + 7)
+        # local data is retrieved in blocks of one day by default
+        del self.get_waveforms.bulk
+        self.get_waveforms.local = True
+        self.requests = []
+        streams = list(iter_event_data(self.events, self.inventory,
+                                       self.get_waveforms, order='station'))
+        self.assertEqual(len(streams), 7)
+        self.assertEqual(len(self.requests), 7)
+        for kwargs in self.requests:
+            self.assertEqual(kwargs['endtime'].ns - kwargs['starttime'].ns,
+                             86400 * 10 ** 9 - 1)
+
+    def test_aiter_event_data(self):
+        running = []
+        max_running = []
+
+        async def get_waveforms(**kwargs):
+            running.append(1)
+            max_running.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+            if len(self.requests) == 1:
+                self.requests.append(kwargs)
+                raise ValueError('no data')
+            return self.get_waveforms(**kwargs)
+
+        async def collect(**kwargs):
+            return [st async for st in aiter_event_data(
+                self.events, self.inventory, get_waveforms, **kwargs)]
+        streams = list(iter_event_data(self.events, self.inventory,
+                                       self.get_waveforms))
+        ids = [st[0].stats.event_id for st in streams]
+        self.requests = []
+        streams2 = _run(collect(max_concurrent=3))
+        self.assertEqual(max(max_running), 3)
+        self.assertEqual(len(streams2), 6)
+        ids2 = [st[0].stats.event_id for st in streams2]
+        self.assertEqual(ids2, [id_ for id_ in ids if id_ in ids2])
+        for stream in streams2:
+            self.assertEqual(len(stream), 3)
+            self.assertIn('onset', stream[0].stats)
+        self.requests = []
+        del max_running[:]
+        streams2 = _run(collect(max_concurrent=2, prefetch=2,
+                                ordered=False))
+        self.assertEqual(len(streams2), 6)
+        self.assertEqual(max(max_running), 2)
+
+    def test_journal(self):
+        get_waveforms = self.get_waveforms
+
+        def get_waveforms2(**kwargs):
+            if len(self.requests) == 1:
+                self.requests.append(kwargs)
+                return
+            st = get_waveforms(**kwargs)
+            if len(self.requests) == 3:
+                st.pop()
+            return st
+        with tempdir():
+            journal = Journal('journal.sqlite')
+            streams = list(iter_event_data(self.events, self.inventory,
+                                           get_waveforms2, journal=journal))
+            self.assertEqual(len(streams), 5)
+            self.assertEqual(journal.summary(),
+                             {'written': 5, 'rejected': 1, 'failed': 1})
+            status, reason = journal.status(
+                streams[0][0].stats.event_id, 'CX.PB01..BH?', 'P')
+            self.assertEqual((status, reason), ('written', None))
+            # only the failed pair is retrieved again
+            self.requests = []
+            streams = list(iter_event_data(
+                self.events, self.inventory, self.get_waveforms,
+                journal='journal.sqlite', resume=True))
+            self.assertEqual(len(self.requests), 1)
+            self.assertEqual(len(streams), 1)
+            self.assertEqual(journal.summary(),
+                             {'written': 6, 'rejected': 1})
+            # pairs are marked as written after they were processed
+            journal = Journal('journal2.sqlite')
+            iter_ = iter_event_data(self.events, self.inventory,
+                                    self.get_waveforms, journal=journal)
+            next(iter_)
+            self.assertEqual(len(journal), 0)
+            next(iter_)
+            self.assertEqual(len(journal), 1)
+            tasks = plan_event_data(self.events, self.inventory)
+            self.requests = []
+            streams = list(iter_task_data(tasks, self.get_waveforms,
+                                          journal=journal, resume=True))
+            self.assertEqual(len(streams), 6)
+            self.assertEqual(len(self.requests), 6)
+
+            # journals opened from filename are closed at the end
+            async def aget_waveforms(**kwargs):
+                return self.get_waveforms(**kwargs)
+
+            async def collect(**kwargs):
+                return [st async for st in aiter_event_data(
+                    self.events, self.inventory, aget_waveforms, **kwargs)]
+            with mock.patch.object(Journal, 'close', autospec=True) as close:
+                list(iter_event_data(self.events, self.inventory,
+                                     self.get_waveforms,
+                                     journal='journal3.sqlite'))
+                list(iter_task_data(tasks, self.get_waveforms,
+                                    journal='journal3.sqlite'))
+                _run(collect(journal='journal3.sqlite'))
+                self.assertEqual(close.call_count, 3)
+                list(iter_event_data(self.events, self.inventory,
+                                     self.get_waveforms, journal=journal))
+                self.assertEqual(close.call_count, 3)
+
+    def test_iter_event_data_coalesce(self):
+        kw = dict(phase=['P', 'PP'], request_window=(-20, 60))
+        streams = list(iter_event_data(self.events, self.inventory,
+                                       self.get_waveforms, **kw))
+        self.assertEqual(len(self.requests), 18)
+        self.requests = []
+        streams2 = list(iter_event_data(self.events, self.inventory,
+                                        self.get_waveforms, coalesce=1000,
+                                        **kw))
+        # one request per event-station pair
+        self.assertEqual(len(self.requests), 13)
+        self.assertEqual(len(streams2), len(streams))
+        for st1, st2 in zip(streams, streams2):
+            self.assertEqual(st1[0].stats.phase, st2[0].stats.phase)
+            for tr1, tr2 in zip(st1, st2):
+                self.assertEqual(tr1.stats.starttime, tr2.stats.starttime)
+                np.testing.assert_array_equal(tr1.data, tr2.data)
+
+    def test_coalesce_requests(self):
+        t = UTCDateTime(2020, 1, 1)
+        windows = [(0, 100), (50, 150), (155, 200), (300, 400), (0, 10)]
+        requests = [_Request({'network': 'NET', 'station': 'STA',
+                              'location': '', 'channel': 'BH?',
+                              'starttime': t + t1, 'endtime': t + t2},
+                             None, None, None) for t1, t2 in windows]
+        combined = list(_coalesce_requests(requests, tolerance=10))
+        self.assertEqual(len(combined), 3)
+        self.assertEqual(combined[0].parts, requests[:3])
+        self.assertEqual(combined[0].kws['starttime'], t)
+        self.assertEqual(combined[0].kws['endtime'], t + 200)
+        self.assertIs(combined[1], requests[3])
+        self.assertIs(combined[2], requests[4])
+        combined = list(_coalesce_requests(requests))
+        self.assertEqual(len(combined), 4)
+
+    def test_event_table(self):
+        table = EventTable(self.events)
+        self.assertEqual(len(table), len(self.events))
+        self.assertEqual(table.time.dtype, np.int64)
+        for i, event in enumerate(self.events):
+            stats1 = obj2stats(event=event)
+            stats2 = obj2stats(event=table[i])
+            self.assertEqual(stats1, stats2)
+        self.assertEqual(len(table[2:5]), 3)
+        self.assertEqual(len(table[table.magnitude > 10]), 0)
+        with tempdir():
+            table.save('events.npz')
+            table2 = EventTable.load('events.npz')
+        for key in EventTable.COLUMNS:
+            np.testing.assert_array_equal(getattr(table, key),
+                                          getattr(table2, key))
+        event = self.events[0].copy()
+        event.preferred_magnitude_id = None
+        event.magnitudes = []
+        with self.assertRaisesRegex(ValueError, 'No magnitude'):
+            EventTable([event])[0]
+        meta1 = list(iter_event_metadata(self.events, self.inventory))
+        meta2 = list(iter_event_metadata(table, self.inventory))
+        self.assertEqual(meta1, meta2)
+        streams = list(iter_event_data(table, self.inventory,
+                                       self.get_waveforms))
+        self.assertEqual(len(streams), 7)
+
+    def test_station_table(self):
+        table = StationTable(self.inventory)
+        self.assertEqual(table.seedids, ['CX.PB01..BH?'])
+        events = EventTable(self.events)
+        epochs = table.match(events.time)
+        self.assertEqual(epochs.shape, (len(events), 1))
+        for i in range(len(events)):
+            coords = self.inventory.get_coordinates('CX.PB01..BHZ',
+                                                    events.utctime(i))
+            self.assertEqual(table.coordinates(epochs[i, 0]), coords)
+        # no active station before 2000
+        epochs = table.match([UTCDateTime('1990-01-01').ns])
+        self.assertEqual(epochs[0, 0], -1)
+        streams = list(iter_event_data(events, table, self.get_waveforms))
+        self.assertEqual(len(streams), 7)
+
+    def test_station_table_boundaries(self):
+        inventory = self.inventory.copy()
+        channels = inventory[0][0].channels
+        t1 = UTCDateTime('2011-01-01')
+        t2 = UTCDateTime('2012-01-01')
+        for cha in channels:
+            cha.end_date = t1
+        # second epoch with open end date and other coordinates
+        for cha in channels[:3]:
+            cha = cha.copy()
+            cha.start_date = t1
+            cha.end_date = None
+            cha.latitude = float(cha.latitude) + 1
+            channels.append(cha)
+        inventory[0][0].end_date = None
+        inventory[0].end_date = None
+        table = StationTable(inventory)
+        self.assertEqual(len(table), 2)
+        times = [t1 - 1e-6, t1, t1 + 1e-6, t2, UTCDateTime('2100-01-01')]
+        epochs = table.match([t.ns for t in times])
+        self.assertTrue(np.all(epochs >= 0))
+        for t, epoch in zip(times, epochs[:, 0]):
+            coords = inventory.get_coordinates('CX.PB01..BHZ', t)
+            self.assertEqual(table.coordinates(epoch), coords)
+        # at the common boundary the first epoch in the inventory is used
+        self.assertEqual(epochs[1, 0], epochs[0, 0])
+        self.assertNotEqual(epochs[2, 0], epochs[0, 0])
+        # small chunks give the same result
+        chunksize = rf.util.MATCH_CHUNKSIZE
+        rf.util.MATCH_CHUNKSIZE = 1
+        try:
+            np.testing.assert_equal(table.match([t.ns for t in times]),
+                                    epochs)
+        finally:
+            rf.util.MATCH_CHUNKSIZE = chunksize
+
+    def test_channel_priority(self):
+        inventory = self.inventory.copy()
+        channels = inventory[0][0].channels
+        t = UTCDateTime('2011-03-15')
+        for code in ('HHZ', 'HHN', 'HHE', 'BH1', 'BH2', 'EHZ'):
+            cha = channels[0].copy()
+            cha.code = code
+            if code.startswith('HH'):
+                cha.end_date = t
+            channels.append(cha)
+        table = StationTable(inventory)
+        self.assertEqual(len(table.seedids), 3)
+        table = StationTable(inventory, channel_priority=['HH', 'BH', 'EH'])
+        # incomplete EH? channels are ignored
+        self.assertEqual(sorted(table.seedids),
+                         ['CX.PB01..BH?', 'CX.PB01..HH?'])
+        events = EventTable(self.events)
+        epochs = table.match(events.time)
+        self.assertTrue(np.all(np.sum(epochs >= 0, axis=1) == 1))
+        jhh = table.seedids.index('CX.PB01..HH?')
+        np.testing.assert_equal(epochs[:, jhh] >= 0, events.time < t.ns)
+        # only the channels of the preferred set are requested for epochs
+        # with additional components
+        self.assertEqual(
+            {table.seedids[j]: ch
+             for j, ch in zip(table.index, table.channels)},
+            {'CX.PB01..HH?': '', 'CX.PB01..BH?': 'BHZ,BHN,BHE'})
+        # only the best seed id is requested for each event
+        requests = []
+        # data with ZNE and Z12 components
+        stream = self.stream.copy()
+        for tr in self.stream.select(component='[NE]'):
+            tr2 = tr.copy()
+            tr2.stats.channel = tr.stats.channel.replace('N', '1').replace(
+                'E', '2')
+            stream.append(tr2)
+
+        def get_waveforms(**kwargs):
+            requests.append(kwargs['channel'])
+            # surplus channels are returned for lists of channels
+            st = stream if ',' in kwargs['channel'] else self.stream
+            return st.slice(kwargs['starttime'], kwargs['endtime'])
+        streams = list(iter_event_data(
+            self.events, inventory, get_waveforms,
+            channel_priority=['HH', 'BH', 'EH']))
+        self.assertEqual(len(streams), 7)
+        self.assertEqual(set(requests), {'HH?', 'BHZ,BHN,BHE'})
+        # surplus channels are discarded
+        for st in streams:
+            self.assertEqual(sorted(tr.stats.channel[-1] for tr in st),
+                             ['E', 'N', 'Z'])
+        # lists of channels are split up for bulk requests
+        bulk = []
+
+        def get_waveforms_bulk(bulk_):
+            bulk.extend(bulk_)
+            st = stream.copy()
+            for tr in self.stream.copy():
+                tr.stats.channel = 'HH' + tr.stats.channel[-1]
+                st.append(tr)
+            return st
+        get_waveforms.bulk = get_waveforms_bulk
+        streams2 = list(iter_event_data(
+            self.events, inventory, get_waveforms,
+            channel_priority=['HH', 'BH', 'EH']))
+        self.assertEqual(len(streams2), 7)
+        self.assertEqual({args[3] for args in bulk},
+                         {'HH?', 'BHZ', 'BHN', 'BHE'})
+        for st in streams2:
+            self.assertEqual(sorted(tr.stats.channel[-1] for tr in st),
+                             ['E', 'N', 'Z'])
+        # Z12 is used if ZNE is not complete
+        table = StationTable(inventory, channel_priority=['BH'],
+                             components=('Z12', 'ZNE'))
+        self.assertEqual(set(table.channels), {'', 'BHZ,BH1,BH2'})
+        # without channel priority the streams are not changed
+        streams = list(iter_event_data(
+            self.events, self.inventory,
+            lambda **kw: stream.select(channel=kw['channel']).slice(
+                kw['starttime'], kw['endtime'])))
+        self.assertEqual(len(streams), 0)
+
+    def test_plan_event_data(self):
+        streams1 = list(iter_event_data(self.events, self.inventory,
+                                        self.get_waveforms, pp_depth=50))
+        tasks = plan_event_data(self.events, self.inventory, pp_depth=50)
+        self.assertEqual(len(tasks), 7)
+        summary = tasks.summary()
+        self.assertEqual(summary['pairs'], 7)
+        self.assertEqual(summary['stations'], 1)
+        sr = self.inventory[0][0][0].sample_rate
+        self.assertEqual(summary['bytes'], 7 * 3 * 220 * sr * 4)
+        with tempdir():
+            tasks.save('tasks.npz')
+            tasks = TaskTable.load('tasks.npz')
+        streams2 = list(iter_task_data(tasks, self.get_waveforms))
+        self.assertEqual(len(streams1), len(streams2))
+        for st1, st2 in zip(streams1, streams2):
+            self.assertEqual(st1, st2)
+            for tr1, tr2 in zip(st1, st2):
+                for head in ('onset', 'slowness', 'event_time', 'event_id',
+                             'station_latitude', 'pp_latitude', 'phase'):
+                    self.assertEqual(tr1.stats[head], tr2.stats[head])
+        shards = [tasks.shard(i, 3) for i in range(3)]
+        self.assertEqual(sum(len(shard) for shard in shards), 7)
+        # pad of the plan is used for the summary and data retrieval
+        tasks = plan_event_data(self.events, self.inventory, pad=5)
+        self.assertEqual(tasks.summary()['bytes'], 7 * 3 * 210 * sr * 4)
+        with tempdir():
+            tasks.save('tasks.npz')
+            tasks = TaskTable.load('tasks.npz')
+        self.assertEqual(tasks.shard(0, 3).pad, 5)
+        requests = []
+
+        def get_waveforms(**kwargs):
+            requests.append(kwargs['endtime'] - kwargs['starttime'])
+            return self.get_waveforms(**kwargs)
+        list(iter_task_data(tasks, get_waveforms))
+        self.assertEqual(set(requests), {210})
+        tasks = plan_event_data(self.events, self.inventory,
+                                phase=['P', 'PP'], dist_range=None)
+        self.assertEqual(len(np.unique(tasks.pair)), 13)
+        self.assertEqual(set(tasks.phase), {'P', 'PP'})
+        # headers set to NaN by rfstats are kept, e.g. piercing points of
+        # P waves with S wave slowness
+        kw = dict(phase='S', dist_range=None, pp_depth=100)
+        streams1 = list(iter_event_data(self.events, self.inventory,
+                                        self.get_waveforms, **kw))
+        tasks = plan_event_data(self.events, self.inventory, **kw)
+        self.assertTrue(np.any(np.isnan(tasks.pp_latitude)))
+        with tempdir():
+            tasks.save('tasks.npz')
+            tasks = TaskTable.load('tasks.npz')
+        streams2 = list(iter_task_data(tasks, self.get_waveforms))
+        self.assertEqual(len(streams1), len(streams2))
+        pp_lats = []
+        for st1, st2 in zip(streams1, streams2):
+            for tr1, tr2 in zip(st1, st2):
+                self.assertEqual(set(tr1.stats), set(tr2.stats))
+                np.testing.assert_equal(tr1.stats.pp_latitude,
+                                        tr2.stats.pp_latitude)
+                pp_lats.append(tr2.stats.pp_latitude)
+        self.assertTrue(np.any(np.isnan(pp_lats)))
+
+
+def suite():
+    return unittest.makeSuite(UtilTestCase, 'test')
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
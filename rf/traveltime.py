@@ -0,0 +1,332 @@
+# Copyright 2013-2019 Tom Eulenfeld, MIT license
+"""
+Travel time tables and caches for fast calculation of ray specific values.
+"""
+from collections import OrderedDict
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+from obspy.taup import TauPyModel
+
+
+#: Maximal number of TauPy models kept in the pool
+TAUPY_POOL_SIZE = 8
+_TAUPY_POOL = threading.local()
+
+
+def _taupy_pool():
+    """Return pool of TauPy models of the current thread"""
+    try:
+        return _TAUPY_POOL.models
+    except AttributeError:
+        _TAUPY_POOL.models = OrderedDict()
+        return _TAUPY_POOL.models
+
+
+def load_taupy_model(model='iasp91'):
+    """
+    Return TauPyModel instance from a pool of loaded models.
+
+    Loading a TauPy model from disk is expensive. Each thread has its own
+    pool, because TauPyModel objects are not thread-safe. A pool holds up
+    to `TAUPY_POOL_SIZE` models and drops the least recently used model if
+    the pool is full. Models loaded by the main thread before forking are
+    reused by the worker processes.
+
+    :param model: name of model or path to model file
+        (see the `obspy.taup` module, default: iasp91)
+    """
+    pool = _taupy_pool()
+    key = str(model)
+    try:
+        pool.move_to_end(key)
+        return pool[key]
+    except KeyError:
+        pass
+    tt_model = TauPyModel(model=model)
+    pool[key] = tt_model
+    while len(pool) > TAUPY_POOL_SIZE:
+        pool.popitem(last=False)
+    return tt_model
+
+
+class TravelTimeTable(object):
+
+    """
+    Travel time lookup table for a depth x distance grid.
+
+    For each phase the table holds travel time, ray parameter and incidence
+    angle of the first arrival calculated with TauPy. Values between grid
+    nodes are linearly interpolated. The table is built once and can be
+    saved to and loaded from disk. Pass it to `~rf.rfstream.rfstats()` with
+    the ``tt_table`` argument to avoid a ray calculation for each
+    event-station pair.
+
+    :param phases: tuple of phases, e.g. ``('P', 'S')``
+    :param model: model for travel time calculation
+        (see the `obspy.taup` module, default: iasp91)
+    :param depths: event depths of grid nodes in km
+        (default: 0km to 700km in steps of 10km)
+    :param distances: epicentral distances of grid nodes in degree
+        (default: 0° to 180° in steps of 1°)
+    :param data: array with shape (len(phases), 3, len(depths),
+        len(distances)) holding travel time, slowness and incidence angle,
+        if None (default) the table is calculated with TauPy
+
+    Example usage::
+
+        table = TravelTimeTable(('P', 'S'), distances=np.arange(25, 101.))
+        print(table.max_error())
+        table.save('iasp91_tt.npz')
+        table = TravelTimeTable.load('iasp91_tt.npz')
+        stats = rfstats(station=station, event=event, tt_table=table)
+    """
+
+    def __init__(self, phases=('P',), model='iasp91', depths=None,
+                 distances=None, data=None):
+        if isinstance(phases, str):
+            phases = (phases,)
+        if depths is None:
+            depths = np.arange(0, 701, 10.)
+        if distances is None:
+            distances = np.arange(0, 181, 1.)
+        self.phases = tuple(phases)
+        self.model = model
+        self.depths = np.asarray(depths, dtype=float)
+        self.distances = np.asarray(distances, dtype=float)
+        if data is None:
+            data = self._calculate()
+        self.data = np.asarray(data, dtype=float)
+        self._identity = None
+
+    def _calculate(self):
+        shape = (len(self.phases), 3, len(self.depths), len(self.distances))
+        data = np.full(shape, np.nan)
+        tt_model = load_taupy_model(self.model)
+        for i, depth in enumerate(self.depths):
+            for j, dist in enumerate(self.distances):
+                arrivals = tt_model.get_travel_times(depth, dist, self.phases)
+                for k, phase in enumerate(self.phases):
+                    arrival = _first_arrival(arrivals, phase)
+                    if arrival is not None:
+                        data[k, :, i, j] = (arrival.time,
+                                            arrival.ray_param_sec_degree,
+                                            arrival.incident_angle)
+        return data
+
+    def __contains__(self, phase):
+        return phase in self.phases
+
+    @property
+    def identity(self):
+        """
+        String identifying the table by a hash of model, phases, grid
+        and data.
+
+        Used by `RFStatsCache` to distinguish interpolated values from
+        exact values. The hash is calculated once, changes of the data
+        afterwards are not taken into account.
+        """
+        if self._identity is None:
+            sha = hashlib.sha1(repr((self.phases, str(self.model))).encode())
+            for array in (self.depths, self.distances, self.data):
+                sha.update(np.ascontiguousarray(array).tobytes())
+            self._identity = 'table:' + sha.hexdigest()[:16]
+        return self._identity
+
+    def __call__(self, phase, depth, distance):
+        """
+        Return interpolated travel time, slowness and incidence angle.
+
+        :param phase: phase, which has to be included in the table
+        :param depth: event depth(s) in km
+        :param distance: epicentral distance(s) in degree
+        :return: tuple (time, slowness, inclination), the values are NaN
+            outside the grid or if the phase does not arrive at one of the
+            neighbouring grid nodes
+        """
+        data = self.data[self.phases.index(phase)]
+        depth = np.asarray(depth, dtype=float)
+        distance = np.asarray(distance, dtype=float)
+        i, wi = _grid_weights(self.depths, depth)
+        j, wj = _grid_weights(self.distances, distance)
+        values = ((1 - wi) * (1 - wj) * data[:, i, j] +
+                  (1 - wi) * wj * data[:, i, j + 1] +
+                  wi * (1 - wj) * data[:, i + 1, j] +
+                  wi * wj * data[:, i + 1, j + 1])
+        return tuple(values)
+
+    def max_error(self, num=100, seed=None):
+        """
+        Return maximal interpolation error compared to TauPy.
+
+        The error is estimated at random positions inside the grid.
+
+        :param num: number of random positions
+        :param seed: seed for the random number generator
+        :return: dictionary with phases as keys and tuples of maximal
+            absolute errors of travel time (s), slowness (s/deg) and
+            incidence angle (deg) as values
+        """
+        rng = np.random.RandomState(seed)
+        depths = rng.uniform(self.depths[0], self.depths[-1], num)
+        dists = rng.uniform(self.distances[0], self.distances[-1], num)
+        tt_model = load_taupy_model(self.model)
+        errors = {phase: np.zeros(3) for phase in self.phases}
+        for depth, dist in zip(depths, dists):
+            arrivals = tt_model.get_travel_times(depth, dist, self.phases)
+            for phase in self.phases:
+                arrival = _first_arrival(arrivals, phase)
+                values = np.array(self(phase, depth, dist))
+                if arrival is None or np.any(np.isnan(values)):
+                    continue
+                exact = (arrival.time, arrival.ray_param_sec_degree,
+                         arrival.incident_angle)
+                np.maximum(errors[phase], np.abs(values - exact),
+                           out=errors[phase])
+        return {phase: tuple(err) for phase, err in errors.items()}
+
+    def save(self, fname):
+        """Save table to NumPy npz file."""
+        np.savez_compressed(fname, phases=np.array(self.phases),
+                            model=np.array(self.model), depths=self.depths,
+                            distances=self.distances, data=self.data)
+
+    @classmethod
+    def load(cls, fname):
+        """Load table from NumPy npz file written by `save()`."""
+        with np.load(fname) as npz:
+            return cls(phases=tuple(str(p) for p in npz['phases']),
+                       model=str(npz['model']), depths=npz['depths'],
+                       distances=npz['distances'], data=npz['data'])
+
+
+class RFStatsCache(object):
+
+    """
+    Persistent cache of ray specific values calculated by rfstats.
+
+    Distance, back azimuth, travel time, slowness and inclination are
+    stored in a SQLite database with the key (event id, station coordinates,
+    phase, travel time model). Values calculated with a `TravelTimeTable`
+    are stored separately from exact values, the key includes the
+    identity of the table. Pass the cache to `~rf.rfstream.rfstats()`
+    or `~rf.util.iter_event_data()` with the ``cache`` argument. Warm runs
+    do not need any geodetic or TauPy calculation.
+
+    :param fname: filename of SQLite database, the file is created if it
+        does not exist
+
+    The attributes ``hits`` and ``misses`` count the successful and
+    unsuccessful lookups. The cache can be used as a context manager,
+    which closes the database connection at the end.
+    """
+
+    _CREATE = (
+        'CREATE TABLE IF NOT EXISTS rfstats ('
+        'event_id TEXT, latitude REAL, longitude REAL, elevation REAL, '
+        'phase TEXT, tt_model TEXT, distance REAL, back_azimuth REAL, '
+        'time REAL, slowness REAL, inclination REAL, '
+        'PRIMARY KEY (event_id, latitude, longitude, elevation, phase, '
+        'tt_model))')
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(fname, isolation_level=None,
+                                    check_same_thread=False)
+        self._con.execute('PRAGMA synchronous=OFF')
+        self._con.execute(self._CREATE)
+
+    def __repr__(self):
+        return '%s(%r) hits:%d misses:%d' % (
+            self.__class__.__name__, self.fname, self.hits, self.misses)
+
+    def __len__(self):
+        with self._lock:
+            cursor = self._con.execute('SELECT COUNT(*) FROM rfstats')
+            return cursor.fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _key(stats, phase, tt_model, tt_table=None):
+        model = str(tt_model)
+        if tt_table is not None:
+            model = '%s|%s' % (model, tt_table.identity)
+        return (stats.get('event_id'),
+                round(stats.station_latitude, 4),
+                round(stats.station_longitude, 4),
+                round(stats.get('station_elevation') or 0., 1),
+                phase, model)
+
+    def get(self, stats, phase, tt_model, tt_table=None):
+        """
+        Return cached values for event and station in stats.
+
+        Values calculated with tt_table are only returned if the same
+        table is given.
+
+        :return: tuple (distance, back_azimuth, time, slowness,
+            inclination) or None if the entry is not cached.
+            The last three values are None if the arrival was not
+            calculated, because the event was outside of the distance range.
+        """
+        key = self._key(stats, phase, tt_model, tt_table)
+        if key[0] is None:
+            return
+        with self._lock:
+            row = self._con.execute(
+                'SELECT distance, back_azimuth, time, slowness, inclination '
+                'FROM rfstats WHERE event_id=? AND latitude=? AND '
+                'longitude=? AND elevation=? AND phase=? AND tt_model=?',
+                key).fetchone()
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return row
+
+    def put(self, stats, phase, tt_model, distance, back_azimuth,
+            time=None, slowness=None, inclination=None, tt_table=None):
+        """
+        Store values for event and station in stats.
+
+        Pass tt_table if the values were calculated with a
+        `TravelTimeTable`.
+        """
+        key = self._key(stats, phase, tt_model, tt_table)
+        if key[0] is None:
+            return
+        values = key + (distance, back_azimuth, time, slowness, inclination)
+        with self._lock:
+            self._con.execute(
+                'INSERT OR REPLACE INTO rfstats VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', values)
+
+    def close(self):
+        """Close database connection."""
+        self._con.close()
+
+
+def _first_arrival(arrivals, phase):
+    for arrival in arrivals:
+        if arrival.phase.name == phase:
+            return arrival
+
+
+def _grid_weights(nodes, x):
+    """Return lower node index and interpolation weight for values x"""
+    i = np.clip(np.searchsorted(nodes, x, side='right') - 1,
+                0, len(nodes) - 2)
+    w = (x - nodes[i]) / (nodes[i + 1] - nodes[i])
+    w = np.where((w < 0) | (w > 1), np.nan, w)
+    return i, w
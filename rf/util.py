@@ -3,43 +3,622 @@
 Utility functions and classes for receiver function calculation.
 """
 import collections
+import functools
 import inspect
 import itertools
 from pkg_resources import resource_filename
+import sqlite3
+import threading
 
 from decorator import decorator
 import numpy as np
+from obspy.core import AttribDict
 
 
 DEG2KM = 111.2  #: Conversion factor from degrees epicentral distance to km
 
 
-def _get_stations(inventory):
+#: Default component sets of three component seismograms in order of
+#: preference
+COMPONENTS = ('ZNE', 'Z12')
+# maximal number of elements of the boolean mask in StationTable.match
+MATCH_CHUNKSIZE = 2 ** 22
+
+
+def _get_stations(inventory, channel_priority=None, components=COMPONENTS):
+    """
+    Return dictionary of seed ids ``NET.STA.LOC.XX?`` and one component.
+
+    If channel_priority is given, only seed ids with a complete
+    three component set are returned, if such a set exists for the
+    station.
+    """
     channels = inventory.get_contents()['channels']
     stations = {ch[:-1] + '?': ch[-1] for ch in channels}
-    return stations
+    if channel_priority is None:
+        return stations
+    comps = collections.defaultdict(set)
+    for ch in channels:
+        comps[ch[:-1] + '?'].add(ch[-1])
+    complete = {seedid for seedid, c in comps.items()
+                if any(set(cs) <= c for cs in components)}
+    complete_stations = {seedid.rsplit('.', 2)[0] for seedid in complete}
+    return {seedid: comp for seedid, comp in stations.items()
+            if seedid in complete or
+            seedid.rsplit('.', 2)[0] not in complete_stations}
+
+
+def _select_channels(seedid, comp_epochs, start, end, components):
+    """
+    Return list of channels of the preferred component set of an epoch.
+
+    An empty string is returned if the epoch has no additional components
+    or no complete set.
+    """
+    comps = {comp for comp, t1, t2 in comp_epochs if t1 <= end and start <= t2}
+    cs = next((cs for cs in components if set(cs) <= comps), None)
+    if cs is None or len(comps) == len(cs):
+        return ''
+    return ','.join(seedid.split('.')[3][:-1] + comp for comp in cs)
+
+
+def _channel_rank(seedid, comps, channel_priority, components=COMPONENTS):
+    """Return rank of seed id, the best channels have the lowest rank"""
+    from fnmatch import fnmatch
+    band = seedid.split('.')[3][:2]
+    band_rank = next((i for i, pattern in enumerate(channel_priority)
+                      if fnmatch(band, pattern)), len(channel_priority))
+    comp_rank = next((i for i, cs in enumerate(components)
+                      if set(cs) <= set(comps)), len(components))
+    return band_rank * (len(components) + 1) + comp_rank
+
+
+class StationTable(object):
+
+    """
+    Interval index of channel epochs with coordinates.
+
+    The table is built once from an inventory. It contains one row per
+    epoch of the channels selected by ``_get_stations()``, i.e. one
+    representative channel per ``NET.STA.LOC.XX?`` seed id. All events can be
+    matched to active stations at once with `match()`. The table can be
+    used instead of the inventory in `iter_event_data()`.
+
+    By default all seed ids of a station are used. If channel_priority is
+    given, only the best seed id of each station is matched for an event.
+    Only seed ids with a complete three component set are considered,
+    if such a set exists for the station. Seed ids are ranked by the
+    band and instrument code first and by the component set second.
+    Additionally, if an epoch has more components than the preferred
+    complete set (e.g. ZNE12), only the channels of this set are requested
+    for this epoch.
+
+    :param inventory: `~obspy.core.inventory.inventory.Inventory` instance
+    :param channel_priority: list of band and instrument codes in order of
+        preference, e.g. ``['HH', 'BH', 'EH']``, wildcards are allowed,
+        codes not in the list have the lowest priority
+    :param components: component sets in order of preference, default is
+        ``('ZNE', 'Z12')``, i.e. ZNE is preferred over Z12
+
+    The attribute seedids is a list of the seed ids. The following array
+    attributes have one value per epoch: index (index into seedids),
+    start and end (int64 nanoseconds since 1970-01-01, open intervals are
+    represented by the minimal and maximal int64 values), latitude,
+    longitude, elevation, local_depth and sampling_rate. The array
+    attribute channels holds the comma separated list of channels to
+    request for an epoch (e.g. ``'BHZ,BHN,BHE'``) or an empty string if
+    all channels of the seed id are requested.
+    """
+
+    def __init__(self, inventory, channel_priority=None,
+                 components=COMPONENTS):
+        stations = _get_stations(inventory, channel_priority, components)
+        self.seedids = list(stations)
+        self.rank = None
+        if channel_priority is not None:
+            comps = collections.defaultdict(set)
+            for ch in inventory.get_contents()['channels']:
+                comps[ch[:-1] + '?'].add(ch[-1])
+            ranks = {seedid: _channel_rank(seedid, comps[seedid],
+                                           channel_priority, components)
+                     for seedid in self.seedids}
+            self.rank = np.array([ranks[seedid] for seedid in self.seedids])
+        channels = {seedid[:-1] + comp: i
+                    for i, (seedid, comp) in enumerate(stations.items())}
+        imin, imax = np.iinfo(np.int64).min, np.iinfo(np.int64).max
+        rows = []
+        # epochs of all components of a seed id
+        comp_epochs = collections.defaultdict(list)
+        for net in inventory:
+            for sta in net:
+                for cha in sta:
+                    seedid = '.'.join((net.code, sta.code, cha.location_code,
+                                       cha.code))
+                    starts = [obj.start_date for obj in (net, sta, cha)
+                              if obj.start_date is not None]
+                    ends = [obj.end_date for obj in (net, sta, cha)
+                            if obj.end_date is not None]
+                    start = max(starts).ns if starts else imin
+                    end = min(ends).ns if ends else imax
+                    comp_epochs[seedid[:-1] + '?'].append(
+                        (seedid[-1], start, end))
+                    if seedid not in channels:
+                        continue
+                    coords = [getattr(cha, key, None)
+                              if getattr(cha, key, None) is not None
+                              else getattr(sta, key, None)
+                              for key in ('latitude', 'longitude',
+                                          'elevation')]
+                    coords.extend([cha.depth, cha.sample_rate])
+                    coords = [np.nan if v is None else v for v in coords]
+                    rows.append([channels[seedid], start, end] + coords)
+        columns = list(zip(*rows)) if len(rows) else [()] * 8
+        self.index = np.array(columns[0], dtype=int)
+        self.start = np.array(columns[1], dtype=np.int64)
+        self.end = np.array(columns[2], dtype=np.int64)
+        self.latitude = np.array(columns[3], dtype=float)
+        self.longitude = np.array(columns[4], dtype=float)
+        self.elevation = np.array(columns[5], dtype=float)
+        self.local_depth = np.array(columns[6], dtype=float)
+        self.sampling_rate = np.array(columns[7], dtype=float)
+        self.channels = np.array([''] * len(self.index), dtype=object)
+        if channel_priority is not None:
+            for k in range(len(self)):
+                seedid = self.seedids[self.index[k]]
+                self.channels[k] = _select_channels(
+                    seedid, comp_epochs[seedid], self.start[k], self.end[k],
+                    components)
+
+    def __len__(self):
+        return len(self.index)
+
+    def match(self, times):
+        """
+        Return epochs of all stations active at the given times.
+
+        If several epochs are active the first one in the inventory is
+        returned (like ``Inventory.get_coordinates()`` does). If the table
+        was created with channel_priority only the best active seed id of
+        each station is returned.
+
+        :param times: array of times in int64 nanoseconds
+            (e.g. ``EventTable.time``)
+        :return: integer array with shape (len(times), len(seedids)) holding
+            the epoch index or -1 if the station is not active
+        """
+        times = np.asarray(times, dtype=np.int64)
+        epochs = np.full((len(times), len(self.seedids)), -1, dtype=int)
+        if len(self) == 0:
+            return epochs
+        # epochs grouped by seed id, inventory order is kept in each group
+        order = np.argsort(self.index, kind='stable')
+        index = self.index[order]
+        first = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+        start = self.start[order]
+        end = self.end[order]
+        # process times in chunks to limit the size of the mask
+        step = max(1, MATCH_CHUNKSIZE // len(self))
+        for i in range(0, len(times), step):
+            t = times[i:i + step, np.newaxis]
+            # bounds are inclusive like in Inventory.get_coordinates()
+            active = (start <= t) & (t <= end)
+            k = np.where(active, order, len(self))
+            k = np.minimum.reduceat(k, first, axis=1)
+            k[k == len(self)] = -1
+            epochs[i:i + step, index[first]] = k
+        if self.rank is not None:
+            stations = [seedid.rsplit('.', 2)[0] for seedid in self.seedids]
+            groups = collections.defaultdict(list)
+            for j, sta in enumerate(stations):
+                groups[sta].append(j)
+            for js in groups.values():
+                if len(js) == 1:
+                    continue
+                js = np.array(js)
+                rank = np.where(epochs[:, js] >= 0, self.rank[js],
+                                np.iinfo(int).max)
+                best = np.argmin(rank, axis=1)
+                drop = np.ones(rank.shape, dtype=bool)
+                drop[np.arange(len(times)), best] = False
+                sub = epochs[:, js]
+                sub[drop] = -1
+                epochs[:, js] = sub
+        return epochs
+
+    def coordinates(self, epoch):
+        """Return dictionary with coordinates of epoch."""
+        return {'latitude': float(self.latitude[epoch]),
+                'longitude': float(self.longitude[epoch]),
+                'elevation': float(self.elevation[epoch]),
+                'local_depth': float(self.local_depth[epoch])}
+
+
+class EventTable(object):
+
+    """
+    Compact columnar table of event parameters.
+
+    The table is extracted once from a catalog and can be used instead
+    of the catalog in `iter_event_data()` and `iter_event_metadata()`.
+    Indexing with an integer returns a dictionary with the event entries
+    of the stats object, which can be passed to `~rf.rfstream.rfstats()`
+    as event argument. Indexing with a slice or an index array returns a
+    new table.
+
+    :param events: list of events or `~obspy.core.event.Catalog` instance
+    :param columns: alternatively, arrays with the columns of the table
+
+    The table has the following array attributes: latitude, longitude,
+    depth (km), magnitude, time (int64 nanoseconds since 1970-01-01, i.e.
+    UTCDateTime.ns) and resource_id. Missing values are NaN, missing
+    origin times are NaT (-2**63) and missing resource ids are empty
+    strings.
+    """
+
+    COLUMNS = ('latitude', 'longitude', 'depth', 'magnitude', 'time',
+               'resource_id')
+    NAT = np.iinfo(np.int64).min
+
+    def __init__(self, events=None, **columns):
+        if events is not None:
+            columns = self._extract(events)
+        for key in self.COLUMNS[:4]:
+            setattr(self, key, np.asarray(columns[key], dtype=float))
+        self.time = np.asarray(columns['time'], dtype=np.int64)
+        self.resource_id = np.asarray(columns['resource_id'], dtype=str)
+
+    @classmethod
+    def _extract(cls, events):
+        rows = []
+        for event in events:
+            origin = event.preferred_origin() or (
+                event.origins[0] if len(event.origins) else None)
+            magnitude = event.preferred_magnitude() or (
+                event.magnitudes[0] if len(event.magnitudes) else None)
+            if origin is None:
+                row = [None, None, None]
+                time = cls.NAT
+            else:
+                row = [origin.latitude, origin.longitude, origin.depth]
+                time = cls.NAT if origin.time is None else origin.time.ns
+            if row[2] is not None:
+                row[2] = row[2] / 1000
+            row.append(None if magnitude is None else magnitude.mag)
+            row = [np.nan if v is None else v for v in row]
+            evid = event.get('resource_id')
+            rows.append(row + [time, '' if evid is None else str(evid)])
+        columns = list(zip(*rows)) if len(rows) else [()] * 6
+        return dict(zip(cls.COLUMNS, columns))
+
+    def __len__(self):
+        return len(self.time)
+
+    def __str__(self, extended=False):
+        out = ['%d Event(s) in EventTable:' % len(self)]
+        if extended or len(self) <= 10:
+            for i in range(len(self)):
+                out.append('%s | %+7.3f, %+8.3f | %.1f km | M%.1f | %s' % (
+                    self.utctime(i), self.latitude[i], self.longitude[i],
+                    self.depth[i], self.magnitude[i], self.resource_id[i]))
+        return '\n'.join(out)
+
+    def __getitem__(self, index):
+        if not isinstance(index, (int, np.integer)):
+            return self.__class__(**{key: getattr(self, key)[index]
+                                     for key in self.COLUMNS})
+        values = [getattr(self, key)[index] for key in self.COLUMNS[:4]]
+        if np.isnan(values[0]) or np.isnan(values[1]):
+            raise ValueError('No origin')
+        if np.isnan(values[2]):
+            raise ValueError('No origin depth')
+        if np.isnan(values[3]):
+            raise ValueError('No magnitude')
+        if self.time[index] == self.NAT:
+            raise ValueError('No origin time')
+        evid = str(self.resource_id[index]) or None
+        return {'event_latitude': float(values[0]),
+                'event_longitude': float(values[1]),
+                'event_depth': float(values[2]),
+                'event_magnitude': float(values[3]),
+                'event_time': self.utctime(index),
+                'event_id': evid}
+
+    def utctime(self, index):
+        """Return origin time of event as UTCDateTime or None."""
+        from obspy import UTCDateTime
+        ns = self.time[index]
+        return None if ns == self.NAT else UTCDateTime(ns=int(ns))
+
+    def save(self, fname):
+        """Save table to NumPy npz file."""
+        np.savez_compressed(fname, **{key: getattr(self, key)
+                                      for key in self.COLUMNS})
+
+    @classmethod
+    def load(cls, fname):
+        """Load table from NumPy npz file written by `save()`."""
+        with np.load(fname) as npz:
+            return cls(**{key: npz[key] for key in cls.COLUMNS})
+
+
+def _distance_azimuth(lat1, lon1, lat2, lon2):
+    """Return spherical distance and azimuth from point 2 to point 1"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    dlon = lon1 - lon2
+    # haversine formula for distance
+    a = (np.sin(0.5 * (lat1 - lat2)) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin(0.5 * dlon) ** 2)
+    dist = 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    baz = np.arctan2(np.sin(dlon) * np.cos(lat1),
+                     np.cos(lat2) * np.sin(lat1) -
+                     np.sin(lat2) * np.cos(lat1) * np.cos(dlon))
+    return np.degrees(dist), np.degrees(baz) % 360
+
+
+def distance_azimuth_matrix(events, stations):
+    """
+    Return matrices of epicentral distance and back azimuth.
+
+    The calculation is vectorized and uses a spherical earth. Results
+    differ slightly (<0.5%) from the WGS84 values calculated in
+    `~rf.rfstream.rfstats()`.
+
+    :param events: array with shape (N, 2) holding event latitudes and
+        longitudes
+    :param stations: array with shape (M, 2) holding station latitudes and
+        longitudes
+    :return: arrays of epicentral distances in degree and
+        back azimuths (azimuth from station to event) in degree,
+        both with shape (N, M)
+    """
+    lat1, lon1 = np.asarray(events, dtype=float).T[:, :, None]
+    lat2, lon2 = np.asarray(stations, dtype=float).T[:, None, :]
+    return _distance_azimuth(lat1, lon1, lat2, lon2)
+
+
+def _get_pairs(events, stations, phases, dist_range):
+    """
+    Return list of active event-station pairs inside dist_range
+
+    :param events: EventTable
+    :param stations: StationTable
+    :return: list of tuples (event index, seedid index, epoch index)
+    """
+    from rf.rfstream import _get_dist_range
+    epochs = stations.match(events.time)
+    mask = (epochs >= 0) & (events.time != EventTable.NAT)[:, None]
+    dist_ranges = [_get_dist_range(phase, dist_range) for phase in phases]
+    if all(dist_ranges):
+        ep = np.maximum(epochs, 0)
+        dist, _ = _distance_azimuth(events.latitude[:, None],
+                                    events.longitude[:, None],
+                                    stations.latitude[ep],
+                                    stations.longitude[ep])
+        # use a tolerance to account for the spherical approximation,
+        # the exact check is performed in rfstats
+        tol = 1.
+        in_range = np.isnan(dist)
+        for dr in dist_ranges:
+            in_range |= (dr[0] - tol <= dist) & (dist <= dr[1] + tol)
+        mask &= in_range
+    i, j = np.nonzero(mask)
+    return list(zip(i, j, epochs[i, j]))
+
+
+def _merge_windows(windows):
+    """
+    Merge overlapping time windows.
+
+    :param windows: list of tuples (starttime, endtime, item)
+    :return: list of tuples (starttime, endtime, list of items)
+    """
+    merged = []
+    for t1, t2, item in sorted(windows, key=lambda w: w[0]):
+        if len(merged) > 0 and t1 <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], t2)
+            merged[-1][2].append((t1, t2, item))
+        else:
+            merged.append([t1, t2, [(t1, t2, item)]])
+    return merged
+
+
+class Journal(object):
+
+    """
+    Journal recording the outcome of event-station pairs.
+
+    For each event id, seed id and phase the status of the last run is
+    stored in a SQLite database. The status is one of
+
+    * 'written': the stream was yielded and the iteration continued
+      afterwards, i.e. the stream was processed by the consumer
+    * 'rejected': the pair was rejected, e.g. by rfstats or because of
+      missing components, the reason is stored, too
+    * 'failed': no data could be retrieved
+
+    Pass the journal to `iter_event_data()` with the ``journal`` argument.
+    With ``resume=True`` written and rejected pairs are skipped before
+    calling `~rf.rfstream.rfstats()`. Failed pairs are tried again.
+
+    :param fname: filename of SQLite database, the file is created if it
+        does not exist
+    """
+
+    _CREATE = (
+        'CREATE TABLE IF NOT EXISTS journal ('
+        'event_id TEXT, seedid TEXT, phase TEXT, status TEXT, reason TEXT, '
+        'PRIMARY KEY (event_id, seedid, phase))')
+    DONE = ('written', 'rejected')
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(fname, isolation_level=None,
+                                    check_same_thread=False)
+        self._con.execute(self._CREATE)
+
+    def __repr__(self):
+        return '%s(%r) %s' % (self.__class__.__name__, self.fname,
+                              self.summary())
+
+    def __len__(self):
+        with self._lock:
+            cursor = self._con.execute('SELECT COUNT(*) FROM journal')
+            return cursor.fetchone()[0]
+
+    def record(self, event_id, seedid, phase, status, reason=None):
+        """Record status of event-station pair for phase"""
+        if not event_id:
+            return
+        with self._lock:
+            self._con.execute(
+                'INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?)',
+                (event_id, seedid, phase, status, reason))
+
+    def status(self, event_id, seedid, phase):
+        """Return status and reason of event-station pair or None"""
+        with self._lock:
+            return self._con.execute(
+                'SELECT status, reason FROM journal WHERE event_id=? AND '
+                'seedid=? AND phase=?', (event_id, seedid, phase)).fetchone()
+
+    def done(self):
+        """Return set of (event_id, seedid, phase) tuples of done pairs"""
+        with self._lock:
+            rows = self._con.execute(
+                'SELECT event_id, seedid, phase FROM journal '
+                'WHERE status IN (?, ?)', self.DONE).fetchall()
+        return set(rows)
+
+    def summary(self):
+        """Return dictionary with number of entries per status"""
+        with self._lock:
+            rows = self._con.execute(
+                'SELECT status, COUNT(*) FROM journal GROUP BY status')
+            return dict(rows.fetchall())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close database connection."""
+        self._con.close()
+
+
+def _closing(iterable, journal):
+    """Yield items of iterable and close journal at the end"""
+    with journal:
+        for item in iterable:
+            yield item
+
+
+def _prepare_stream(stream, stats, event_id, seedid, journal=None):
+    """Merge stream, check components and gaps and attach stats"""
+    from rf.rfstream import RFStream
+    from warnings import warn
+    channels = seedid.split('.')[-1].split(',')
+    if len(channels) > 1:
+        # list of requested channels, other channels are discarded
+        stream.traces = [tr for tr in stream if tr.stats.channel in channels]
+    stream.merge()
+    msg = None
+    if len(stream) != 3:
+        msg = ('Need 3 component seismograms. %d components '
+               'detected for event %s, station %s.'
+               % (len(stream), event_id, seedid))
+    elif any(isinstance(tr.data, np.ma.masked_array) for tr in stream):
+        msg = ('Gaps or overlaps detected for event %s, station %s.'
+               % (event_id, seedid))
+    if msg is not None:
+        warn(msg)
+        if journal is not None:
+            journal.record(event_id, seedid, stats.phase, 'rejected', msg)
+        return
+    for tr in stream:
+        tr.stats.update(stats)
+    return RFStream(stream)
 
 
 def iter_event_data(events, inventory, get_waveforms, phase='P',
-                    request_window=None, pad=10, pbar=None, **kwargs):
+                    request_window=None, pad=10, pbar=None,
+                    max_workers=None, prefetch=None, ordered=True,
+                    bulk='event', order='event', block_length=None,
+                    journal=None, resume=False, coalesce=None, **kwargs):
     """
     Return iterator yielding three component streams per station and event.
 
-    :param events: list of events or `~obspy.core.event.Catalog` instance
-    :param inventory: `~obspy.core.inventory.inventory.Inventory` instance
-        with station and channel information
+    :param events: list of events, `~obspy.core.event.Catalog` or
+        `EventTable` instance
+    :param inventory: `~obspy.core.inventory.inventory.Inventory` or
+        `StationTable` instance with station and channel information
     :param get_waveforms: Function returning the data. It has to take the
         arguments network, station, location, channel, starttime, endtime.
-    :param phase: Considered phase, e.g. 'P', 'S', 'PP'
+        If the function has an attribute ``bulk``, it is used for bulk
+        requests. ``get_waveforms.bulk`` has to take a list of tuples
+        (network, station, location, channel, starttime, endtime) like
+        `obspy.clients.fdsn.client.Client.get_waveforms_bulk()` and
+        return one stream with the data of all requests.
+    :param phase: Considered phase, e.g. 'P', 'S', 'PP', or list of
+        phases, e.g. ['P', 'PP', 'S']. For a list of phases one stream
+        is yielded per phase and event-station pair. Data of phases with
+        overlapping request windows is retrieved with one request.
     :type request_window: tuple (start, end)
     :param request_window: requested time window around the onset of the phase
     :param float pad: add specified time in seconds to request window and
        trim afterwards again
     :param pbar: tqdm_ instance for displaying a progressbar
-    :param kwargs: all other kwargs are passed to `~rf.rfstream.rfstats()`
+    :param max_workers: retrieve data concurrently with this number of
+        threads (default: None, data is retrieved sequentially)
+    :param prefetch: maximal number of requests which are in flight or
+        wait for the consumer of the iterator (default: 2 * max_workers)
+    :param ordered: yield streams in order of the requests, otherwise
+        streams are yielded as soon as the data is available
+    :param bulk: chunk size of bulk requests, 'event' (default) combines
+        all requests for one event, an integer combines the given number of
+        requests, None disables bulk requests.
+        Only used if get_waveforms supports bulk requests.
+    :param order: 'event' (default) processes the event-station pairs
+        event by event, 'station' processes them station by station sorted
+        by time
+    :param block_length: retrieve data in blocks of this length in seconds
+        and keep the last blocks in memory, see
+        `~rf.datacache.BlockCache`. Default is one day for
+        ``order='station'`` and data read from a local archive
+        (`~rf.datacache.WaveformArchive`, the SDS client of ObsPy or a
+        function with the attribute ``local`` set to True), for which
+        consecutive requests of a station are served from the same block.
+        Otherwise, e.g. for FDSN web services, no blocks are used by
+        default. Use 0 to disable blocks.
+    :param journal: `Journal` instance or filename of journal database
+        recording the outcome of each event-station pair and phase
+    :param resume: skip pairs which are written or rejected according to
+        the journal
+    :param coalesce: combine overlapping requests of a channel and requests
+        separated by a gap not larger than this value in seconds to one
+        request, the data of the single requests is sliced afterwards
+        (default: None, requests are not combined). This reduces the
+        number of requests for clustered seismicity.
+    :param channel_priority,components: request only the best three
+        component set of each station, e.g. ``channel_priority=['HH',
+        'BH', 'EH']``, see `StationTable`
+        (default: all channels of a station are requested). If a station
+        epoch has additional components, the channels of the preferred
+        set are requested as comma separated list like for FDSN web
+        services (e.g. ``channel='BHZ,BHN,BHE'``), get_waveforms has to
+        support such lists in this case.
+    :param kwargs: all other kwargs are passed to `~rf.rfstream.rfstats()`,
+        the cache argument can also be the filename of a
+        `~rf.traveltime.RFStatsCache` database
 
     :return: three component streams with raw data
 
+    Events are matched to active stations and event-station pairs clearly
+    outside of dist_range are discarded beforehand with vectorized
+    calculations.
+
     Example usage with progressbar::
 
         from tqdm import tqdm
@@ -50,81 +629,698 @@ def iter_event_data(events, inventory, get_waveforms, phase='P',
 
     .. _tqdm: https://pypi.python.org/pypi/tqdm
     """
-    from rf.rfstream import rfstats, RFStream
-    method = phase[-1].upper()
-    if request_window is None:
-        request_window = (-50, 150) if method == 'P' else (-100, 50)
-    stations = _get_stations(inventory)
+    if block_length is None and order == 'station' and _is_local(
+            get_waveforms):
+        block_length = 86400
+    close = isinstance(journal, str)
+    if close:
+        journal = Journal(journal)
+    pairs = _iter_pairs(events, inventory, phase=phase,
+                        request_window=request_window, pbar=pbar,
+                        order=order, journal=journal, resume=resume,
+                        **kwargs)
+    data = _iter_data(pairs, get_waveforms, pad=pad, max_workers=max_workers,
+                      prefetch=prefetch, ordered=ordered, bulk=bulk,
+                      block_length=block_length, journal=journal,
+                      coalesce=coalesce)
+    # journal opened from filename is closed at the end
+    return _closing(data, journal) if close else data
+
+
+#: Accepted event-station pair with list of (starttime, endtime, stats)
+#: tuples, one for each phase
+_Pair = collections.namedtuple('_Pair', 'event_id seedid sampling_rate '
+                               'windows')
+
+
+def _iter_pairs(events, inventory, phase='P', request_window=None,
+                pbar=None, order='event', journal=None, resume=False,
+                channel_priority=None, components=COMPONENTS, **kwargs):
+    """Return iterator yielding accepted event-station pairs"""
+    from rf.rfstream import rfstats
+    if isinstance(kwargs.get('cache'), str):
+        # cache opened from filename is closed at the end
+        from rf.traveltime import RFStatsCache
+        with RFStatsCache(kwargs.pop('cache')) as cache:
+            for pair in _iter_pairs(
+                    events, inventory, phase=phase,
+                    request_window=request_window, pbar=pbar, order=order,
+                    journal=journal, resume=resume,
+                    channel_priority=channel_priority,
+                    components=components, cache=cache, **kwargs):
+                yield pair
+        return
+    phases = [phase] if isinstance(phase, str) else list(phase)
+    request_windows = []
+    for ph in phases:
+        rw = request_window
+        if rw is None:
+            rw = (-50, 150) if ph[-1].upper() == 'P' else (-100, 50)
+        request_windows.append(rw)
+    if not isinstance(events, EventTable):
+        events = EventTable(events)
+    stations = inventory
+    if not isinstance(stations, StationTable):
+        stations = StationTable(inventory, channel_priority=channel_priority,
+                                components=components)
+    pairs = _get_pairs(events, stations, phases,
+                       kwargs.get('dist_range', 'default'))
+    if order == 'station':
+        pairs = sorted(pairs, key=lambda p: (p[1], events.time[p[0]]))
+    elif order != 'event':
+        raise ValueError("order has to be one of 'event', 'station'")
+    done = journal.done() if resume and journal is not None else ()
     if pbar is not None:
-        pbar.total = len(events) * len(stations)
-    for event, seedid in itertools.product(events, stations):
+        pbar.total = len(pairs)
+    for i, j, epoch in pairs:
+        event_id = events.resource_id[i]
+        seedid = stations.seedids[j]
+        if stations.channels[epoch]:
+            # request only the preferred component set
+            seedid = '%s.%s' % (seedid.rsplit('.', 1)[0],
+                                stations.channels[epoch])
         if pbar is not None:
             pbar.update(1)
-        origin_time = (event.preferred_origin() or event.origins[0])['time']
-        try:
-            args = (seedid[:-1] + stations[seedid], origin_time)
-            coords = inventory.get_coordinates(*args)
-        except Exception:  # station not available at that time
+        if done and all((event_id, seedid, ph) in done for ph in phases):
             continue
+        coords = stations.coordinates(epoch)
         try:
-            stats = rfstats(station=coords, event=event, phase=phase, **kwargs)
+            stats = rfstats(station=coords, event=events[i], phase=phase,
+                            **kwargs)
         except Exception as ex:
             from warnings import warn
-            warn('Error "%s" in rfstats call for event %s, station %s.'
-                 % (ex, event.resource_id, seedid))
-            continue
-        if not stats:
-            continue
-        net, sta, loc, cha = seedid.split('.')
-        starttime = stats.onset + request_window[0]
-        endtime = stats.onset + request_window[1]
-        kws = {'network': net, 'station': sta, 'location': loc,
-               'channel': cha, 'starttime': starttime - pad,
-               'endtime': endtime + pad}
-        try:
-            stream = get_waveforms(**kws)
-        except Exception:  # no data available
-            continue
-        stream.trim(starttime, endtime)
-        stream.merge()
-        if len(stream) != 3:
-            from warnings import warn
-            warn('Need 3 component seismograms. %d components '
-                 'detected for event %s, station %s.'
-                 % (len(stream), event.resource_id, seedid))
-            continue
-        if any(isinstance(tr.data, np.ma.masked_array) for tr in stream):
-            from warnings import warn
-            warn('Gaps or overlaps detected for event %s, station %s.'
-                 % (event.resource_id, seedid))
+            msg = ('Error "%s" in rfstats call for event %s, station %s.'
+                   % (ex, event_id, seedid))
+            warn(msg)
+            if journal is not None:
+                for ph in phases:
+                    journal.record(event_id, seedid, ph, 'rejected', msg)
             continue
-        for tr in stream:
-            tr.stats.update(stats)
-        yield RFStream(stream)
+        if isinstance(phase, str):
+            stats = [stats]
+        if journal is not None:
+            for ph, st in zip(phases, stats):
+                if not st:
+                    journal.record(event_id, seedid, ph, 'rejected',
+                                   'no arrival inside distance range')
+        windows = [(st.onset + rw[0], st.onset + rw[1], st)
+                   for st, rw in zip(stats, request_windows) if st]
+        if len(windows) > 0:
+            yield _Pair(event_id, seedid, stations.sampling_rate[epoch],
+                        windows)
+
+
+#: Options of `iter_event_data()` used for data retrieval only
+_RETRIEVAL_OPTIONS = ('pad', 'max_workers', 'prefetch', 'ordered', 'bulk',
+                      'block_length', 'journal', 'resume', 'coalesce')
+
+#: Request with get_waveforms kwargs, pair and windows of the pair inside
+#: the request, combined requests hold the list of original requests in
+#: parts
+_Request = collections.namedtuple('_Request', 'kws pair group parts')
+
+#: Maximal length in seconds of combined requests
+COALESCE_MAX_LENGTH = 6 * 3600
+
+
+def _iter_requests(pairs, pad=10):
+    """Return iterator yielding request kwargs and corresponding windows"""
+    for pair in pairs:
+        net, sta, loc, cha = pair.seedid.split('.')
+        # phases with overlapping request windows share one request
+        for starttime, endtime, group in _merge_windows(pair.windows):
+            kws = {'network': net, 'station': sta, 'location': loc,
+                   'channel': cha, 'starttime': starttime - pad,
+                   'endtime': endtime + pad}
+            yield _Request(kws, pair, group, None)
+
+
+def _combine_requests(t1, t2, parts):
+    if len(parts) == 1:
+        return parts[0]
+    kws = dict(parts[0].kws, starttime=t1, endtime=t2)
+    return _Request(kws, parts[0].pair, None, parts)
+
+
+def _coalesce_requests(requests, tolerance=0):
+    """
+    Combine overlapping or nearly adjacent requests of the same channel.
+
+    A request is combined with the pending request of the same channel if
+    the gap between both is not larger than tolerance and the combined
+    request is not longer than `COALESCE_MAX_LENGTH`. Otherwise the pending
+    request is yielded.
+    """
+    pending = collections.OrderedDict()
+    for request in requests:
+        kws = request.kws
+        key = tuple(kws[k] for k in ('network', 'station', 'location',
+                                     'channel'))
+        t1, t2 = kws['starttime'], kws['endtime']
+        if key in pending:
+            p1, p2, parts = pending[key]
+            if (t1 - tolerance <= p2 and p1 - tolerance <= t2 and
+                    max(t2, p2) - min(t1, p1) <= COALESCE_MAX_LENGTH):
+                pending[key] = [min(t1, p1), max(t2, p2), parts + [request]]
+                continue
+            yield _combine_requests(*pending.pop(key))
+        pending[key] = [t1, t2, [request]]
+    for value in pending.values():
+        yield _combine_requests(*value)
+
+
+def _get_waveforms_or_none(get_waveforms, request):
+    try:
+        return get_waveforms(**request.kws)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception:  # no data available
+        pass
+
+
+def _iter_chunks(requests, bulk='event'):
+    """Return iterator yielding lists of requests for bulk requests"""
+    if bulk == 'event':
+        for _, chunk in itertools.groupby(requests,
+                                          lambda r: r.pair.event_id):
+            yield list(chunk)
+        return
+    requests = iter(requests)
+    while True:
+        chunk = list(itertools.islice(requests, bulk))
+        if len(chunk) == 0:
+            break
+        yield chunk
+
+
+def _get_waveforms_bulk(get_waveforms_bulk, chunk):
+    """Retrieve data of requests in chunk with one call and split it up"""
+    keys = ('network', 'station', 'location', 'channel', 'starttime',
+            'endtime')
+    # lists of channels are requested with one line per channel
+    lines = []
+    for request in chunk:
+        net, sta, loc, cha, t1, t2 = (request.kws[key] for key in keys)
+        lines.append([(net, sta, loc, c, t1, t2) for c in cha.split(',')])
+    bulk = [args for request_lines in lines for args in request_lines]
+    try:
+        stream = get_waveforms_bulk(bulk)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception:  # no data available
+        stream = None
+    if stream is None:
+        return [None] * len(chunk)
+    streams = []
+    for request_lines in lines:
+        st = stream.__class__()
+        for net, sta, loc, cha, t1, t2 in request_lines:
+            st += stream.select(network=net, station=sta, location=loc,
+                                channel=cha).slice(t1, t2)
+        st = st.copy()
+        streams.append(st if len(st) > 0 else None)
+    return streams
+
+
+def _fetch(items, func, max_workers=None, prefetch=None, ordered=True):
+    """
+    Return iterator yielding items together with the results of func(item).
+
+    With max_workers > 1 the function is called concurrently by a thread
+    pool. At most prefetch items are in flight or wait for the consumer.
+    """
+    if not max_workers or max_workers <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor,
+                                    wait)
+    if prefetch is None:
+        prefetch = 2 * max_workers
+    prefetch = max(prefetch, 1)
+    items = iter(items)
+    pending = collections.OrderedDict()
+    executor = ThreadPoolExecutor(max_workers)
+    try:
+        while True:
+            for item in itertools.islice(items, prefetch - len(pending)):
+                pending[executor.submit(func, item)] = item
+            if len(pending) == 0:
+                break
+            if ordered:
+                future = next(iter(pending))
+            else:
+                future = next(iter(wait(pending,
+                                        return_when=FIRST_COMPLETED)[0]))
+            item = pending.pop(future)
+            yield item, future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _iter_streams(requests, get_waveforms, bulk='event', **kwargs):
+    """Return iterator yielding requests together with retrieved streams"""
+    get_waveforms_bulk = getattr(get_waveforms, 'bulk', None)
+    if get_waveforms_bulk is None or not bulk:
+        func = functools.partial(_get_waveforms_or_none, get_waveforms)
+        for request, stream in _fetch(requests, func, **kwargs):
+            yield request, stream
+        return
+    func = functools.partial(_get_waveforms_bulk, get_waveforms_bulk)
+    chunks = _iter_chunks(requests, bulk=bulk)
+    for chunk, streams in _fetch(chunks, func, **kwargs):
+        for request, stream in zip(chunk, streams):
+            yield request, stream
+
+
+def _is_local(get_waveforms):
+    """Check if get_waveforms reads data from a local archive"""
+    from obspy.clients.filesystem.sds import Client as SDSClient
+    # unwrap caches, see rf.datacache
+    for _ in range(10):
+        if (getattr(get_waveforms, 'local', False) or
+                isinstance(getattr(get_waveforms, '__self__', None),
+                           SDSClient)):
+            return True
+        get_waveforms = getattr(get_waveforms, 'get_waveforms', None)
+        if get_waveforms is None:
+            break
+    return False
+
+
+def _iter_data(pairs, get_waveforms, pad=10, bulk='event', block_length=None,
+               journal=None, coalesce=None, **kwargs):
+    """Return iterator yielding streams for accepted event-station pairs"""
+    if block_length:
+        from rf.datacache import BlockCache
+        get_waveforms = BlockCache(get_waveforms, block_length=block_length)
+    requests = _iter_requests(pairs, pad=pad)
+    if coalesce is not None:
+        requests = _coalesce_requests(requests, tolerance=coalesce)
+    for request, stream in _iter_streams(requests, get_waveforms, bulk=bulk,
+                                         **kwargs):
+        for pair, st in _split_stream(request, stream, journal=journal):
+            yield st
+            _record_written(pair, st, journal)
+
+
+def _record_written(pair, stream, journal):
+    """Record stream in journal after it was processed by the consumer"""
+    if journal is not None:
+        journal.record(pair.event_id, pair.seedid, stream[0].stats.phase,
+                       'written')
+
+
+def _split_stream(request, stream, journal=None):
+    """Return list of (pair, checked stream) for the windows of a request"""
+    if request.parts is not None:
+        # slice the original requests from the data of combined requests
+        streams = []
+        for part in request.parts:
+            st = None
+            if stream is not None:
+                st = stream.slice(part.kws['starttime'],
+                                  part.kws['endtime']).copy()
+            streams.extend(_split_stream(part, st, journal=journal))
+        return streams
+    pair, group = request.pair, request.group
+    if stream is None:
+        if journal is not None:
+            for _, _, st in group:
+                journal.record(pair.event_id, pair.seedid, st.phase,
+                               'failed', 'no data')
+        return []
+    streams = []
+    for t1, t2, st in group:
+        if len(group) == 1:
+            stream.trim(t1, t2)
+            st_phase = stream
+        else:
+            st_phase = stream.slice(t1, t2).copy()
+        st_phase = _prepare_stream(st_phase, st, pair.event_id, pair.seedid,
+                                   journal=journal)
+        if st_phase is not None:
+            streams.append((pair, st_phase))
+    return streams
+
+
+async def aiter_event_data(events, inventory, get_waveforms, phase='P',
+                           request_window=None, pad=10, pbar=None,
+                           max_concurrent=10, prefetch=None, ordered=True,
+                           journal=None, resume=False, coalesce=None,
+                           **kwargs):
+    """
+    Return asynchronous iterator yielding three component streams.
+
+    This is the asyncio variant of `iter_event_data()` for data sources
+    with an asynchronous client. Up to max_concurrent requests are
+    awaited concurrently. The returned streams are checked in the same
+    way as in `iter_event_data()`. Failed requests are skipped.
+
+    :param get_waveforms: coroutine function returning the data. It has to
+        take the arguments network, station, location, channel, starttime,
+        endtime.
+    :param max_concurrent: maximal number of concurrent requests
+    :param prefetch: maximal number of requests which are in flight or
+        wait for the consumer of the iterator
+        (default: 2 * max_concurrent)
+    :param ordered: yield streams in order of the requests, otherwise
+        streams are yielded as soon as the data is available
+
+    See `iter_event_data()` for a description of the other arguments.
+
+    Example usage::
+
+        async for stream3c in aiter_event_data(*args, max_concurrent=100):
+            do_something(stream3c)
+    """
+    import asyncio
+    if prefetch is None:
+        prefetch = 2 * max_concurrent
+    prefetch = max(prefetch, 1)
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def fetch(request):
+        async with semaphore:
+            try:
+                return await get_waveforms(**request.kws)
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # no data available
+                pass
+
+    close = isinstance(journal, str)
+    if close:
+        journal = Journal(journal)
+    pairs = _iter_pairs(events, inventory, phase=phase,
+                        request_window=request_window, pbar=pbar,
+                        journal=journal, resume=resume, **kwargs)
+    requests = _iter_requests(pairs, pad=pad)
+    if coalesce is not None:
+        requests = _coalesce_requests(requests, tolerance=coalesce)
+    pending = collections.OrderedDict()
+    try:
+        while True:
+            for request in itertools.islice(requests,
+                                            prefetch - len(pending)):
+                pending[asyncio.ensure_future(fetch(request))] = request
+            if len(pending) == 0:
+                break
+            if ordered:
+                task = next(iter(pending))
+                await asyncio.wait([task])
+            else:
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                task = next(t for t in pending if t in done)
+            request = pending.pop(task)
+            for pair, st in _split_stream(request, task.result(),
+                                          journal=journal):
+                yield st
+                _record_written(pair, st, journal)
+    finally:
+        for task in pending:
+            task.cancel()
+        if close:
+            # journal opened from filename is closed at the end
+            journal.close()
+
+
+class TaskTable(object):
+
+    """
+    Table of accepted event-station work items.
+
+    Each row corresponds to one phase of an accepted event-station pair
+    and holds all entries of the stats object calculated by
+    `~rf.rfstream.rfstats()` and the request window. The table is
+    created with `plan_event_data()`, can be saved to and loaded
+    from disk and is consumed by `iter_task_data()`.
+
+    :param pad: time in seconds added to the request windows during
+        data retrieval, stored in the attribute pad
+    :param unset: comma separated names of headers not set by
+        `~rf.rfstream.rfstats()` for each row, stored in the attribute
+        unset, default: headers with NaN value
+    :param columns: arrays with the columns of the table
+
+    Times are stored as int64 nanoseconds since 1970-01-01. The pair
+    column numbers the event-station pairs, rows of the same pair are
+    consecutive.
+    """
+
+    COLUMNS = ('pair', 'event_id', 'seedid', 'phase',
+               'event_latitude', 'event_longitude', 'event_depth',
+               'event_magnitude', 'event_time',
+               'station_latitude', 'station_longitude', 'station_elevation',
+               'distance', 'back_azimuth', 'inclination', 'slowness',
+               'onset', 'starttime', 'endtime', 'sampling_rate',
+               'pp_latitude', 'pp_longitude', 'pp_depth')
+    _STR_COLUMNS = ('event_id', 'seedid', 'phase')
+    _TIME_COLUMNS = ('event_time', 'onset', 'starttime', 'endtime')
+    _WINDOW_COLUMNS = ('starttime', 'endtime', 'sampling_rate')
+
+    def __init__(self, pad=10, unset=None, **columns):
+        self.pad = float(pad)
+        for key in self.COLUMNS:
+            dtype = (str if key in self._STR_COLUMNS else
+                     np.int64 if key in self._TIME_COLUMNS + ('pair',) else
+                     float)
+            setattr(self, key, np.asarray(columns.get(key, ()), dtype=dtype))
+        if unset is None:
+            keys = [key for key in self.COLUMNS[4:]
+                    if getattr(self, key).dtype == float and
+                    key not in self._WINDOW_COLUMNS]
+            unset = [','.join(key for key in keys
+                              if np.isnan(getattr(self, key)[k]))
+                     for k in range(len(self))]
+        self.unset = np.asarray(unset, dtype=str)
+
+    @classmethod
+    def _from_pairs(cls, pairs, pad=10):
+        rows = []
+        unset = []
+        for k, pair in enumerate(pairs):
+            for t1, t2, st in pair.windows:
+                row = [k, pair.event_id or '', pair.seedid]
+                missing = []
+                for key in cls.COLUMNS[3:]:
+                    if key in ('starttime', 'endtime'):
+                        value = t1 if key == 'starttime' else t2
+                    elif key == 'sampling_rate':
+                        value = pair.sampling_rate
+                    else:
+                        value = st.get(key)
+                        if value is None:
+                            missing.append(key)
+                    if key in cls._TIME_COLUMNS:
+                        value = value.ns
+                    row.append(np.nan if value is None else value)
+                rows.append(row)
+                unset.append(','.join(missing))
+        columns = (list(zip(*rows)) if len(rows) else
+                   [()] * len(cls.COLUMNS))
+        return cls(pad=pad, unset=unset, **dict(zip(cls.COLUMNS, columns)))
+
+    def __len__(self):
+        return len(self.pair)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            index = [index]
+        return self.__class__(pad=self.pad, unset=self.unset[index],
+                              **{key: getattr(self, key)[index]
+                                 for key in self.COLUMNS})
+
+    def __str__(self):
+        summary = self.summary()
+        return ('TaskTable with {tasks} tasks for {pairs} event-station '
+                'pairs, {events} events and {stations} stations, '
+                'estimated data volume: {megabytes:.1f} MB').format(
+                    megabytes=summary['bytes'] / 1e6, **summary)
+
+    def summary(self, ncomponents=3, bytes_per_sample=4, pad=None):
+        """
+        Return counts and estimated data volume.
+
+        :param ncomponents: number of components per request
+        :param bytes_per_sample: estimated number of bytes per sample
+        :param pad: time in seconds added to the request windows,
+            default is the pad of the table
+        :return: dictionary with number of tasks, pairs, events,
+            stations and estimated bytes
+        """
+        if pad is None:
+            pad = self.pad
+        duration = (self.endtime - self.starttime) / 1e9 + 2 * pad
+        nbytes = np.nansum(duration * self.sampling_rate) * ncomponents
+        return {'tasks': len(self), 'pairs': len(np.unique(self.pair)),
+                'events': len(np.unique(self.event_id)),
+                'stations': len(np.unique(self.seedid)),
+                'bytes': int(nbytes * bytes_per_sample)}
+
+    def shard(self, index, number):
+        """
+        Return part of the table for processing with several workers.
+
+        Rows of one event-station pair are kept together.
+
+        :param index: index of shard between 0 and number-1
+        :param number: number of shards
+        """
+        return self[self.pair % number == index]
+
+    def stats(self, index):
+        """Return stats dictionary of row with index."""
+        from obspy import UTCDateTime
+        stats = AttribDict()
+        unset = str(self.unset[index]).split(',')
+        for key in self.COLUMNS[3:]:
+            if key in self._WINDOW_COLUMNS or key in unset:
+                continue
+            value = getattr(self, key)[index]
+            if key in self._TIME_COLUMNS:
+                value = UTCDateTime(ns=int(value))
+            elif key in self._STR_COLUMNS:
+                value = str(value)
+            else:
+                value = float(value)
+            stats[key] = value
+        stats['event_id'] = str(self.event_id[index]) or None
+        return stats
+
+    def _iter_pairs(self):
+        from obspy import UTCDateTime
+        pair = None
+        for k in range(len(self)):
+            if pair is None or self.pair[k] != self.pair[k - 1]:
+                if pair is not None:
+                    yield pair
+                pair = _Pair(str(self.event_id[k]) or None,
+                             str(self.seedid[k]),
+                             self.sampling_rate[k], [])
+            pair.windows.append((UTCDateTime(ns=int(self.starttime[k])),
+                                 UTCDateTime(ns=int(self.endtime[k])),
+                                 self.stats(k)))
+        if pair is not None:
+            yield pair
+
+    def save(self, fname):
+        """Save table to NumPy npz file."""
+        np.savez_compressed(fname, pad=self.pad, unset=self.unset,
+                            **{key: getattr(self, key)
+                               for key in self.COLUMNS})
+
+    @classmethod
+    def load(cls, fname):
+        """Load table from NumPy npz file written by `save()`."""
+        with np.load(fname) as npz:
+            pad = npz['pad'] if 'pad' in npz.files else 10
+            unset = npz['unset'] if 'unset' in npz.files else None
+            return cls(pad=pad, unset=unset,
+                       **{key: npz[key] for key in cls.COLUMNS})
+
+
+def plan_event_data(events, inventory, phase='P', request_window=None,
+                    pbar=None, **kwargs):
+    """
+    Return table of all accepted event-station pairs.
+
+    The table contains the same work items as processed by
+    `iter_event_data()`, but no data is retrieved. It can be saved to disk,
+    inspected, split into shards and consumed by `iter_task_data()`.
+
+    See `iter_event_data()` for a description of the arguments.
+    Options for data retrieval are ignored, except pad, which is stored
+    in the table and used by `iter_task_data()`.
+
+    :return: `TaskTable` instance
+    """
+    pad = kwargs.get('pad', 10)
+    for key in _RETRIEVAL_OPTIONS:
+        kwargs.pop(key, None)
+    pairs = _iter_pairs(events, inventory, phase=phase,
+                        request_window=request_window, pbar=pbar, **kwargs)
+    return TaskTable._from_pairs(pairs, pad=pad)
+
+
+def iter_task_data(tasks, get_waveforms, pad=None, pbar=None,
+                   max_workers=None, prefetch=None, ordered=True,
+                   bulk='event', block_length=None, journal=None,
+                   resume=False, coalesce=None):
+    """
+    Return iterator yielding three component streams for a task table.
+
+    :param tasks: `TaskTable` instance created by `plan_event_data()`
+    :param get_waveforms: function returning the data,
+        see `iter_event_data()`
+    :param float pad: add specified time in seconds to request window and
+       trim afterwards again, default is the pad of the task table
+    :param pbar: tqdm_ instance for displaying a progressbar
+    :param max_workers,prefetch,ordered,bulk,block_length,coalesce: options
+        for concurrent data retrieval, bulk requests, retrieval of data
+        blocks and combination of requests, see `iter_event_data()`
+    :param journal,resume: journal recording the outcome of the tasks and
+        flag for skipping done tasks, see `iter_event_data()`
+
+    :return: three component streams with raw data
+    """
+    if pad is None:
+        pad = tasks.pad
+    close = isinstance(journal, str)
+    if close:
+        journal = Journal(journal)
+    pairs = tasks._iter_pairs()
+    if pbar is not None:
+        pbar.total = len(np.unique(tasks.pair))
+        pairs = _update_pbar(pairs, pbar)
+    if resume and journal is not None:
+        done = journal.done()
+        pairs = (pair for pair in pairs if not all(
+            (pair.event_id, pair.seedid, w[2].phase) in done
+            for w in pair.windows))
+    data = _iter_data(pairs, get_waveforms, pad=pad, max_workers=max_workers,
+                      prefetch=prefetch, ordered=ordered, bulk=bulk,
+                      block_length=block_length, journal=journal,
+                      coalesce=coalesce)
+    # journal opened from filename is closed at the end
+    return _closing(data, journal) if close else data
+
+
+def _update_pbar(iterable, pbar):
+    for item in iterable:
+        pbar.update(1)
+        yield item
 
 
 def iter_event_metadata(events, inventory, pbar=None):
     """
     Return iterator yielding metadata per station and event.
 
-    :param events: list of events or `~obspy.core.event.Catalog` instance
+    :param events: list of events, `~obspy.core.event.Catalog` or
+        `EventTable` instance
     :param inventory: `~obspy.core.inventory.inventory.Inventory` instance
         with station and channel information
     :param pbar: tqdm_ instance for displaying a progressbar
     """
     stations = _get_stations(inventory)
     if events is None:
-        events = [None]
+        times = [None]
+    else:
+        if not isinstance(events, EventTable):
+            events = EventTable(events)
+        times = [events.utctime(i) for i in range(len(events))]
     if pbar is not None:
-        pbar.total = len(events) * len(stations)
-    for event, seedid in itertools.product(events, stations):
+        pbar.total = len(times) * len(stations)
+    for ot, seedid in itertools.product(times, stations):
         if pbar is not None:
             pbar.update(1)
         net, sta, loc, cha = seedid.split('.')
         meta = {'network': net, 'station': sta, 'location': loc,
                 'channel': cha}
-        if event is not None:
-            ot = (event.preferred_origin() or event.origins[0])['time']
+        if ot is not None:
             meta['event_time'] = ot
         yield meta
 
@@ -222,8 +1418,8 @@ def minimal_example_Srf():
     return stream.copy()
 
 
-@decorator
-def _add_processing_info(_func_, *args, **kwargs):
+def _processing_info(_func_, *args, **kwargs):
+    """Return processing info for a call of _func_"""
     from rf import __version__
     args_ = inspect.getcallargs(_func_, *args, **kwargs)
     if args_.pop('self', None) is None:
@@ -239,7 +1435,12 @@ def _add_processing_info(_func_, *args, **kwargs):
         version=__version__, function=_func_.__name__)
     arguments = ['%s=%s' % (k, repr(v)) if not isinstance(v, str) else
                  "%s='%s'" % (k, v) for k, v in kw.items()]
-    info = info % '::'.join(sorted(arguments))
+    return info % '::'.join(sorted(arguments))
+
+
+@decorator
+def _add_processing_info(_func_, *args, **kwargs):
+    info = _processing_info(_func_, *args, **kwargs)
     stream = _func_(*args, **kwargs)
     try:
         for tr in stream: